@@ -1,19 +1,36 @@
 from flask import Flask, request, jsonify, Blueprint
-from PIL import Image
-from io import BytesIO
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import logging
 import time
 import threading
-from fuzzywuzzy import process, fuzz
+from fuzzywuzzy import fuzz, utils as fuzz_utils
+from sortedcontainers import SortedList
 import urllib.parse
 import json
 import math
 import re
-from typing import Dict, Any, Optional, Tuple, List
+from typing import Dict, Any, Optional, Tuple, List, NamedTuple
 from datetime import datetime, timedelta
 import random
+import queue
+import itertools
+import atexit
+import signal
+import sqlite3
+import hashlib
+import hmac
+import heapq
+import bisect
+import sys
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 
 
 app = Flask(__name__)
@@ -43,6 +60,9 @@ ADMIN_IDS = [
 ]
 JSONBIN_MASTER_KEY = os.getenv("JSONBIN_MASTER_KEY")
 JSONBIN_BIN_ID = os.getenv("JSONBIN_BIN_ID")
+JSONBIN_API = os.getenv("JSONBIN_API", "https://api.jsonbin.io/v3")
+KARMA_FLUSH_SECONDS = float(os.getenv("KARMA_FLUSH_SECONDS", "10"))
+KARMA_MAX_STALENESS = float(os.getenv("KARMA_MAX_STALENESS", "300"))
 
 # Swear word categories
 INSTANT_BAN_WORDS = [
@@ -72,32 +92,261 @@ user_swear_counts_file = "user_swear_counts.json"
 strikes_file = "user_strikes.json"
 daily_counts_file = "daily_message_counts.json"
 last_messages_file = "last_messages.json"
+daily_history_file = "daily_history.jsonl"
+search_db_file = os.getenv("SEARCH_DB_PATH", "search.db")
 system_messages_enabled_file = "system_messages_enabled.json"
+muted_users_file = "muted_users.json"
+karma_cache_file = "karma_history.json"
+membership_jobs_file = "membership_jobs.json"
+seen_messages_file = "seen_messages.json"
+swear_words_file = "swear_words.json"  # optional {"instant": [...], "regular": [...]} override
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-GROUPME_API = "https://api.groupme.com/v3"
-API_URL = "https://api.groupme.com/v3"
+# Overridable so benchmarks can point the bot at fakeapi.py
+GROUPME_API = os.getenv("GROUPME_API", "https://api.groupme.com/v3")
+API_URL = GROUPME_API
+TAVILY_API = os.getenv("TAVILY_API", "https://api.tavily.com")
 
 # In-memory caches
-user_swear_counts: Dict[str, int] = {}
-banned_users: Dict[str, str] = {}
-former_members: Dict[str, str] = {}
-user_strikes: Dict[str, int] = {}
-muted_users: Dict[str, float] = {}  # Changed to float for time.time()
-daily_message_counts: Dict[str, int] = {}
-last_message_by_user: Dict[str, str] = {}
-daily_counts_date: Optional[str] = None
-last_messages_date: Optional[str] = None
-system_messages_enabled = True
+# bans, swear counts, former members, strikes and mutes are StateMaps (see State Backends);
+# daily counts and last messages are a DailyTracker per group (see Daily Tracking Init)
+
+# State backend: "json" (one file per map, write-behind) or "sqlite" (WAL, per-key upserts)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+
+# HTTP client
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
+
+# Shared state for cooldowns/spam windows: "memory", "sqlite" or "redis" (REDIS_URL)
+SHARED_STATE = os.getenv("SHARED_STATE", "sqlite" if STATE_BACKEND == "sqlite" else "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Spam rules (see Spam Detection)
+SPAM_IDENTICAL_LIMIT = int(os.getenv("SPAM_IDENTICAL_LIMIT", "5"))
+SPAM_RATE_LIMIT = int(os.getenv("SPAM_RATE_LIMIT", "10"))
+SPAM_FLOOD_CHARS = int(os.getenv("SPAM_FLOOD_CHARS", "4000"))
+
+# Raid detection (see Raid Detection)
+RAID_WINDOW_SECONDS = float(os.getenv("RAID_WINDOW_SECONDS", "60"))
+RAID_JOIN_LIMIT = int(os.getenv("RAID_JOIN_LIMIT", "8"))
+RAID_AUTO_LOCKDOWN = os.getenv("RAID_AUTO_LOCKDOWN", "1") != "0"
+RAID_MUTE_MINUTES = int(os.getenv("RAID_MUTE_MINUTES", "5"))
+RAID_LOCKDOWN_MINUTES = int(os.getenv("RAID_LOCKDOWN_MINUTES", "30"))
 
 # Cooldown
-last_sent_time = 0.0
-last_system_message_time = 0.0
 cooldown_seconds = 10
 
+# -----------------------
+# Metrics
+# -----------------------
+# Prometheus-style counters and latency histograms for the webhook stages and
+# every outbound call, rendered at /metrics. Both /metrics and
+# /metrics/profile are disabled (404) until METRICS_TOKEN is set, and then
+# require ?token=... (or a Bearer header). The sampling profiler is off
+# unless PROFILER_ENABLED=1 or toggled through /metrics/profile.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))
+
+_metrics_lock = Lock()
+_histograms: Dict[Tuple[str, Tuple], Dict[str, Any]] = {}
+_counters: Dict[Tuple[str, Tuple], float] = {}
+_metric_help: Dict[str, str] = {
+    "webhook_seconds": "Total /webhook handling time",
+    "webhook_stage_seconds": "Time spent in each webhook stage",
+    "webhook_requests_total": "Webhook calls by outcome",
+    "http_client_seconds": "Outbound API call latency",
+    "http_client_errors_total": "Outbound API calls that raised or returned >= 400",
+    "state_flush_seconds": "Write-behind file flush time",
+    "outbound_budget_dropped_total": "Dispatch jobs dropped by a group's outbound budget",
+    "webhook_unknown_group_total": "Callbacks for groups this deployment does not serve",
+    "webhook_duplicates_total": "Redelivered callbacks dropped by message id",
+    "search_seconds": "!search query time",
+    "async_outbound_total": "Outbound jobs sent from the asgi.py event loop, by outcome",
+    "async_outbound_wait_seconds": "Time async outbound jobs waited for a free slot",
+}
+
+def observe(name: str, seconds: float, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * (len(METRIC_BUCKETS) + 1), "sum": 0.0, "count": 0}
+        hist["buckets"][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+@contextmanager
+def timed(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def _metric_labels(labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def render_metrics(gauges: Dict[str, float]) -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]} for k, v in _histograms.items()}
+        counters = dict(_counters)
+    seen = set()
+    for (name, labels), hist in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_metric_help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        running = 0
+        for bound, count in zip(METRIC_BUCKETS + (float("inf"),), hist["buckets"]):
+            running += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            bucket_labels = _metric_labels(labels, 'le="' + le + '"')
+            lines.append(f"{name}_bucket{bucket_labels} {running}")
+        lines.append(f"{name}_sum{_metric_labels(labels)} {hist['sum']:.6f}")
+        lines.append(f"{name}_count{_metric_labels(labels)} {hist['count']}")
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_metric_help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_metric_labels(labels)} {value:g}")
+    for name, value in sorted(gauges.items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {float(value):g}")
+    return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    """Samples every thread's stack on a timer and counts collapsed stacks (flamegraph input)."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self.running = False
+        self._lock = Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self.samples[key] = self.samples.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def collapsed(self, limit: int = 200) -> str:
+        with self._lock:
+            top = sorted(self.samples.items(), key=lambda kv: -kv[1])[:limit]
+        return "".join(f"{stack} {count}\n" for stack, count in top)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples = {}
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+if os.getenv("PROFILER_ENABLED") == "1":
+    profiler.start()
+
+# -----------------------
+# HTTP Client
+# -----------------------
+# One keep-alive session per host so deletes, posts and karma saves reuse
+# their TCP/TLS connections. Only idempotent methods are retried on 429/5xx;
+# a retried POST could double-post or double-ban.
+_http_sessions: Dict[str, requests.Session] = {}
+_http_lock = Lock()
+_http_stats: Dict[str, Dict[str, Any]] = {}
+
+def _http_session(host: str) -> requests.Session:
+    session = _http_sessions.get(host)
+    if session is not None:
+        return session
+    with _http_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE"}),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[host] = session
+    return session
+
+def _http_endpoint(url: str) -> str:
+    # Ids folded away so the label set stays small
+    return re.sub(r"/(?!v[0-9]+(?=/|$))[^/]*[0-9][^/]*", "/:id", urllib.parse.urlsplit(url).path)
+
+def _record_http(host: str, elapsed: float, error: bool, method: str = "", url: str = "") -> None:
+    endpoint = _http_endpoint(url)
+    observe("http_client_seconds", elapsed, host=host, method=method, endpoint=endpoint)
+    if error:
+        inc("http_client_errors_total", host=host, method=method, endpoint=endpoint)
+    with _http_lock:
+        stats = _http_stats.setdefault(host, {"requests": 0, "errors": 0, "seconds_total": 0.0, "seconds_max": 0.0})
+        stats["requests"] += 1
+        stats["seconds_total"] += elapsed
+        stats["seconds_max"] = max(stats["seconds_max"], elapsed)
+        if error:
+            stats["errors"] += 1
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """requests.request() through the pooled per-host session, with latency/error counters."""
+    host = urllib.parse.urlsplit(url).netloc
+    kwargs.setdefault("timeout", 8)
+    start = time.perf_counter()
+    try:
+        response = _http_session(host).request(method, url, **kwargs)
+    except Exception:
+        _record_http(host, time.perf_counter() - start, True, method, url)
+        raise
+    _record_http(host, time.perf_counter() - start, response.status_code >= 400, method, url)
+    return response
+
+def http_stats() -> Dict[str, Dict[str, Any]]:
+    with _http_lock:
+        result = {host: dict(stats) for host, stats in _http_stats.items()}
+    for stats in result.values():
+        stats["seconds_avg"] = stats["seconds_total"] / stats["requests"] if stats["requests"] else 0.0
+    return result
+
 # -----------------------
 # JSON Helpers
 # -----------------------
@@ -120,19 +369,705 @@ def save_json(file_path: str, data: Dict[str, Any]) -> None:
     except Exception as e:
         logger.error(f"Failed to save {file_path}: {e}")
 
+# -----------------------
+# Write-Behind Persistence
+# -----------------------
+# Hot-path state (daily counts, last messages, swear counts) is marked dirty
+# instead of rewritten per message. A flusher thread writes each dirty file
+# once per interval, or sooner when enough updates pile up.
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "2"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "200"))
+
+_write_behind_lock = Lock()
+_write_behind_dirty: Dict[str, Any] = {}
+_write_behind_pending = 0
+_write_behind_wakeup = threading.Event()
+_write_behind_started = False
+
+def schedule_save(file_path: str, producer) -> None:
+    """Mark file_path dirty. producer() must return a snapshot safe to serialize off-thread."""
+    global _write_behind_pending
+    with _write_behind_lock:
+        _write_behind_dirty[file_path] = producer
+        _write_behind_pending += 1
+        over_threshold = _write_behind_pending >= WRITE_BEHIND_MAX_PENDING
+    _start_write_behind_once()
+    if over_threshold:
+        _write_behind_wakeup.set()
+
+def flush_pending_saves() -> int:
+    global _write_behind_dirty, _write_behind_pending
+    with _write_behind_lock:
+        batch = _write_behind_dirty
+        _write_behind_dirty = {}
+        _write_behind_pending = 0
+    for path, producer in batch.items():
+        try:
+            with timed("state_flush_seconds", file=os.path.basename(path)):
+                safe_save_json(path, producer())
+        except Exception as e:
+            logger.error(f"Write-behind flush failed for {path}: {e}")
+            with _write_behind_lock:
+                _write_behind_dirty.setdefault(path, producer)
+    return len(batch)
+
+def _write_behind_worker() -> None:
+    while True:
+        _write_behind_wakeup.wait(WRITE_BEHIND_INTERVAL)
+        _write_behind_wakeup.clear()
+        try:
+            flush_pending_saves()
+        except Exception as e:
+            logger.error(f"Write-behind worker error: {e}")
+
+def _start_write_behind_once() -> None:
+    global _write_behind_started
+    if _write_behind_started:
+        return
+    with _write_behind_lock:
+        if _write_behind_started:
+            return
+        _write_behind_started = True
+    threading.Thread(target=_write_behind_worker, name="write-behind", daemon=True).start()
+
+def _install_shutdown_flush() -> None:
+    atexit.register(flush_pending_saves)
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            flush_pending_saves()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:
+        # Not the main thread; atexit still covers a clean shutdown
+        pass
+
+_install_shutdown_flush()
+
+# -----------------------
+# State Backends
+# -----------------------
+# Bans, strikes, swear counts, former members, mutes and the karma cache are
+# StateMaps: dict-like objects that persist every write themselves. The JSON
+# backend keeps the map in memory and rewrites its file through the
+# write-behind flusher; the SQLite backend upserts one row per change and
+# reads through, so several gunicorn workers see the same state.
+class JsonStateMap(MutableMapping):
+    def __init__(self, name: str, file_path: str):
+        self.name = name
+        self.file_path = file_path
+        self._lock = Lock()
+        raw = load_json(file_path) or {}
+        self._data: Dict[str, Any] = {str(k): v for k, v in raw.items()} if isinstance(raw, dict) else {}
+        self._generation = 0
+
+    def _changed(self) -> None:
+        self._generation += 1
+        schedule_save(self.file_path, self.snapshot)
+
+    def generation(self):
+        """Changes whenever the map is written, for caches derived from it."""
+        return self._generation
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._data)
+
+    def __getitem__(self, key):
+        return self._data[str(key)]
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            self._data[str(key)] = value
+        self._changed()
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            del self._data[str(key)]
+        self._changed()
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(str(key), default)
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+        self._changed()
+
+    def incr(self, key, delta: int = 1) -> int:
+        with self._lock:
+            value = int(self._data.get(str(key), 0) or 0) + delta
+            self._data[str(key)] = value
+        self._changed()
+        return value
+
+    def replace_all(self, data: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data = {str(k): v for k, v in data.items()}
+        self._changed()
+
+_sqlite_local = threading.local()
+_sqlite_schema_lock = Lock()
+_sqlite_schema_ready = False
+
+def _sqlite_conn() -> sqlite3.Connection:
+    """One connection per thread; autocommit unless a BEGIN is issued."""
+    global _sqlite_schema_ready
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    with _sqlite_schema_lock:
+        if not _sqlite_schema_ready:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS state (
+                    ns TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (ns, key)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS state_ns_updated ON state (ns, updated_at);
+                CREATE TABLE IF NOT EXISTS migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_at REAL NOT NULL
+                );
+            """)
+            _sqlite_schema_ready = True
+    _sqlite_local.conn = conn
+    return conn
+
+class SqliteStateMap(MutableMapping):
+    UPSERT = ("INSERT INTO state (ns, key, value, updated_at) VALUES (?, ?, ?, ?) "
+              "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at")
+
+    def __init__(self, name: str, file_path: Optional[str] = None):
+        self.name = name
+        self.file_path = file_path
+        if file_path:
+            self._import_json(file_path)
+
+    def _import_json(self, file_path: str) -> None:
+        # One-time migration; rows already in the DB win over the file
+        conn = _sqlite_conn()
+        migration = f"import:{self.name}:{file_path}"
+        if conn.execute("SELECT 1 FROM migrations WHERE name = ?", (migration,)).fetchone():
+            return
+        raw = load_json(file_path) or {}
+        now = time.time()
+        rows = [(self.name, str(k), json.dumps(v, ensure_ascii=False), now) for k, v in raw.items()] if isinstance(raw, dict) else []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO state (ns, key, value, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT (ns, key) DO NOTHING", rows)
+            conn.execute("INSERT OR IGNORE INTO migrations (name, applied_at) VALUES (?, ?)", (migration, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if rows:
+            logger.info(f"Imported {len(rows)} {self.name} entries from {file_path} into SQLite")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def generation(self):
+        """Changes whenever the map is written, by this worker or another one."""
+        return _sqlite_conn().execute(
+            "SELECT COUNT(*), MAX(updated_at) FROM state WHERE ns = ?", (self.name,)).fetchone()
+
+    def __getitem__(self, key):
+        row = _sqlite_conn().execute("SELECT value FROM state WHERE ns = ? AND key = ?", (self.name, str(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value) -> None:
+        _sqlite_conn().execute(self.UPSERT, (self.name, str(key), json.dumps(value, ensure_ascii=False), time.time()))
+
+    def __delitem__(self, key) -> None:
+        cur = _sqlite_conn().execute("DELETE FROM state WHERE ns = ? AND key = ?", (self.name, str(key)))
+        if cur.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return _sqlite_conn().execute("SELECT 1 FROM state WHERE ns = ? AND key = ?", (self.name, str(key))).fetchone() is not None
+
+    def __iter__(self):
+        rows = _sqlite_conn().execute("SELECT key FROM state WHERE ns = ?", (self.name,)).fetchall()
+        return iter([r[0] for r in rows])
+
+    def __len__(self) -> int:
+        return _sqlite_conn().execute("SELECT COUNT(*) FROM state WHERE ns = ?", (self.name,)).fetchone()[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        rows = _sqlite_conn().execute("SELECT key, value FROM state WHERE ns = ?", (self.name,)).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def clear(self) -> None:
+        _sqlite_conn().execute("DELETE FROM state WHERE ns = ?", (self.name,))
+
+    def incr(self, key, delta: int = 1) -> int:
+        row = _sqlite_conn().execute(
+            "INSERT INTO state (ns, key, value, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (ns, key) DO UPDATE SET value = CAST(value AS INTEGER) + ?, updated_at = excluded.updated_at "
+            "RETURNING value",
+            (self.name, str(key), str(delta), time.time(), delta),
+        ).fetchone()
+        return int(row[0])
+
+    def replace_all(self, data: Dict[str, Any]) -> None:
+        conn = _sqlite_conn()
+        now = time.time()
+        current = dict(conn.execute("SELECT key, value FROM state WHERE ns = ?", (self.name,)).fetchall())
+        wanted = {str(k): json.dumps(v, ensure_ascii=False) for k, v in data.items()}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(self.UPSERT, [(self.name, k, v, now) for k, v in wanted.items() if current.get(k) != v])
+            conn.executemany("DELETE FROM state WHERE ns = ? AND key = ?", [(self.name, k) for k in current if k not in wanted])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def open_state_map(name: str, file_path: str):
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateMap(name, file_path)
+    if STATE_BACKEND != "json":
+        logger.warning(f"Unknown STATE_BACKEND '{STATE_BACKEND}', using json")
+    return JsonStateMap(name, file_path)
+
+# -----------------------
+# Group Tenancy
+# -----------------------
+# One process can serve many groups. Each group is a GroupConfig (group id,
+# bot id, admins, karma bin, outbound budget) listed in GROUPS_FILE; with no
+# file the GROUP_ID / BOT_ID / ADMIN_IDS environment is the only group and
+# every payload is routed to it, as before. webhook() makes the payload's
+# group the current group for the request and for every job it dispatches.
+# Per-group state lives in GroupLocal objects, created on a group's first
+# use. The first group keeps the original files, state namespaces and
+# shared_state keys, so a single-group deployment's data carries over.
+GROUPS_FILE = os.getenv("GROUPS_FILE", "groups.json")
+GROUP_STATE_DIR = os.getenv("GROUP_STATE_DIR", "groups")
+GROUP_OUTBOUND_PER_MINUTE = int(os.getenv("GROUP_OUTBOUND_PER_MINUTE", "120"))
+GROUP_OUTBOUND_BURST = int(os.getenv("GROUP_OUTBOUND_BURST", "30"))
+
+class GroupConfig(NamedTuple):
+    group_id: str
+    bot_id: Optional[str]
+    admin_ids: frozenset
+    name: str = ""
+    jsonbin_bin_id: Optional[str] = None
+    outbound_per_minute: int = GROUP_OUTBOUND_PER_MINUTE  # 0 = no budget
+    outbound_burst: int = GROUP_OUTBOUND_BURST
+
+def load_group_configs() -> "OrderedDict[str, GroupConfig]":
+    """Groups listed in GROUPS_FILE, as {"groups": [...]} or a bare list."""
+    raw = load_json(GROUPS_FILE)
+    entries = raw.get("groups", []) if isinstance(raw, dict) else raw
+    groups: "OrderedDict[str, GroupConfig]" = OrderedDict()
+    for entry in entries or []:
+        if not isinstance(entry, dict) or not entry.get("group_id") or not entry.get("bot_id"):
+            logger.warning(f"Skipping group entry without group_id/bot_id in {GROUPS_FILE}: {entry}")
+            continue
+        group = GroupConfig(
+            group_id=str(entry["group_id"]),
+            bot_id=str(entry["bot_id"]),
+            admin_ids=frozenset(str(a) for a in entry.get("admin_ids", ADMIN_IDS)),
+            name=entry.get("name", ""),
+            jsonbin_bin_id=entry.get("jsonbin_bin_id"),
+            outbound_per_minute=int(entry.get("outbound_per_minute", GROUP_OUTBOUND_PER_MINUTE)),
+            outbound_burst=int(entry.get("outbound_burst", GROUP_OUTBOUND_BURST)),
+        )
+        groups[group.group_id] = group
+    if groups:
+        logger.info(f"Serving {len(groups)} group(s) from {GROUPS_FILE}")
+    return groups
+
+GROUPS = load_group_configs()
+# Only a configured group list makes routing strict (unknown groups ignored)
+# and sets outbound budgets; a lone env group has nobody to share workers with
+MULTI_GROUP = bool(GROUPS)
+if not GROUPS:
+    GROUPS[str(GROUP_ID or "")] = GroupConfig(str(GROUP_ID or ""), BOT_ID, frozenset(ADMIN_IDS),
+                                              jsonbin_bin_id=JSONBIN_BIN_ID, outbound_per_minute=0)
+DEFAULT_GROUP = next(iter(GROUPS.values()))
+
+_current_group: ContextVar[GroupConfig] = ContextVar("current_group", default=DEFAULT_GROUP)
+
+def current_group() -> GroupConfig:
+    return _current_group.get()
+
+@contextmanager
+def use_group(group: GroupConfig):
+    token = _current_group.set(group)
+    try:
+        yield group
+    finally:
+        _current_group.reset(token)
+
+def group_for_payload(data: Optional[Dict[str, Any]]) -> Optional[GroupConfig]:
+    """The group a callback belongs to; None for a group this deployment doesn't serve."""
+    group_id = str((data or {}).get("group_id") or "")
+    if not group_id:
+        return DEFAULT_GROUP  # DMs
+    group = GROUPS.get(group_id)
+    if group is None and not MULTI_GROUP:
+        return DEFAULT_GROUP
+    return group
+
+def is_group_admin(user_id) -> bool:
+    return str(user_id) in current_group().admin_ids
+
+def bind_group(func):
+    """func, pinned to the current group so it can run on another thread."""
+    group = current_group()
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        with use_group(group):
+            return func(*args, **kwargs)
+    return bound
+
+def group_scoped(key: str, group: Optional[GroupConfig] = None) -> str:
+    """State namespace / shared_state key for a group; the default group keeps the bare key."""
+    group = group or current_group()
+    return key if group.group_id == DEFAULT_GROUP.group_id else f"{group.group_id}:{key}"
+
+def group_file(file_path: str, group: Optional[GroupConfig] = None) -> str:
+    group = group or current_group()
+    if group.group_id == DEFAULT_GROUP.group_id:
+        return file_path
+    directory = os.path.join(GROUP_STATE_DIR, group.group_id)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, file_path)
+
+class GroupLocal:
+    """One factory(group) instance per group; attribute access goes to the current group's."""
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    def for_group(self, group: Optional[GroupConfig] = None):
+        group = group or current_group()
+        instance = self._instances.get(group.group_id)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(group.group_id)
+                if instance is None:
+                    instance = self._instances[group.group_id] = self._factory(group)
+        return instance
+
+    def instances(self) -> List[Tuple[GroupConfig, Any]]:
+        with self._lock:
+            return [(GROUPS.get(gid, DEFAULT_GROUP), inst) for gid, inst in self._instances.items()]
+
+    def __getattr__(self, name):
+        return getattr(self.for_group(), name)
+
+    def __len__(self) -> int:
+        return len(self.for_group())
+
+class GroupStateMap(GroupLocal, MutableMapping):
+    """A StateMap per group behind one module-level name."""
+    def __getitem__(self, key):
+        return self.for_group()[key]
+
+    def __setitem__(self, key, value) -> None:
+        self.for_group()[key] = value
+
+    def __delitem__(self, key) -> None:
+        del self.for_group()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.for_group()
+
+    def __iter__(self):
+        return iter(self.for_group())
+
+    def get(self, key, default=None):
+        return self.for_group().get(key, default)
+
+    def items(self):
+        return self.for_group().items()
+
+    def clear(self) -> None:
+        self.for_group().clear()
+
+    def generation(self):
+        return self.for_group().generation()
+
+def open_group_state_map(name: str, file_path: str) -> GroupStateMap:
+    return GroupStateMap(lambda group: open_state_map(group_scoped(name, group), group_file(file_path, group)))
+
+def take_outbound_budget(group: Optional[GroupConfig] = None) -> bool:
+    """Token bucket per group, shared across workers: False once the group is over its budget."""
+    group = group or current_group()
+    if group.outbound_per_minute <= 0:
+        return True
+    now = time.time()
+    rate = group.outbound_per_minute / 60.0
+    granted = {"ok": False}
+
+    def take(bucket):
+        tokens, last = bucket or (group.outbound_burst, now)
+        tokens = min(float(group.outbound_burst), tokens + (now - last) * rate)
+        granted["ok"] = tokens >= 1
+        return [tokens - 1 if granted["ok"] else tokens, now]
+
+    shared_state.update(group_scoped("budget:outbound", group), take, ex=group.outbound_burst / rate + 1)
+    return granted["ok"]
+
+# -----------------------
+# Shared State
+# -----------------------
+# Short-lived cross-worker state (post cooldowns, spam windows, once-a-day
+# jobs) behind a small Redis-style interface. "memory" is per-process and
+# doubles as the fake for tests; "sqlite" shares STATE_DB_PATH between
+# gunicorn workers on one host; "redis" shares across hosts.
+class InProcessSharedState:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._ops = 0
+
+    def _live(self, key: str, now: float):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and now >= expires_at:
+            del self._data[key]
+            return None
+        return item
+
+    def _purge(self, now: float) -> None:
+        self._ops += 1
+        if self._ops % 1000 == 0:
+            for key in [k for k, (_, exp) in self._data.items() if exp is not None and now >= exp]:
+                del self._data[key]
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._live(key, time.time())
+            return default if item is None else item[0]
+
+    def set(self, key: str, value, ex: Optional[float] = None, nx: bool = False) -> bool:
+        with self._lock:
+            now = time.time()
+            self._purge(now)
+            if nx and self._live(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ex if ex else None)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1, ex: Optional[float] = None) -> int:
+        return self.update(key, lambda old: int(old or 0) + amount, ex=ex)
+
+    def update(self, key: str, func, ex: Optional[float] = None):
+        """Atomically replace key with func(current value or None); returns the new value."""
+        with self._lock:
+            now = time.time()
+            self._purge(now)
+            item = self._live(key, now)
+            value = func(None if item is None else item[0])
+            self._data[key] = (value, now + ex if ex else None)
+            return value
+
+class SqliteSharedState:
+    def __init__(self):
+        conn = _sqlite_conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS shared_kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS shared_kv_expires ON shared_kv (expires_at)")
+        self._ops = 0
+
+    def _purge(self, conn: sqlite3.Connection, now: float) -> None:
+        self._ops += 1
+        if self._ops % 1000 == 0:
+            conn.execute("DELETE FROM shared_kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def get(self, key: str, default=None):
+        row = _sqlite_conn().execute(
+            "SELECT value FROM shared_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key: str, value, ex: Optional[float] = None, nx: bool = False) -> bool:
+        conn = _sqlite_conn()
+        now = time.time()
+        expires_at = now + ex if ex else None
+        if nx:
+            # Take over the key only if it is missing or expired
+            cur = conn.execute(
+                "INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE shared_kv.expires_at IS NOT NULL AND shared_kv.expires_at <= ?",
+                (key, json.dumps(value), expires_at, now),
+            )
+            return cur.rowcount == 1
+        conn.execute(
+            "INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, json.dumps(value), expires_at),
+        )
+        self._purge(conn, now)
+        return True
+
+    def delete(self, key: str) -> None:
+        _sqlite_conn().execute("DELETE FROM shared_kv WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1, ex: Optional[float] = None) -> int:
+        return self.update(key, lambda old: int(old or 0) + amount, ex=ex)
+
+    def update(self, key: str, func, ex: Optional[float] = None):
+        conn = _sqlite_conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM shared_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, now)
+            ).fetchone()
+            value = func(None if row is None else json.loads(row[0]))
+            conn.execute(
+                "INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, json.dumps(value), now + ex if ex else None),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._purge(conn, now)
+        return value
+
+class RedisSharedState:
+    def __init__(self, url: str):
+        import redis  # optional dependency, only needed for SHARED_STATE=redis
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+
+    def get(self, key: str, default=None):
+        raw = self._redis.get(key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key: str, value, ex: Optional[float] = None, nx: bool = False) -> bool:
+        px = int(ex * 1000) if ex else None
+        return bool(self._redis.set(key, json.dumps(value), px=px, nx=nx))
+
+    def delete(self, key: str) -> None:
+        self._redis.delete(key)
+
+    def incr(self, key: str, amount: int = 1, ex: Optional[float] = None) -> int:
+        return self.update(key, lambda old: int(old or 0) + amount, ex=ex)
+
+    def update(self, key: str, func, ex: Optional[float] = None):
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    value = func(None if raw is None else json.loads(raw))
+                    pipe.multi()
+                    pipe.set(key, json.dumps(value), px=int(ex * 1000) if ex else None)
+                    pipe.execute()
+                    return value
+                except self._watch_error:
+                    continue
+
+def open_shared_state():
+    try:
+        if SHARED_STATE == "sqlite":
+            return SqliteSharedState()
+        if SHARED_STATE == "redis":
+            if not REDIS_URL:
+                raise ValueError("REDIS_URL is not set")
+            return RedisSharedState(REDIS_URL)
+    except Exception as e:
+        logger.error(f"Shared state '{SHARED_STATE}' unavailable ({e}); falling back to in-process state")
+    return InProcessSharedState()
+
+shared_state = open_shared_state()
+
+# A send cooldown starts only once the send succeeds. While the send is in
+# flight a short claim keeps other workers and threads from racing it.
+SEND_CLAIM_SECONDS = 30
+
+def claim_cooldown_send(name: str, seconds: float, on_done=None):
+    """
+    The on_done for a send that `name`'s cooldown covers, or None while the
+    cooldown runs or another send under it is in flight. The callback starts
+    the `seconds` cooldown on success and releases the claim either way;
+    pass it None (not False) if the send was never queued.
+    """
+    cooldown_key = group_scoped(f"cooldown:{name}")
+    claim_key = group_scoped(f"sending:{name}")
+    if shared_state.get(cooldown_key) is not None:
+        return None
+    if not shared_state.set(claim_key, time.time(), ex=SEND_CLAIM_SECONDS, nx=True):
+        return None
+
+    def finished(success: Optional[bool]) -> None:
+        if success:
+            shared_state.set(cooldown_key, time.time(), ex=seconds)
+        shared_state.delete(claim_key)
+        if on_done and success is not None:
+            on_done(success)
+    return finished
+
+def _check_worker_config() -> None:
+    workers = int(os.getenv("WEB_CONCURRENCY", "1") or 1)
+    if workers > 1 and (STATE_BACKEND != "sqlite" or isinstance(shared_state, InProcessSharedState)):
+        logger.warning(
+            f"WEB_CONCURRENCY={workers} but state is per-process; "
+            "set STATE_BACKEND=sqlite and SHARED_STATE=sqlite or redis to share mutes, cooldowns and spam windows"
+        )
+
 def load_system_messages_enabled() -> bool:
-    data = load_json(system_messages_enabled_file)
-    return bool(data.get("enabled", True))
+    return bool(settings.get("enabled", True))
 
 def save_system_messages_enabled(enabled: bool) -> None:
-    save_json(system_messages_enabled_file, {"enabled": enabled})
+    settings["enabled"] = enabled
 
 # Initialize
-system_messages_enabled = load_system_messages_enabled()
-banned_users = load_json(banned_users_file) or {}
-user_swear_counts = load_json(user_swear_counts_file) or {}
-former_members = load_json(former_members_file) or {}
-user_strikes = load_json(strikes_file) or {}
+_check_worker_config()
+settings = open_group_state_map("settings", system_messages_enabled_file)
+banned_users = open_group_state_map("banned_users", banned_users_file)
+user_swear_counts = open_group_state_map("user_swear_counts", user_swear_counts_file)
+former_members = open_group_state_map("former_members", former_members_file)
+user_strikes = open_group_state_map("user_strikes", strikes_file)
+muted_users = open_group_state_map("muted_users", muted_users_file)
 
 def get_factorial_response(text: str) -> Optional[str]:
     # Regex: Matches a number followed by ! (e.g., 500!) 
@@ -173,77 +1108,820 @@ def get_factorial_response(text: str) -> Optional[str]:
         return f"{n}! is effectively infinity for my hardware."
 
 # -----------------------
-# Daily Tracking Init
+# Webhook Deduplication
 # -----------------------
-def _initialize_daily_tracking():
-    global daily_message_counts, last_message_by_user, daily_counts_date, last_messages_date
-    today = datetime.now().strftime("%Y-%m-%d")
-    raw = load_json(daily_counts_file)
-    if isinstance(raw, dict) and raw.get("date") == today and isinstance(raw.get("counts"), dict):
-        daily_message_counts = {str(k): int(v) for k, v in raw.get("counts", {}).items()}
-        daily_counts_date = today
-        logger.info(f"Loaded daily_message_counts for {today} ({len(daily_message_counts)} users).")
-    else:
-        daily_message_counts = {}
-        daily_counts_date = today
-        save_json(daily_counts_file, {"date": today, "counts": daily_message_counts})
-        logger.info("Initialized new daily_message_counts for today.")
-    raw2 = load_json(last_messages_file)
-    if isinstance(raw2, dict) and raw2.get("date") == today and isinstance(raw2.get("last"), dict):
-        last_message_by_user = {str(k): v for k, v in raw2.get("last", {}).items()}
-        last_messages_date = today
-        logger.info(f"Loaded last_message_by_user for {today} ({len(last_message_by_user)} users).")
+# GroupMe redelivers a callback when /webhook is slow or fails, so every
+# message id is claimed once before any processing. The local set is an
+# OrderedDict in arrival order (= expiry order, the TTL is fixed), so expiry
+# and eviction only ever pop from the front. With a shared SHARED_STATE the
+# claim is also a set-nx there, which catches redeliveries that land on
+# another worker and survives restarts; in memory mode the set is saved to
+# seen_messages.json through the write-behind flusher instead. A delivery
+# that fails keeps its claim and is acknowledged with a 200: swear counts,
+# daily counts and queued deletes may already have been applied, and a
+# retry would apply them twice.
+SEEN_MESSAGES_TTL = float(os.getenv("SEEN_MESSAGES_TTL", "3600"))
+SEEN_MESSAGES_MAX = int(os.getenv("SEEN_MESSAGES_MAX", "20000"))
+
+_seen_lock = Lock()
+_seen_messages: "OrderedDict[str, float]" = OrderedDict()
+
+def _load_seen_messages() -> None:
+    now = time.time()
+    saved = load_json(seen_messages_file)
+    live = sorted(((float(exp), mid) for mid, exp in saved.items() if float(exp) > now))[-SEEN_MESSAGES_MAX:]
+    with _seen_lock:
+        for expires_at, mid in live:
+            _seen_messages[mid] = expires_at
+
+def _seen_snapshot() -> Dict[str, float]:
+    with _seen_lock:
+        return dict(_seen_messages)
+
+def first_delivery(message_id) -> bool:
+    """Claim message_id; False if it was already seen within SEEN_MESSAGES_TTL."""
+    key = str(message_id)
+    now = time.time()
+    with _seen_lock:
+        while _seen_messages:
+            oldest = next(iter(_seen_messages))
+            if _seen_messages[oldest] > now and len(_seen_messages) < SEEN_MESSAGES_MAX:
+                break
+            _seen_messages.popitem(last=False)
+        if key in _seen_messages:
+            return False
+        _seen_messages[key] = now + SEEN_MESSAGES_TTL
+    if isinstance(shared_state, InProcessSharedState):
+        schedule_save(seen_messages_file, _seen_snapshot)
+        return True
+    return shared_state.set(f"seen:{key}", 1, ex=SEEN_MESSAGES_TTL, nx=True)
+
+_load_seen_messages()
+
+# -----------------------
+# Spam Detection
+# -----------------------
+# Each user has a fixed-size ring of (time, content hash, length) slots in
+# shared_state. A message is one read-modify-write of that bounded record and
+# every rule is checked in the same pass over the ring. The record expires
+# once the user has been quiet for longer than the widest rule window, so
+# idle users cost nothing.
+class SpamRule(NamedTuple):
+    name: str
+    kind: str  # "identical" (same content), "rate" (any message) or "flood" (total characters)
+    limit: int
+    window: float
+    mute_minutes: int
+    reason: str
+
+SPAM_RULES = [
+    SpamRule("identical", "identical", SPAM_IDENTICAL_LIMIT, 10, 2,
+             f"sent {SPAM_IDENTICAL_LIMIT} identical messages in 10 seconds"),
+    SpamRule("rate", "rate", SPAM_RATE_LIMIT, 10, 2,
+             f"sent {SPAM_RATE_LIMIT} messages in 10 seconds"),
+    SpamRule("flood", "flood", SPAM_FLOOD_CHARS, 15, 2,
+             f"sent over {SPAM_FLOOD_CHARS:,} characters in 15 seconds"),
+]
+# Enough slots for the largest message-count rule; anyone flooding more
+# messages than that inside a window has already tripped the rate rule.
+SPAM_RING_SIZE = max(rule.limit for rule in SPAM_RULES if rule.kind != "flood")
+SPAM_WINDOW = max(rule.window for rule in SPAM_RULES)
+
+def spam_fingerprint(text: str) -> str:
+    """Short hash of the message with case, spacing, punctuation and stretched letters folded away."""
+    norm = re.sub(r"(.)\1+", r"\1", re.sub(r"[\W_]+", "", text.lower())) or text.strip()
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=8).hexdigest()
+
+def _empty_spam_ring() -> Dict[str, Any]:
+    return {"i": 0, "t": [0.0] * SPAM_RING_SIZE, "h": [""] * SPAM_RING_SIZE, "n": [0] * SPAM_RING_SIZE}
+
+def _evaluate_spam_rules(ring: Dict[str, Any], now: float, fingerprint: str) -> Optional[SpamRule]:
+    totals = [0] * len(SPAM_RULES)
+    for sent_at, digest, length in zip(ring["t"], ring["h"], ring["n"]):
+        age = now - sent_at
+        for idx, rule in enumerate(SPAM_RULES):
+            if age >= rule.window:
+                continue
+            if rule.kind == "flood":
+                totals[idx] += length
+            elif rule.kind == "rate" or digest == fingerprint:
+                totals[idx] += 1
+    for idx, rule in enumerate(SPAM_RULES):
+        if totals[idx] >= rule.limit:
+            return rule
+    return None
+
+def check_spam(user_id: str, text: str) -> Optional[SpamRule]:
+    """Record a message and return the first spam rule it trips, if any."""
+    now = time.time()
+    fingerprint = spam_fingerprint(text)
+    hit: Dict[str, Optional[SpamRule]] = {"rule": None}
+
+    def record(ring):
+        if not ring or len(ring.get("t", ())) != SPAM_RING_SIZE:
+            ring = _empty_spam_ring()
+        slot = ring["i"]
+        ring["t"][slot], ring["h"][slot], ring["n"][slot] = now, fingerprint, len(text)
+        ring["i"] = (slot + 1) % SPAM_RING_SIZE
+        # Assigned on every call: Redis may retry this function
+        hit["rule"] = _evaluate_spam_rules(ring, now, fingerprint)
+        # Start over after a hit so the next message doesn't re-trigger
+        return _empty_spam_ring() if hit["rule"] else ring
+
+    shared_state.update(group_scoped(f"spam:{user_id}"), record, ex=SPAM_WINDOW)
+    return hit["rule"]
+
+# -----------------------
+# Mute Scheduler
+# -----------------------
+# muted_users maps user id -> unmute timestamp and is the persisted source of
+# truth. A min-heap of (deadline, uid) lets expiry pop only what is due
+# instead of scanning every mute on every message; entries whose deadline no
+# longer matches the store (re-muted, unmuted) are skipped when popped.
+# !muteall is one GROUP_MUTE_KEY record rather than one entry per member.
+GROUP_MUTE_KEY = "*"
+
+class MuteScheduler:
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[float, str]] = []
+        # uid -> deadline for the heap entries still in force; the heap also
+        # holds superseded and lifted entries until they surface or get compacted
+        self._live: Dict[str, float] = {}
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """Reload the heap from the store, dropping anything already expired."""
+        now = time.time()
+        with self._lock:
+            live = []
+            for uid, until in list(self._store.items()):
+                if now >= float(until):
+                    del self._store[uid]
+                else:
+                    live.append((float(until), uid))
+            heapq.heapify(live)
+            self._heap = live
+            self._live = {uid: until for until, uid in live}
+
+    def _compact(self) -> None:
+        # Caller holds the lock; keeps the heap within a constant factor of the live mutes
+        if len(self._heap) > 2 * len(self._live) + 64:
+            self._heap = [(until, uid) for uid, until in self._live.items()]
+            heapq.heapify(self._heap)
+
+    def _schedule(self, uid: str, seconds: float) -> float:
+        return self._schedule_at(uid, time.time() + seconds)
+
+    def _schedule_at(self, uid: str, until: float) -> float:
+        with self._lock:
+            self._store[uid] = until
+            self._live[uid] = until
+            heapq.heappush(self._heap, (until, uid))
+            self._compact()
+        return until
+
+    def mute(self, uid: str, seconds: float) -> float:
+        return self._schedule(str(uid), seconds)
+
+    def mute_all(self, seconds: float) -> float:
+        return self._schedule(GROUP_MUTE_KEY, seconds)
+
+    def mute_all_until(self, until: float) -> float:
+        return self._schedule_at(GROUP_MUTE_KEY, until)
+
+    def unmute(self, uid: str) -> bool:
+        with self._lock:
+            self._live.pop(str(uid), None)
+            self._compact()
+            return self._store.pop(str(uid), None) is not None
+
+    def unmute_all(self) -> Tuple[int, bool]:
+        """Clear every mute. Returns (individual mutes cleared, whether a group mute was lifted)."""
+        now = time.time()
+        with self._lock:
+            group = self._store.pop(GROUP_MUTE_KEY, None)
+            total = len(self._store)
+            self._store.clear()
+            self._heap = []
+            self._live = {}
+        return total, group is not None and now < float(group)
+
+    def group_mute_until(self, now: Optional[float] = None) -> Optional[float]:
+        """Deadline of the group-wide mute, or None if none is in force."""
+        until = self._store.get(GROUP_MUTE_KEY)
+        if until is None or float(until) <= (now or time.time()):
+            return None
+        return float(until)
+
+    def remaining(self, uid: str, now: Optional[float] = None) -> float:
+        """Seconds left on the user's mute (0 if not muted). Admins ignore group mutes."""
+        now = now or time.time()
+        left = float(self._store.get(str(uid), 0)) - now
+        if not is_group_admin(uid):
+            left = max(left, float(self._store.get(GROUP_MUTE_KEY, 0)) - now)
+        return max(left, 0.0)
+
+    def expire_due(self, now: Optional[float] = None) -> int:
+        """Drop mutes whose deadline has passed; O(log n) per expired mute."""
+        now = now or time.time()
+        expired = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                until, uid = heapq.heappop(self._heap)
+                if self._live.get(uid) == until:
+                    del self._live[uid]
+                current = self._store.get(uid)
+                if current is not None and float(current) == until:
+                    del self._store[uid]
+                    expired += 1
+        if expired:
+            logger.info(f"Cleaned {expired} expired mutes")
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+mute_scheduler = GroupLocal(lambda group: MuteScheduler(muted_users.for_group(group)))
+
+def _non_admin_member_count() -> int:
+    return sum(1 for m in get_group_members() if not is_group_admin(m.get("user_id")))
+
+# -----------------------
+# Raid Detection
+# -----------------------
+# Join and leave system events feed two bucketed sliding-window counters kept
+# in one shared_state record, so every worker sees the same rates and an
+# event costs a fixed number of bucket updates. A burst of joins (or joins
+# and leaves churning together) triggers a lockdown: a group-wide mute plus
+# a ban on links from non-admins, recorded once in shared_state with a TTL.
+# The lockdown only lifts the group mute it set itself, so an admin's
+# !muteall running underneath survives !unlock.
+RAID_BUCKETS = 12
+MEMBER_JOIN_PHRASES = ('has joined the group', 'was added to the group')
+MEMBER_LEAVE_PHRASES = ('has left the group', 'was removed from the group')
+# "Alice added Bob to the group." / "Alice removed Bob from the group."
+MEMBER_ADDED_RE = re.compile(r'\badded .+ to the group')
+MEMBER_REMOVED_RE = re.compile(r'\bremoved .+ from the group')
+LOCKDOWN_LINK_RE = re.compile(r'https?://|www\.', re.IGNORECASE)
+
+def classify_member_event(text_lower: str) -> Optional[str]:
+    if any(p in text_lower for p in MEMBER_JOIN_PHRASES) or MEMBER_ADDED_RE.search(text_lower):
+        return "join"
+    if any(p in text_lower for p in MEMBER_LEAVE_PHRASES) or MEMBER_REMOVED_RE.search(text_lower):
+        return "leave"
+    return None
+
+def _advance_window(counter: Dict[str, Any], slot: int) -> None:
+    """Zero the buckets that slid out of the window since counter["slot"]."""
+    gap = slot - counter["slot"]
+    if gap <= 0:
+        return
+    if gap >= RAID_BUCKETS:
+        counter["b"] = [0] * RAID_BUCKETS
+        counter["n"] = 0
     else:
-        last_message_by_user = {}
-        last_messages_date = today
-        save_json(last_messages_file, {"date": today, "last": last_message_by_user})
-        logger.info("Initialized new last_message_by_user for today.")
+        for s in range(counter["slot"] + 1, slot + 1):
+            counter["n"] -= counter["b"][s % RAID_BUCKETS]
+            counter["b"][s % RAID_BUCKETS] = 0
+    counter["slot"] = slot
+
+def _check_raid_rules(joins: int, leaves: int) -> Optional[str]:
+    if joins >= RAID_JOIN_LIMIT:
+        return f"{joins} joins in {RAID_WINDOW_SECONDS:g}s"
+    half = max(1, RAID_JOIN_LIMIT // 2)
+    if joins >= half and leaves >= half:
+        return f"join/leave churn ({joins} joins, {leaves} leaves in {RAID_WINDOW_SECONDS:g}s)"
+    return None
+
+def record_member_event(kind: str, now: Optional[float] = None) -> Optional[str]:
+    """Count a join/leave; returns the raid reason if this event crosses a threshold."""
+    now = now or time.time()
+    slot = int(now // (RAID_WINDOW_SECONDS / RAID_BUCKETS))
+    hit: Dict[str, Optional[str]] = {"reason": None}
+
+    def record(rates):
+        if not rates:
+            rates = {k: {"slot": slot, "b": [0] * RAID_BUCKETS, "n": 0} for k in ("join", "leave")}
+        for counter in rates.values():
+            _advance_window(counter, slot)
+        rates[kind]["b"][slot % RAID_BUCKETS] += 1
+        rates[kind]["n"] += 1
+        hit["reason"] = _check_raid_rules(rates["join"]["n"], rates["leave"]["n"])
+        return rates
+
+    shared_state.update(group_scoped("raid:rates"), record, ex=RAID_WINDOW_SECONDS)
+    return hit["reason"]
+
+def lockdown_status() -> Optional[Dict[str, Any]]:
+    return shared_state.get(group_scoped("raid:lockdown"))
+
+def start_lockdown(reason: str, mute_minutes: int = RAID_MUTE_MINUTES,
+                   lockdown_minutes: int = RAID_LOCKDOWN_MINUTES, by: Optional[str] = None) -> bool:
+    """Group-wide mute plus link blocking. False if a lockdown is already running."""
+    now = time.time()
+    prior_mute = mute_scheduler.group_mute_until(now)
+    # A longer group mute already in force is left alone and not recorded as ours
+    mute_until = now + mute_minutes * 60 if prior_mute is None or prior_mute < now + mute_minutes * 60 else None
+    record = {"reason": reason, "started": now, "until": now + lockdown_minutes * 60, "by": by,
+              "mute_until": mute_until, "prior_mute": prior_mute}
+    if not shared_state.set(group_scoped("raid:lockdown"), record, ex=lockdown_minutes * 60, nx=True):
+        return False
+    if mute_until is not None:
+        mute_scheduler.mute_all_until(mute_until)
+    logger.warning(f"LOCKDOWN: {reason} (mute {mute_minutes}m, links {lockdown_minutes}m, by {by or 'auto'})")
+    send_system_message(
+        f"**LOCKDOWN** – {reason}.\nEveryone except admins is muted for {mute_minutes} minute(s) "
+        f"and links are blocked for {lockdown_minutes} minute(s). Admins: !unlock to lift.",
+        urgent=True,
+    )
+    return True
+
+def end_lockdown() -> bool:
+    status = lockdown_status()
+    shared_state.delete(group_scoped("raid:lockdown"))
+    if status is None:
+        return False
+    now = time.time()
+    # Only undo the lockdown's own group mute; one set since (!muteall) stays
+    if status.get("mute_until") is not None and mute_scheduler.group_mute_until(now) == status["mute_until"]:
+        prior = status.get("prior_mute")
+        if prior is not None and prior > now:
+            mute_scheduler.mute_all(prior - now)
+        else:
+            mute_scheduler.unmute(GROUP_MUTE_KEY)
+    return True
+
+def handle_member_event(kind: str) -> None:
+    reason = record_member_event(kind)
+    if reason and RAID_AUTO_LOCKDOWN:
+        start_lockdown(f"Raid detected: {reason}")
+
+# -----------------------
+# Ranking Indexes
+# -----------------------
+# The leaderboard reads its top entries straight off sorted indexes that are
+# updated as messages and votes land, instead of re-sorting every count and
+# karma record on each post. The order lives in a sortedcontainers
+# SortedList, so an update is O(log n).
+
+class TopIndex:
+    """uid -> rank key, kept in ascending key order (ties by uid); top(k) is O(k)."""
+    def __init__(self, items=()):
+        self._keys: Dict[str, Any] = dict(items)
+        ordered = sorted((key, uid) for uid, key in self._keys.items())
+        self._order = SortedList(ordered)
+
+    def update(self, uid: str, key) -> None:
+        """Set uid's rank key; None drops uid from the index."""
+        old = self._keys.pop(uid, None)
+        if old is not None:
+            self._order.remove((old, uid))
+        if key is not None:
+            self._keys[uid] = key
+            self._order.add((key, uid))
+
+    def top(self, k: int) -> List[Tuple[str, Any]]:
+        return [(uid, key) for key, uid in self._order[:k]]
+
+    def get(self, uid: str, default=None):
+        return self._keys.get(uid, default)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+# -----------------------
+# Daily History
+# -----------------------
+# A day's counts are archived when its DailyTracker resets. Both the 8pm
+# post and the midnight rollover close a segment, and segments for the same
+# date add up. The archive is an append-only JSON-lines file per group.
+# Compaction rewrites it once the oldest day is a week past HISTORY_DAYS:
+# older days fold into one record per month, and months past HISTORY_MONTHS
+# into a single base record, so the file stays bounded. In memory each user
+# keeps prefix sums over their archived days, so a user's total for a range
+# is two bisects. Each leaderboard range is summed once per archive change
+# and cached as a TopIndex.
+HISTORY_RANGES = {"week": 7, "month": 30}
+HISTORY_DAYS = max(int(os.getenv("HISTORY_DAYS", "62")), max(HISTORY_RANGES.values()))
+HISTORY_MONTHS = int(os.getenv("HISTORY_MONTHS", "24"))
+
+def _day_ordinal(date: str) -> int:
+    return datetime.strptime(date, "%Y-%m-%d").toordinal()
+
+class DailyHistory:
+    """Archived per-day message counts for one group."""
+    def __init__(self, group: GroupConfig):
+        self.file_path = group_file(daily_history_file, group)
+        self._lock = Lock()
+        self.base: Dict[str, int] = {}
+        self.months: Dict[str, Dict[str, int]] = {}
+        self.days: Dict[str, Dict[str, int]] = {}
+        self.totals: Dict[str, int] = {}
+        self.lines = 0
+        try:
+            with open(self.file_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a torn last line from a crash mid-append
+                    self._fold(record)
+                    self.lines += 1
+        except FileNotFoundError:
+            pass
+        self._reindex()
+        if self.days:
+            logger.info(f"Loaded daily history: {len(self.days)} days, {len(self.months)} months ({self.file_path}).")
+        self._compact_if_due()
+
+    def _fold(self, record: Dict[str, Any]) -> None:
+        counts = {str(uid): int(n) for uid, n in (record.get("counts") or {}).items()}
+        if "date" in record:
+            target = self.days.setdefault(record["date"], {})
+        elif "month" in record:
+            target = self.months.setdefault(record["month"], {})
+        else:
+            target = self.base
+        for uid, n in counts.items():
+            target[uid] = target.get(uid, 0) + n
+            self.totals[uid] = self.totals.get(uid, 0) + n
+
+    def _reindex(self) -> None:
+        # Per-user (day ordinals, running totals) over the days still kept daily
+        self.user_days: Dict[str, Tuple[List[int], List[int]]] = {}
+        for date in sorted(self.days, key=_day_ordinal):
+            ordinal = _day_ordinal(date)
+            for uid, n in self.days[date].items():
+                ordinals, running = self.user_days.setdefault(uid, ([], []))
+                ordinals.append(ordinal)
+                running.append((running[-1] if running else 0) + n)
+        self.all_time = TopIndex((uid, -n) for uid, n in self.totals.items())
+        self._ranges: Dict[int, TopIndex] = {}
+
+    def append(self, date: str, counts: Dict[str, int]) -> None:
+        """Archive one segment of `date`'s counts."""
+        record = {"date": date, "counts": counts}
+        with self._lock:
+            with open(self.file_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.lines += 1
+            self._fold(record)
+            ordinal = _day_ordinal(date)
+            for uid, n in counts.items():
+                self._add_user_day(uid, ordinal, n)
+                self.all_time.update(uid, -self.totals[uid])
+            self._ranges.clear()
+            self._compact_if_due()
+
+    def _add_user_day(self, uid: str, ordinal: int, n: int) -> None:
+        ordinals, running = self.user_days.setdefault(uid, ([], []))
+        i = bisect.bisect_left(ordinals, ordinal)
+        if i == len(ordinals) or ordinals[i] != ordinal:
+            ordinals.insert(i, ordinal)
+            running.insert(i, running[i - 1] if i else 0)
+        # Segments arrive in date order, so this touches only the last entry
+        for j in range(i, len(running)):
+            running[j] += n
+
+    def user_total(self, uid: str, days: Optional[int], today: str) -> int:
+        """uid's archived count over the `days` days ending `today`; None for all time."""
+        with self._lock:
+            if days is None:
+                return self.totals.get(uid, 0)
+            ordinals, running = self.user_days.get(uid, ((), ()))
+            i = bisect.bisect_left(ordinals, _day_ordinal(today) - days + 1)
+            return (running[-1] - running[i - 1] if i else running[-1]) if ordinals else 0
+
+    def top(self, days: Optional[int], today: str, top_n: int, live: Dict[str, int]) -> List[Tuple[str, int]]:
+        """The top_n (uid, count) over the `days` days ending `today` plus the `live` counts."""
+        with self._lock:
+            ranking = self._ranking(days, today)
+            # Anyone without live messages keeps their archived rank, so only
+            # the archived top_n and the live posters can make the cut
+            candidates = {uid: -key + live.get(uid, 0) for uid, key in ranking.top(top_n)}
+            for uid, n in live.items():
+                candidates[uid] = -ranking.get(uid, 0) + n
+        return heapq.nsmallest(top_n, candidates.items(), key=lambda kv: (-kv[1], kv[0]))
+
+    def _ranking(self, days: Optional[int], today: str) -> TopIndex:
+        if days is None:
+            return self.all_time
+        start = _day_ordinal(today) - days + 1
+        ranking = self._ranges.get(start)
+        if ranking is None:
+            summed: Dict[str, int] = {}
+            for date, counts in self.days.items():
+                if _day_ordinal(date) >= start:
+                    for uid, n in counts.items():
+                        summed[uid] = summed.get(uid, 0) + n
+            ranking = self._ranges[start] = TopIndex((uid, -n) for uid, n in summed.items())
+        return ranking
+
+    def _compact_if_due(self) -> None:
+        # Caller holds the lock (or is __init__)
+        if not self.days:
+            return
+        ordinals = [_day_ordinal(d) for d in self.days]
+        if max(ordinals) - min(ordinals) >= HISTORY_DAYS + 7:
+            self._compact(max(ordinals))
+
+    def compact(self) -> None:
+        """Fold old days into months and old months into the base, then rewrite the file."""
+        with self._lock:
+            if self.days:
+                self._compact(max(_day_ordinal(d) for d in self.days))
+
+    def _compact(self, newest: int) -> None:
+        for date in [d for d in self.days if _day_ordinal(d) <= newest - HISTORY_DAYS]:
+            month = self.months.setdefault(date[:7], {})
+            for uid, n in self.days.pop(date).items():
+                month[uid] = month.get(uid, 0) + n
+        for key in sorted(self.months)[:max(0, len(self.months) - HISTORY_MONTHS)]:
+            for uid, n in self.months.pop(key).items():
+                self.base[uid] = self.base.get(uid, 0) + n
+        records = [{"base": True, "counts": self.base}] if self.base else []
+        records += [{"month": m, "counts": self.months[m]} for m in sorted(self.months)]
+        records += [{"date": d, "counts": self.days[d]} for d in sorted(self.days)]
+        tmp = self.file_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.file_path)
+        self.lines = len(records)
+        self._reindex()
+        logger.info(f"Compacted daily history to {len(self.days)} days, {len(self.months)} months ({self.file_path}).")
+
+daily_history = GroupLocal(DailyHistory)
+
+class DailyTracker:
+    """Today's message count and last message per user, for one group."""
+    def __init__(self, group: GroupConfig):
+        self.group = group
+        self.counts_file = group_file(daily_counts_file, group)
+        self.last_file = group_file(last_messages_file, group)
+        today = datetime.now().strftime("%Y-%m-%d")
+        self.date = today
+        raw = load_json(self.counts_file)
+        if isinstance(raw, dict) and raw.get("date") == today and isinstance(raw.get("counts"), dict):
+            self.counts: Dict[str, int] = {str(k): int(v) for k, v in raw.get("counts", {}).items()}
+            logger.info(f"Loaded daily_message_counts for {today} ({len(self.counts)} users).")
+        else:
+            if isinstance(raw, dict) and raw.get("date") and isinstance(raw.get("counts"), dict) and raw["counts"]:
+                # Left over from a day nobody reset (the bot was down at midnight)
+                daily_history.for_group(group).append(raw["date"], {str(k): int(v) for k, v in raw["counts"].items()})
+            self.counts = {}
+            save_json(self.counts_file, {"date": today, "counts": self.counts})
+            logger.info("Initialized new daily_message_counts for today.")
+        raw2 = load_json(self.last_file)
+        if isinstance(raw2, dict) and raw2.get("date") == today and isinstance(raw2.get("last"), dict):
+            self.last: Dict[str, str] = {str(k): v for k, v in raw2.get("last", {}).items()}
+            logger.info(f"Loaded last_message_by_user for {today} ({len(self.last)} users).")
+        else:
+            self.last = {}
+            save_json(self.last_file, {"date": today, "last": self.last})
+            logger.info("Initialized new last_message_by_user for today.")
+        # Most messages first; keys are negated counts
+        self.ranking = TopIndex((uid, -n) for uid, n in self.counts.items())
 
-_initialize_daily_tracking()
+    def reset(self, today: str) -> None:
+        with leaderboard_lock:
+            closed_date, closed = self.date, self.counts
+            self.counts = {}
+            self.last = {}
+            self.ranking = TopIndex()
+            self.date = today
+        if closed:
+            daily_history.for_group(self.group).append(closed_date, closed)
+        save_json(self.counts_file, {"date": today, "counts": self.counts})
+        save_json(self.last_file, {"date": today, "last": self.last})
+
+    def counts_snapshot(self) -> Dict[str, Any]:
+        with leaderboard_lock:
+            return {"date": self.date, "counts": dict(self.counts)}
+
+    def last_snapshot(self) -> Dict[str, Any]:
+        with leaderboard_lock:
+            return {"date": self.date, "last": dict(self.last)}
+
+daily_tracking = GroupLocal(DailyTracker)
+daily_tracking.for_group(DEFAULT_GROUP)
 
 def load_karma_from_bin():
-    url = f"https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}/latest"
+    return _fetch_karma_bin() or {}
+
+def _fetch_karma_bin() -> Optional[Dict[str, Any]]:
+    """The bin contents, or None if JSONBin could not be read (or the group has no bin)."""
+    bin_id = current_group().jsonbin_bin_id
+    if not bin_id:
+        return None
+    url = f"{JSONBIN_API}/b/{bin_id}/latest"
     headers = {
         "X-Master-Key": JSONBIN_MASTER_KEY, 
         "X-Bin-Meta": "false"  # This ensures we get only our data, no metadata
     }
     try:
-        resp = requests.get(url, headers=headers, timeout=8)
+        resp = http_request("GET", url, headers=headers, timeout=8)
         if resp.status_code == 200:
             data = resp.json()
             # Objectively check if it's the right format
             if isinstance(data, dict):
-                return data
+                return _normalize_karma(data)
         else:
             logger.error(f"JSONBin Load Failed: {resp.status_code} - {resp.text}")
     except Exception as e:
         logger.error(f"Karma Load Error: {e}")
-    return {}
+    return None
 
-def save_karma_to_bin(karma_data):
-    url = f"https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}"
+def save_karma_to_bin(karma_data) -> bool:
+    url = f"{JSONBIN_API}/b/{current_group().jsonbin_bin_id}"
     headers = {
         "X-Master-Key": JSONBIN_MASTER_KEY,
         "Content-Type": "application/json"
     }
     # Save the data directly without the "karma" wrapper to keep it clean
     try:
-        resp = requests.put(url, json=karma_data, headers=headers, timeout=10)
+        resp = http_request("PUT", url, json=karma_data, headers=headers, timeout=10)
         if resp.status_code != 200:
             logger.error(f"JSONBin Save Failed: {resp.status_code} - {resp.text}")
+            return False
+        return True
     except Exception as e:
         logger.error(f"Critical Karma Save Error: {e}")
-def sync_karma():
-    """Force a refresh from JSONBin to memory."""
-    global karma_history
-    cloud_data = load_karma_from_bin()
-    if cloud_data:
-        karma_history = cloud_data
-        # Sync the local file to match the cloud truth
-        safe_save_json("karma_history.json", karma_history)
-        logger.info("Memory and local cache synced with JSONBin.")
-
-karma_history: Dict[str, Dict[str, int]] = load_karma_from_bin()
+        return False
+
+# -----------------------
+# Karma Sync
+# -----------------------
+# Votes land in karma_history (memory/StateMap) right away and queue a delta.
+# A flusher thread folds the deltas into a fresh copy of the bin every
+# KARMA_FLUSH_SECONDS and PUTs it once, so concurrent voters (or workers)
+# add to each other's scores instead of overwriting them. Reads are served
+# from memory and re-pulled from JSONBin at most every KARMA_MAX_STALENESS.
+# Each group syncs its own bin; a group without one keeps karma local.
+# Records are normalized to {"score": int, "name": str} as they are loaded,
+# and a KarmaBoard ranks them for the leaderboard.
+karma_lock = Lock()
+_karma_flusher_started = False
+
+class KarmaBoard:
+    """Positive and negative karma rankings for one group."""
+    def __init__(self, records: Dict[str, Dict[str, Any]]):
+        self.positive = TopIndex((uid, -e["score"]) for uid, e in records.items() if _rankable(uid) and e["score"] > 0)
+        self.negative = TopIndex((uid, e["score"]) for uid, e in records.items() if _rankable(uid) and e["score"] < 0)
+        self.built_at = time.time()
+
+    def update(self, uid: str, score: int) -> None:
+        if not _rankable(uid):
+            return
+        self.positive.update(uid, -score if score > 0 else None)
+        self.negative.update(uid, score if score < 0 else None)
+
+class KarmaSyncState:
+    def __init__(self, group: GroupConfig):
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.synced_at = 0.0
+        self.board: Optional[KarmaBoard] = None
+
+karma_sync = GroupLocal(KarmaSyncState)
+
+def _rankable(uid: str) -> bool:
+    return bool(uid) and uid != "None"
+
+def _karma_entry(value, name: Optional[str] = None) -> Dict[str, Any]:
+    if isinstance(value, dict):
+        entry = dict(value)
+        entry["score"] = int(entry.get("score", 0) or 0)
+    else:
+        try:
+            entry = {"score": int(value or 0)}
+        except (ValueError, TypeError):
+            entry = {"score": 0}
+    if name and not entry.get("name"):
+        entry["name"] = name
+    return entry
+
+def _normalize_karma(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Old bins mix bare integer scores with {"score", "name"} records; make them all records."""
+    return {str(uid): _karma_entry(value) for uid, value in data.items()}
+
+def _replace_karma(data: Dict[str, Any]) -> None:
+    """Swap in a full karma map and rebuild its board. Caller holds karma_lock."""
+    records = _normalize_karma(data)
+    karma_history.replace_all(records)
+    karma_sync.for_group().board = KarmaBoard(records)
+
+def _karma_board() -> KarmaBoard:
+    """The current group's board, built on first use. Caller holds karma_lock.
+
+    Shared state backends can be written by other workers, so there the
+    board is rebuilt from the map once it is KARMA_MAX_STALENESS old."""
+    state = karma_sync.for_group()
+    board = state.board
+    if board is None or (STATE_BACKEND != "json" and time.time() - board.built_at > KARMA_MAX_STALENESS):
+        raw = dict(karma_history.items())
+        records = _normalize_karma(raw)
+        if records != raw:
+            karma_history.replace_all(records)
+        board = state.board = KarmaBoard(records)
+    return board
+
+def _apply_pending(data: Dict[str, Any], pending: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    merged = dict(data)
+    for uid, change in pending.items():
+        entry = _karma_entry(merged.get(uid), change.get("name"))
+        entry["score"] += change["delta"]
+        merged[uid] = entry
+    return merged
+
+def sync_karma() -> bool:
+    """Force a refresh from JSONBin to memory, keeping votes not yet flushed."""
+    state = karma_sync.for_group()
+    cloud_data = _fetch_karma_bin()
+    if cloud_data is None:
+        return False
+    with karma_lock:
+        # Sync the local cache to match the cloud truth
+        _replace_karma(_apply_pending(cloud_data, state.pending))
+        state.synced_at = time.time()
+    logger.info("Memory and local cache synced with JSONBin.")
+    return True
+
+def refresh_karma_if_stale() -> None:
+    state = karma_sync.for_group()
+    if current_group().jsonbin_bin_id and time.time() - state.synced_at > KARMA_MAX_STALENESS:
+        sync_karma()
+
+def record_karma_vote(target_uid: str, target_nick: str, change: int) -> int:
+    """Apply a vote locally and queue it for the next flush. Returns the new score."""
+    with karma_lock:
+        entry = _karma_entry(karma_history.get(target_uid), target_nick)
+        entry["score"] += change
+        # Write the whole entry back; StateMaps only persist on assignment
+        karma_history[target_uid] = entry
+        _karma_board().update(target_uid, entry["score"])
+        if current_group().jsonbin_bin_id:
+            pending = karma_sync.pending.setdefault(target_uid, {"delta": 0, "name": target_nick})
+            pending["delta"] += change
+    _start_karma_flusher_once()
+    return entry["score"]
+
+def flush_karma() -> bool:
+    """Merge the current group's queued deltas into the latest bin and PUT it once."""
+    state = karma_sync.for_group()
+    with karma_lock:
+        if not state.pending:
+            return True
+        batch = state.pending
+        state.pending = {}
+    ok = False
+    remote = _fetch_karma_bin()
+    if remote is not None:
+        merged = _apply_pending(remote, batch)
+        ok = save_karma_to_bin(merged)
+    with karma_lock:
+        if ok:
+            _replace_karma(_apply_pending(merged, state.pending))
+            state.synced_at = time.time()
+        else:
+            # Put the batch back in front of anything queued meanwhile
+            for uid, change in batch.items():
+                pending = state.pending.setdefault(uid, {"delta": 0, "name": change.get("name")})
+                pending["delta"] += change["delta"]
+    if ok:
+        logger.info(f"Flushed karma for {len(batch)} user(s) to JSONBin.")
+    return ok
+
+def flush_all_karma() -> None:
+    for group, _ in karma_sync.instances():
+        try:
+            with use_group(group):
+                flush_karma()
+        except Exception as e:
+            logger.error(f"Karma flush error for group {group.group_id}: {e}")
+
+def _karma_flusher() -> None:
+    while True:
+        time.sleep(KARMA_FLUSH_SECONDS)
+        flush_all_karma()
+
+def _start_karma_flusher_once() -> None:
+    global _karma_flusher_started
+    if _karma_flusher_started:
+        return
+    with karma_lock:
+        if _karma_flusher_started:
+            return
+        _karma_flusher_started = True
+    threading.Thread(target=_karma_flusher, name="karma-flush", daemon=True).start()
+
+atexit.register(flush_all_karma)
+
+# Local cache of the JSONBin karma; used as-is if JSONBin is unreachable at boot.
+# Other groups sync on their first leaderboard.
+karma_history = open_group_state_map("karma", karma_cache_file)
+sync_karma()
 
 def get_help_message(is_admin: bool) -> str:
     if is_admin:
@@ -255,16 +1933,21 @@ def get_help_message(is_admin: bool) -> str:
             "• !unmute <user> – Unmute a user\n"
             "• !muteall <minutes> – Mute everyone except admins\n"
             "• !unmuteall – Unmute everyone\n"
+            "• !lockdown <minutes> / !unlock – Raid lockdown (group mute + no links)\n"
             "• !ban <user> – Ban a user\n"
             "• !unban <user> – Unban a user\n"
+            "• !massban @user @user … – Ban many users and delete their recent messages\n"
             "• !delete – Delete a message (reply to it)\n"
             "• !strike <user> – Issue a strike\n"
             "• !strikes <user> – View strikes\n"
-            "• !getid <name> – Get a user's ID\n\n"
+            "• !getid <name> – Get a user's ID\n"
+            "• !jobs / !job <id> – Status of unban jobs\n\n"
             "Utility Commands:\n"
             "• !pixel – Count pixels in an image\n"
             "• !google <query> – AI search\n"
-            "• !leaderboard – Show message leaderboard\n"
+            "• !leaderboard [week|month|all] – Show message leaderboard\n"
+            "• !stats [user] [week|month|all] – Message counts for a user\n"
+            "• !search <words> [@user] [since:/until:YYYY-MM-DD] – Search chat history\n"
             "• !enable / !disable – Toggle system messages\n"
         )
     else:
@@ -322,20 +2005,138 @@ def contains_link_but_no_attachments(text: str, attachments: list) -> bool:
 
     # If we get here, all links found were valid media uploads
     return False
+# -----------------------
+# Image Dimension Probe
+# -----------------------
+# !pixel only needs width x height, which every common format stores in its
+# first few hundred bytes. Stream the start of the file (Range request, and
+# chunked reads in case the server ignores Range) and parse the header. If
+# the header walk fails on an image, Pillow's incremental parser gets the
+# bytes already read and then the rest of the stream only until it has the
+# header, up to IMAGE_PARSER_MAX_BYTES.
+IMAGE_PROBE_BYTES = 128 * 1024
+IMAGE_PROBE_CHUNK = 4096
+IMAGE_PARSER_MAX_BYTES = 4 * 1024 * 1024
+IMAGE_SIZE_CACHE_SIZE = 1024
+
+_image_size_cache: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+_image_size_lock = Lock()
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _jpeg_size(head: bytes) -> Optional[Tuple[int, int]]:
+    i = 2
+    while i + 9 <= len(head):
+        if head[i] != 0xFF:
+            i += 1
+            continue
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1  # fill byte
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2  # standalone markers carry no length
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = int.from_bytes(head[i + 5:i + 7], "big"), int.from_bytes(head[i + 7:i + 9], "big")
+            return (width, height) if width and height else None
+        i += 2 + int.from_bytes(head[i + 2:i + 4], "big")
+    return None
+
+def parse_image_size(head: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from the first bytes of a PNG, JPEG, GIF or WebP; None if not (yet) known."""
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and len(head) >= 24:
+        return int.from_bytes(head[16:20], "big"), int.from_bytes(head[20:24], "big")
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return int.from_bytes(head[6:8], "little"), int.from_bytes(head[8:10], "little")
+    if head[:2] == b"\xff\xd8":
+        return _jpeg_size(head)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            return int.from_bytes(head[26:28], "little") & 0x3FFF, int.from_bytes(head[28:30], "little") & 0x3FFF
+        if chunk == b"VP8L":
+            b0, b1, b2, b3 = head[21:25]
+            return 1 + (((b1 & 0x3F) << 8) | b0), 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+        if chunk == b"VP8X":
+            return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+    return None
+
+def _pillow_image_size(url: str, head: bytes, complete: bool) -> Optional[Tuple[int, int]]:
+    """Size via Pillow, starting from the `head` the probe already read (the whole file if `complete`)."""
+    from PIL import ImageFile  # only needed for formats the header parser can't read
+    parser = ImageFile.Parser()
+    parser.feed(head)
+    received = len(head)
+    if parser.image is None and not complete:
+        resp = http_request("GET", url, headers={"Range": f"bytes={received}-"}, stream=True, timeout=10)
+        try:
+            if resp.status_code == 416:  # the head was the whole file
+                return None
+            resp.raise_for_status()
+            # A server that ignores Range resends from byte 0
+            skip = 0 if resp.status_code == 206 else received
+            for chunk in resp.iter_content(IMAGE_PROBE_CHUNK):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                    if not chunk:
+                        continue
+                parser.feed(chunk)
+                received += len(chunk)
+                if parser.image is not None or received >= IMAGE_PARSER_MAX_BYTES:
+                    break
+        finally:
+            resp.close()
+    return parser.image.size if parser.image is not None else None
+
+def probe_image_size(url: str) -> Optional[Tuple[int, int]]:
+    """Image dimensions from the first few KB of `url`, cached per URL."""
+    with _image_size_lock:
+        if url in _image_size_cache:
+            _image_size_cache.move_to_end(url)
+            return _image_size_cache[url]
+
+    size = None
+    content_type = ""
+    resp = http_request("GET", url, headers={"Range": f"bytes=0-{IMAGE_PROBE_BYTES - 1}"}, stream=True, timeout=10)
+    try:
+        resp.raise_for_status()
+        content_type = resp.headers.get("Content-Type", "")
+        head = b""
+        complete = True  # the stream ended before we stopped reading
+        for chunk in resp.iter_content(IMAGE_PROBE_CHUNK):
+            head += chunk
+            size = parse_image_size(head)
+            if size or len(head) >= IMAGE_PROBE_BYTES:
+                complete = False
+                break
+    finally:
+        resp.close()
+
+    if size is None and content_type.startswith("image/"):
+        logger.info(f"Header probe failed for {url}, falling back to Pillow")
+        size = _pillow_image_size(url, head, complete)
+    if size is None:
+        return None
+
+    with _image_size_lock:
+        _image_size_cache[url] = size
+        while len(_image_size_cache) > IMAGE_SIZE_CACHE_SIZE:
+            _image_size_cache.popitem(last=False)
+    return size
+
 #pixel things
 def get_pixel_count(message_id: str) -> Optional[str]:
     """
     1. Tries to get dimensions from GroupMe metadata.
-    2. If missing, downloads the image and counts pixels manually.
+    2. If missing, reads the size from the image header (probe_image_size).
     Now with maximum silliness injected directly.
     """
-    url = f"{GROUPME_API}/groups/{GROUP_ID}/messages/{message_id}?token={ACCESS_TOKEN}"
     try:
-        resp = requests.get(url, timeout=8)
-        if resp.status_code != 200:
-            logger.error(f"Failed to fetch message: {resp.status_code}")
+        msg = get_message_metadata(message_id)
+        if msg is None:
             return None
-        msg = resp.json().get('response', {}).get('message', {})
         attachments = msg.get('attachments', [])
        
         target_url = None
@@ -359,16 +2160,16 @@ def get_pixel_count(message_id: str) -> Optional[str]:
                 "No image detected. Sending you a virtual participation trophy anyway.",
             ])
         
-        # 2. If metadata failed, Download & Count (Fallback)
+        # 2. If metadata failed, read the dimensions from the file header (Fallback)
         if not width or not height:
             try:
-                logger.info(f"Metadata missing for {message_id}, downloading image...")
-                img_resp = requests.get(target_url, timeout=10)
-                img_resp.raise_for_status()
-                with Image.open(BytesIO(img_resp.content)) as img:
-                    width, height = img.size
+                logger.info(f"Metadata missing for {message_id}, probing image header...")
+                size = probe_image_size(target_url)
+                if not size:
+                    raise ValueError("unrecognized image header")
+                width, height = size
             except Exception as e:
-                logger.error(f"Failed to download/parse image: {e}")
+                logger.error(f"Failed to probe image size: {e}")
                 return random.choice([
                     "I tried to count the pixels but got distracted by how pretty it is.",
                     "The pixels are hiding from me. Rude.",
@@ -448,67 +2249,134 @@ def get_pixel_count(message_id: str) -> Optional[str]:
 # -----------------------
 def send_startup_message():
     """Send a message to the GroupMe chat when the bot boots."""
-    if not BOT_ID:
+    if not current_group().bot_id:
         print("BOT_ID missing — cannot send startup message.")
         return
 
-    url = "https://api.groupme.com/v3/bots/post"
+    url = f"{GROUPME_API}/bots/post"
     payload = {
-        "bot_id": BOT_ID,
+        "bot_id": current_group().bot_id,
         "text": "Bot started successfully — code is live!"
     }
 
     try:
-        requests.post(url, json=payload, timeout=5)
+        http_request("POST", url, json=payload, timeout=5)
     except Exception as e:
         print("Startup message failed:", e)
 
 def startup_worker():
     time.sleep(2)  # Give the server a moment to fully start
-    send_startup_message()
+    for group in GROUPS.values():
+        with use_group(group):
+            send_startup_message()
     
 # -----------------------
 # Ban Functions
 # -----------------------
 def get_user_membership_id(user_id):
     try:
-        url = f"{GROUPME_API}/groups/{GROUP_ID}?token={ACCESS_TOKEN}"
-        response = requests.get(url, timeout=8)
-        if response.status_code == 401:
-            logger.error("ACCESS TOKEN INVALID OR EXPIRED - Regenerate your token at https://dev.groupme.com/!")
-            return None
-        elif response.status_code != 200:
-            logger.error(f"Failed to get group info: {response.status_code} - {response.text}")
-            return None
-        group_data = response.json()
-        members = group_data.get('response', {}).get('members', [])
-        for member in members:
-            if str(member.get('user_id')) == str(user_id):
-                membership_id = member.get('id')
-                logger.info(f"Found membership ID {membership_id} for user {user_id}")
-                return membership_id
+        member = get_roster_member(user_id)
+        if member:
+            membership_id = member.get('id')
+            logger.info(f"Found membership ID {membership_id} for user {user_id}")
+            return membership_id
         logger.warning(f"User {user_id} not found in group members")
         return None
     except Exception as e:
         logger.exception(f"Error getting membership ID for {user_id}: {e}")
         return None
 
+# -----------------------
+# Message Metadata Cache
+# -----------------------
+# Karma votes and !pixel need the author/attachments of the message being
+# replied to. webhook() records every message it sees here, so most reply
+# targets are answered from memory; misses fall back to the API and are cached.
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "5000"))
+MESSAGE_CACHE_TTL = float(os.getenv("MESSAGE_CACHE_TTL", str(24 * 3600)))
+
+_message_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_message_cache_lock = Lock()
+_message_cache_stats = {"hits": 0, "misses": 0, "fills": 0, "evictions": 0}
+
+def remember_message(msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Cache msg's metadata; returns the cached entry (None if msg has no id)."""
+    msg_id = msg.get("id")
+    if not msg_id:
+        return None
+    entry = {
+        "id": str(msg_id),
+        "user_id": str(msg.get("user_id")) if msg.get("user_id") is not None else None,
+        "name": msg.get("name"),
+        "attachments": msg.get("attachments") or [],
+        "created_at": msg.get("created_at"),
+        "group_id": str(msg.get("group_id") or current_group().group_id),
+    }
+    with _message_cache_lock:
+        _message_cache[str(msg_id)] = (time.time() + MESSAGE_CACHE_TTL, entry)
+        _message_cache.move_to_end(str(msg_id))
+        _message_cache_stats["fills"] += 1
+        while len(_message_cache) > MESSAGE_CACHE_SIZE:
+            _message_cache.popitem(last=False)
+            _message_cache_stats["evictions"] += 1
+    return entry
+
+def _cached_message(msg_id: str) -> Optional[Dict[str, Any]]:
+    with _message_cache_lock:
+        item = _message_cache.get(msg_id)
+        if item is None:
+            _message_cache_stats["misses"] += 1
+            return None
+        expires_at, entry = item
+        if time.time() >= expires_at:
+            del _message_cache[msg_id]
+            _message_cache_stats["misses"] += 1
+            return None
+        _message_cache.move_to_end(msg_id)
+        _message_cache_stats["hits"] += 1
+        return entry
+
+def get_message_metadata(message_id, group_id=None) -> Optional[Dict[str, Any]]:
+    """Author and attachments of a group message, from cache or the API."""
+    if not message_id:
+        return None
+    cached = _cached_message(str(message_id))
+    if cached is not None:
+        return cached
+    url = f"{GROUPME_API}/groups/{group_id or current_group().group_id}/messages/{message_id}?token={ACCESS_TOKEN}"
+    response = http_request("GET", url, timeout=8)
+    if response.status_code != 200:
+        logger.error(f"Failed to fetch message {message_id}: {response.status_code}")
+        return None
+    msg = response.json().get("response", {}).get("message", {}) or {}
+    msg.setdefault("id", str(message_id))
+    # The entry itself, not a second lookup into the shared LRU
+    return remember_message(msg)
+
+def recent_message_ids_by(user_ids) -> List[str]:
+    """Ids of cached messages in the current group written by any of user_ids (newest first)."""
+    wanted = {str(u) for u in user_ids}
+    group_id = current_group().group_id
+    now = time.time()
+    with _message_cache_lock:
+        return [msg_id for msg_id, (expires_at, entry) in reversed(_message_cache.items())
+                if entry.get("user_id") in wanted and entry.get("group_id") == group_id and now < expires_at]
+
+def message_cache_stats() -> Dict[str, Any]:
+    with _message_cache_lock:
+        stats = dict(_message_cache_stats)
+        stats["size"] = len(_message_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
 def _get_user_id_from_reply(data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
-    """Explicitly fetches the original message to get the correct User ID."""
+    """Looks up the original message to get the correct User ID."""
     for att in data.get("attachments", []):
         if att.get("type") == "reply":
-            reply_msg_id = att.get("base_reply_id")
-            group_id = data.get("group_id")
-            
-            # Call GroupMe API to get the actual message details
-            url = f"https://api.groupme.com/v3/groups/{group_id}/messages/{reply_msg_id}?token={ACCESS_TOKEN}"
-            response = requests.get(url)
-            
-            if response.status_code == 200:
-                msg_data = response.json().get("response", {}).get("message", {})
-                u_id = str(msg_data.get("user_id"))
-                u_name = msg_data.get("name")
-                return u_id, u_name
+            msg_data = get_message_metadata(att.get("base_reply_id"), data.get("group_id"))
+            if msg_data:
+                return str(msg_data.get("user_id")), msg_data.get("name")
     return None
 
 def _find_replied_message(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -522,10 +2390,15 @@ def _find_replied_message(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
             }
     return None
 
-def _delete_message_by_id(msg_id: str) -> bool:
-    url = f"{GROUPME_API}/conversations/{GROUP_ID}/messages/{msg_id}"
+def _delete_message_by_id(msg_id: str, on_done=None) -> bool:
+    """Queue a moderation delete. on_done(success) runs once the API answers."""
+    unindex_message(msg_id)
+    return dispatch(PRIORITY_MODERATION, _delete_message_now, str(msg_id), on_done=on_done)
+
+def _delete_message_now(msg_id: str) -> bool:
+    url = f"{GROUPME_API}/conversations/{current_group().group_id}/messages/{msg_id}"
     try:
-        r = requests.delete(url, params={"token": ACCESS_TOKEN}, timeout=8)
+        r = http_request("DELETE", url, params={"token": ACCESS_TOKEN}, timeout=8)
         if r.status_code == 204:
             logger.info(f"Deleted message {msg_id}")
             return True
@@ -535,15 +2408,15 @@ def _delete_message_by_id(msg_id: str) -> bool:
         logger.exception(f"Delete error {msg_id}: {e}")
         return False
         
-def ban_user(user_id, username, reason):
+def ban_user(user_id, username, reason, membership_id=None):
     try:
-        if str(user_id) in ADMIN_IDS: return False
-        membership_id = get_user_membership_id(user_id)
+        if is_group_admin(user_id): return False
+        membership_id = membership_id or get_user_membership_id(user_id)
         if not membership_id:
             logger.warning(f"Cannot ban {username} ({user_id}) — membership id not found")
             return False
-        url = f"{GROUPME_API}/groups/{GROUP_ID}/members/{membership_id}/remove?token={ACCESS_TOKEN}"
-        response = requests.post(url, timeout=8)
+        url = f"{GROUPME_API}/groups/{current_group().group_id}/members/{membership_id}/remove?token={ACCESS_TOKEN}"
+        response = http_request("POST", url, timeout=8)
         if response.status_code == 200:
             logger.info(f"Successfully banned {username} ({user_id}) - {reason}")
             return True
@@ -554,13 +2427,24 @@ def ban_user(user_id, username, reason):
         logger.exception(f"Ban error for {username} ({user_id}): {e}")
         return False
 
-def call_ban_service(user_id: str, username: str, reason: str) -> bool:
-    success = ban_user(user_id, username, reason)
+def call_ban_service(user_id: str, username: str, reason: str, membership_id: Optional[str] = None,
+                     refresh: bool = True) -> bool:
+    success = ban_user(user_id, username, reason, membership_id)
+    if success:
+        record_ban(user_id, username, refresh)
+    return success
+
+def record_ban(user_id: str, username: str, refresh: bool = True) -> None:
+    """Bookkeeping after a member was removed (shared with asgi.py's async ban)."""
+    banned_users[str(user_id)] = username
+    user_swear_counts.pop(str(user_id), None)
+    if refresh:
+        invalidate_roster()
+
+def _ban_and_announce(user_id: str, username: str, reason: str, announcement: str) -> bool:
+    success = call_ban_service(user_id, username, reason)
     if success:
-        banned_users[str(user_id)] = username
-        save_json(banned_users_file, banned_users)
-        user_swear_counts.pop(str(user_id), None)
-        save_json(user_swear_counts_file, user_swear_counts)
+        send_system_message(announcement)
     return success
 
 
@@ -568,12 +2452,13 @@ def call_ban_service(user_id: str, username: str, reason: str) -> bool:
 # Message Deletion (Community API)
 # -----------------------
 def delete_message(message_id: str) -> bool:
-    if not ACCESS_TOKEN or not GROUP_ID:
+    if not ACCESS_TOKEN or not current_group().group_id:
         logger.error("Missing ACCESS_TOKEN or GROUP_ID for message deletion")
         return False
-    url = f"{GROUPME_API}/conversations/{GROUP_ID}/messages/{message_id}?token={ACCESS_TOKEN}"
+    unindex_message(message_id)
+    url = f"{GROUPME_API}/conversations/{current_group().group_id}/messages/{message_id}?token={ACCESS_TOKEN}"
     try:
-        response = requests.delete(url, timeout=8)
+        response = http_request("DELETE", url, timeout=8)
         if response.status_code == 204:
             logger.info(f"Deleted message {message_id}")
             return True
@@ -587,50 +2472,132 @@ def delete_message(message_id: str) -> bool:
 # -----------------------
 # Group API Helpers
 # -----------------------
-def get_group_members() -> List[Dict[str, Any]]:
-    if not ACCESS_TOKEN or not GROUP_ID:
-        logger.error("Missing ACCESS_TOKEN or GROUP_ID for group members")
-        return []
-    try:
-        response = requests.get(
-            f"{API_URL}/groups/{GROUP_ID}",
-            headers={"X-Access-Token": ACCESS_TOKEN},
-            timeout=8
-        )
-        response.raise_for_status()
-        return response.json().get("response", {}).get("members", [])
-    except Exception as e:
-        logger.error(f"Failed to get group members: {e}")
-        return []
-
-def get_group_share_url() -> Optional[str]:
-    if not ACCESS_TOKEN or not GROUP_ID:
+def _fetch_group() -> Optional[Dict[str, Any]]:
+    if not ACCESS_TOKEN or not current_group().group_id:
+        logger.error("Missing ACCESS_TOKEN or GROUP_ID for group lookup")
         return None
     try:
-        response = requests.get(
-            f"{API_URL}/groups/{GROUP_ID}",
+        response = http_request(
+            "GET",
+            f"{API_URL}/groups/{current_group().group_id}",
             headers={"X-Access-Token": ACCESS_TOKEN},
             timeout=8
         )
+        if response.status_code == 401:
+            logger.error("ACCESS TOKEN INVALID OR EXPIRED - Regenerate your token at https://dev.groupme.com/!")
+            return None
         response.raise_for_status()
-        return response.json().get("response", {}).get("share_url")
+        return response.json().get("response", {}) or {}
     except Exception as e:
-        logger.error(f"Failed to get group share URL: {e}")
+        logger.error(f"Failed to get group info: {e}")
         return None
 
+# -----------------------
+# Group Roster Cache
+# -----------------------
+# One GET /groups/{id} feeds every member lookup until the TTL runs out or a
+# join/leave/ban/unban event invalidates it. Lookups are dict hits.
+ROSTER_TTL_SECONDS = int(os.getenv("ROSTER_TTL_SECONDS", "300"))
+ROSTER_MISS_REFRESH_SECONDS = 30
+
+class GroupRoster:
+    def __init__(self, group: GroupConfig):
+        self.lock = Lock()
+        self.members: List[Dict[str, Any]] = []
+        self.by_user_id: Dict[str, Dict[str, Any]] = {}
+        self.by_membership_id: Dict[str, Dict[str, Any]] = {}
+        self.by_nickname: Dict[str, Dict[str, Any]] = {}
+        self.share_url: Optional[str] = None
+        self.loaded = False
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self.generation = 0  # bumped whenever members is replaced
+        self.name_index: Optional["MemberNameIndex"] = None
+        self.name_index_version = None
+
+    def refresh(self, force: bool = False) -> bool:
+        with self.lock:
+            now = time.time()
+            if not force and self.loaded and now < self.expires_at:
+                return True
+            group = _fetch_group()
+            if group is None:
+                # Keep serving the last good roster rather than failing every lookup
+                return self.loaded
+            members = group.get("members", []) or []
+            by_user_id, by_membership_id, by_nickname = {}, {}, {}
+            for m in members:
+                if m.get("user_id") is not None:
+                    by_user_id[str(m.get("user_id"))] = m
+                if m.get("id") is not None:
+                    by_membership_id[str(m.get("id"))] = m
+                nick = (m.get("nickname") or "").lower()
+                if nick:
+                    by_nickname.setdefault(nick, m)
+            self.members = members
+            self.by_user_id = by_user_id
+            self.by_membership_id = by_membership_id
+            self.by_nickname = by_nickname
+            self.share_url = group.get("share_url")
+            self.generation += 1
+            self.loaded = True
+            self.fetched_at = now
+            self.expires_at = now + ROSTER_TTL_SECONDS
+            logger.info(f"Roster refreshed ({len(members)} members)")
+            return True
+
+rosters = GroupLocal(GroupRoster)
+
+def refresh_roster(force: bool = False) -> bool:
+    """Reload the current group's roster if it is stale. Returns False only if nothing is cached."""
+    return rosters.for_group().refresh(force)
+
+def invalidate_roster() -> None:
+    rosters.for_group().expires_at = 0.0
+
+def get_roster_member(user_id) -> Optional[Dict[str, Any]]:
+    roster = rosters.for_group()
+    roster.refresh()
+    member = roster.by_user_id.get(str(user_id))
+    if member is None and time.time() - roster.fetched_at > ROSTER_MISS_REFRESH_SECONDS:
+        # Someone may have joined without us seeing the system message
+        roster.refresh(force=True)
+        member = roster.by_user_id.get(str(user_id))
+    return member
+
+def get_member_by_membership_id(membership_id) -> Optional[Dict[str, Any]]:
+    refresh_roster()
+    return rosters.by_membership_id.get(str(membership_id))
+
+def get_member_by_nickname(nickname: str) -> Optional[Dict[str, Any]]:
+    refresh_roster()
+    return rosters.by_nickname.get((nickname or "").lower())
+
+def is_group_member(user_id, fresh: bool = False) -> bool:
+    refresh_roster(force=fresh)
+    return str(user_id) in rosters.by_user_id
+
+def get_member_nicknames() -> Dict[str, str]:
+    refresh_roster()
+    return {uid: m.get("nickname") for uid, m in rosters.by_user_id.items()}
+
+def get_group_members() -> List[Dict[str, Any]]:
+    refresh_roster()
+    return list(rosters.members)
+
+def get_group_share_url() -> Optional[str]:
+    refresh_roster()
+    return rosters.share_url
+
 def is_safe(text: str) -> bool:
     """Checks if text contains banned words or PII patterns."""
     if not text:
         return True
     
-    content = text.lower()
-    
-    # 1. Check against your existing swear lists
-    all_banned_words = INSTANT_BAN_WORDS + REGULAR_SWEAR_WORDS
-    for word in all_banned_words:
-        if word in content:
-            return False
-            
+    # 1. Check against your existing swear lists (substring match, any category)
+    if scan_profanity(text, mode="substring", first_only=True):
+        return False
+
     # 2. Basic PII/Dox protection (Phone numbers & IP addresses)
     # Matches typical phone formats and IPv4 addresses
     pii_patterns = [
@@ -648,7 +2615,7 @@ def get_ai_search(query: str) -> str:
     if not is_safe(query):
         return " I can't look that up for you. Let's keep it clean."
 
-    url = "https://api.tavily.com/search"
+    url = f"{TAVILY_API}/search"
     payload = {
         "api_key": os.getenv("TAVILY_API_KEY"),
         "query": query,  # Send ONLY the query here
@@ -658,7 +2625,7 @@ def get_ai_search(query: str) -> str:
     }
     
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = http_request("POST", url, json=payload, timeout=10)
         if response.status_code != 200:
             logger.error(f"Tavily API Error: {response.status_code}")
             return "Search service is a bit grumpy right now. Try again later."
@@ -716,16 +2683,15 @@ def resolve_target_user(data: Dict, command_text: str) -> Optional[Tuple[str, st
                 uid = str(user_ids[0])
                 start, length = loci[0]
                 mentioned_text = text[start:start+length].lstrip('@').strip()
-                members = get_group_members()
-                for m in members:
-                    if str(m.get("user_id")) == uid:
-                        return uid, m.get("nickname") or mentioned_text
+                member = get_roster_member(uid)
+                if member:
+                    return uid, member.get("nickname") or mentioned_text
                 return uid, mentioned_text
 
     # 3. FUZZY FALLBACK
     prefix_map = {
         '!mute ': 6, '!ban ': 5, '!unban ': 7, '!getid ': 7,
-        '!strike ': 8, '!strikes ': 9, '!unmute': 8
+        '!strike ': 8, '!strikes ': 9, '!unmute': 8, '!stats ': 7
     }
     cut = 0
     for prefix, length in prefix_map.items():
@@ -748,8 +2714,99 @@ def resolve_target_user(data: Dict, command_text: str) -> Optional[Tuple[str, st
     return None
 
 # -----------------------
-# Fuzzy Member Search (Tightened)
+# Member Name Index
 # -----------------------
+# Current and former members in one index, rebuilt only when the roster or
+# former_members changes. Each name is stored in the same normalized,
+# token-sorted form fuzz.token_sort_ratio compares, plus a trigram posting
+# list. A lookup scores only names that share enough trigrams to possibly
+# reach the cutoff, instead of every name in the group.
+FUZZY_NAME_CUTOFF = 92
+
+class NameEntry(NamedTuple):
+    user_id: str
+    nickname: str
+    key: str
+    former: bool
+
+def _name_key(name: str) -> str:
+    return " ".join(sorted(fuzz_utils.full_process(name or "", force_ascii=True).split()))
+
+def _trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class MemberNameIndex:
+    def __init__(self, members: List[Dict[str, Any]], former: Dict[str, str]):
+        self.entries: List[NameEntry] = []
+        self.exact: Dict[str, NameEntry] = {}
+        self.by_key: Dict[str, NameEntry] = {}
+        self.postings: Dict[str, List[int]] = {}
+        seen = set()
+        for m in members:
+            uid, nick = str(m.get("user_id")), m.get("nickname") or ""
+            if nick and m.get("user_id") is not None:
+                seen.add(uid)
+                self._add(NameEntry(uid, nick, _name_key(nick), False))
+        for uid, nick in former.items():
+            if nick and str(uid) not in seen:
+                self._add(NameEntry(str(uid), nick, _name_key(nick), True))
+
+    def _add(self, entry: NameEntry) -> None:
+        idx = len(self.entries)
+        self.entries.append(entry)
+        # First one wins, so current members shadow former ones
+        self.exact.setdefault(entry.nickname.lower(), entry)
+        if not entry.key:
+            return
+        self.by_key.setdefault(entry.key, entry)
+        for gram in _trigrams(entry.key):
+            self.postings.setdefault(gram, []).append(idx)
+
+    def candidates(self, key: str, cutoff: int) -> List[int]:
+        grams = _trigrams(key)
+        # ratio >= r (scores are rounded, hence the half point) allows at most
+        # 2(1-r)/r * len(key) inserted/deleted characters, and each one can
+        # break at most three of the query's trigrams
+        r = (cutoff - 0.5) / 100
+        max_edits = int(2 * (1 - r) / r * len(key))
+        needed = max(1, len(grams) - 3 * max_edits)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for idx in self.postings.get(gram, ()):
+                shared[idx] = shared.get(idx, 0) + 1
+        return [idx for idx, count in shared.items() if count >= needed]
+
+    def find(self, name: str, cutoff: int = FUZZY_NAME_CUTOFF) -> Optional[NameEntry]:
+        exact = self.exact.get(name.lower())
+        if exact:
+            return exact
+        key = _name_key(name)
+        if not key:
+            return None
+        if key in self.by_key:
+            return self.by_key[key]
+        best, best_score = None, cutoff - 1
+        for idx in sorted(self.candidates(key, cutoff)):
+            entry = self.entries[idx]
+            score = fuzz.ratio(key, entry.key)
+            # Index order puts current members first, so they win ties
+            if score > best_score:
+                best, best_score = entry, score
+        return best
+
+name_index_lock = Lock()
+
+def get_name_index() -> MemberNameIndex:
+    roster = rosters.for_group()
+    roster.refresh()
+    version = (roster.generation, former_members.generation())
+    with name_index_lock:
+        if roster.name_index is None or version != roster.name_index_version:
+            roster.name_index = MemberNameIndex(roster.members, dict(former_members.items()))
+            roster.name_index_version = version
+        return roster.name_index
+
 def fuzzy_find_member(target_alias: str) -> Optional[Tuple[str, str]]:
     if not target_alias or len(target_alias.strip()) < 2:
         return None
@@ -757,36 +2814,16 @@ def fuzzy_find_member(target_alias: str) -> Optional[Tuple[str, str]]:
     if target_clean.startswith('@'):
         target_clean = target_clean[1:]
 
-    members = get_group_members()
-    # Exact match first
-    for m in members:
-        nick = m.get("nickname", "")
-        if nick and nick.lower() == target_clean.lower():
-            return (str(m.get("user_id")), nick)
-
-    # High-score fuzzy
-    nicknames = [m.get("nickname", "") for m in members if m.get("nickname")]
-    if not nicknames:
-        return None
-    nick_lower = [n.lower() for n in nicknames]
-    match = process.extractOne(target_clean, nick_lower, score_cutoff=92, scorer=fuzz.token_sort_ratio)
-    if match:
-        matched_lower, score = match
-        idx = nick_lower.index(matched_lower)
-        return (str(members[idx].get("user_id")), nicknames[idx])
-
-    # Former members
-    for uid, nick in former_members.items():
-        if nick.lower() == target_clean.lower():
-            return (str(uid), nick)
-
+    entry = get_name_index().find(target_clean)
+    if entry:
+        return (entry.user_id, entry.nickname)
     return None
 
 # -----------------------
 # Admin Commands
 # -----------------------
 def get_user_id(target_alias: str, sender_name: str, sender_id: str, original_text: str) -> bool:
-    if str(sender_id) not in ADMIN_IDS:
+    if not is_group_admin(sender_id):
         send_system_message(f"> @{sender_name}: {original_text}\nError: Only admins can use this command")
         return False
     result = fuzzy_find_member(target_alias)
@@ -799,13 +2836,14 @@ def get_user_id(target_alias: str, sender_name: str, sender_id: str, original_te
 
 def unban_user(target_user_id: str, sender: str, sender_id: str, full_text: str) -> None:
     """
-    Now accepts user_id directly (no fuzzy lookup)
+    Now accepts user_id directly (no fuzzy lookup). The re-add itself runs as
+    a membership job; this only validates and queues it.
     """
     try:
-        if str(sender_id) not in ADMIN_IDS:
+        if not is_group_admin(sender_id):
             send_system_message(f"> @{sender}: {full_text}\nError: Only admins can use this command")
             return
-        if not ACCESS_TOKEN or not GROUP_ID:
+        if not ACCESS_TOKEN or not current_group().group_id:
             send_system_message(f"> @{sender}: {full_text}\nError: Missing ACCESS_TOKEN or GROUP_ID")
             return
 
@@ -815,117 +2853,18 @@ def unban_user(target_user_id: str, sender: str, sender_id: str, full_text: str)
             send_system_message(f"> @{sender}: {full_text}\nNo record of user `{match_user_id}` in banned/former list.")
             return
 
-        safe_name = re.sub(r"[^A-Za-z0-9 _\\-]", "", match_nickname)[:30] or "User"
-        logger.info(f"Attempting to unban {match_nickname} ({match_user_id})")
-
-        def attempt_add(nick_to_add: str) -> Tuple[bool, int]:
-            payload = {"members": [{"nickname": nick_to_add, "user_id": match_user_id}]}
-            try:
-                resp = requests.post(
-                    f"{API_URL}/groups/{GROUP_ID}/members/add",
-                    headers={"X-Access-Token": ACCESS_TOKEN},
-                    json=payload,
-                    timeout=12
-                )
-            except Exception as e:
-                logger.error(f"HTTP add attempt error: {e}")
-                return False, 0
-            if resp.status_code not in (200, 202):
-                logger.warning(f"Unban HTTP error {resp.status_code}: {resp.text}")
-                return False, resp.status_code
-            try:
-                data = resp.json()
-            except Exception:
-                time.sleep(3)
-                new_members = get_group_members()
-                return (any(str(m.get("user_id")) == match_user_id for m in new_members), 0)
-            results_id = data.get('response', {}).get('results_id')
-            if not results_id:
-                time.sleep(3)
-                new_members = get_group_members()
-                return (any(str(m.get("user_id")) == match_user_id for m in new_members), 0)
-            max_polls = 15
-            for attempt in range(max_polls):
-                sleep_time = 2 if attempt > 0 else 1
-                time.sleep(sleep_time)
-                try:
-                    poll_resp = requests.get(
-                        f"{API_URL}/groups/{GROUP_ID}/members/results/{results_id}",
-                        headers={"X-Access-Token": ACCESS_TOKEN},
-                        timeout=8
-                    )
-                except Exception as e:
-                    logger.error(f"Poll HTTP error on attempt {attempt + 1}: {e}")
-                    continue
-                if poll_resp.status_code == 200:
-                    try:
-                        results_data = poll_resp.json().get('response', {})
-                        added_members = results_data.get('members', [])
-                        if any(str(m.get('user_id')) == match_user_id for m in added_members):
-                            logger.info(f"User found in poll results for {nick_to_add}")
-                            return True, 0
-                    except Exception as e:
-                        logger.error(f"Failed parsing poll JSON: {e}")
-                elif poll_resp.status_code == 404:
-                    break
-                elif poll_resp.status_code == 503:
-                    continue
-            return False, 408
-
-        success, status_code = attempt_add(safe_name)
-        if success:
-            send_system_message(f"> @{sender}: {full_text}\n{match_nickname} re-added to the group.")
-            banned_users.pop(match_user_id, None)
-            save_json(banned_users_file, banned_users)
-            user_swear_counts.pop(match_user_id, None)
-            save_json(user_swear_counts_file, user_swear_counts)
-            user_strikes.pop(match_user_id, None)
-            save_json(strikes_file, user_strikes)
-            former_members.pop(match_user_id, None)
-            save_json(former_members_file, former_members)
-            return
-        time.sleep(6)
-        members_after = get_group_members()
-        if any(str(m.get("user_id")) == match_user_id for m in members_after):
-            send_system_message(f"> @{sender}: {full_text}\n{match_nickname} re-added to the group.")
-            banned_users.pop(match_user_id, None)
-            save_json(banned_users_file, banned_users)
-            user_swear_counts.pop(match_user_id, None)
-            save_json(user_swear_counts_file, user_swear_counts)
-            user_strikes.pop(match_user_id, None)
-            save_json(strikes_file, user_strikes)
-            former_members.pop(match_user_id, None)
-            save_json(former_members_file, former_members)
-            return
-        retry_name = re.sub(r"[^A-Za-z0-9]", "", safe_name)[:20] or "Member"
-        logger.warning(f"Primary unban failed; retrying with '{retry_name}'.")
-        success, _ = attempt_add(retry_name)
-        if success:
-            send_system_message(f"> @{sender}: {full_text}\n{retry_name} re-added after retry.")
-            banned_users.pop(match_user_id, None)
-            save_json(banned_users_file, banned_users)
-            user_swear_counts.pop(match_user_id, None)
-            save_json(user_swear_counts_file, user_swear_counts)
-            user_strikes.pop(match_user_id, None)
-            save_json(strikes_file, user_strikes)
-            former_members.pop(match_user_id, None)
-            save_json(former_members_file, former_members)
-            return
-        share_url = get_group_share_url()
-        error_msg = f"GroupMe sync delay, cooldown, or API failure (code {status_code})"
-        fallback_msg = f"Could not re-add {match_nickname}. {error_msg}. "
-        if share_url:
-            fallback_msg += f"Send them: {share_url}"
-        send_system_message(f"> @{sender}: {full_text}\n{fallback_msg}")
-    except Exception as e:
-        logger.error(f"unban_user error: {e}")
-        send_system_message(f"> @{sender}: {full_text}\nError unbanning user `{target_user_id}': {str(e)}")
+        job = start_unban_job(match_user_id, match_nickname, sender, full_text)
+        logger.info(f"Unban job {job['id']} queued for {match_nickname} ({match_user_id})")
+        send_system_message(f"> @{sender}: {full_text}\nRe-adding {match_nickname} (job `{job['id']}`, check with !job {job['id']})")
+    except Exception as e:
+        logger.error(f"unban_user error: {e}")
+        send_system_message(f"> @{sender}: {full_text}\nError unbanning user `{target_user_id}': {str(e)}")
 
 def ban_user_command(target_user_id: str, target_username: str, sender_name: str, sender_id: str, original_text: str) -> bool:
-    if str(sender_id) not in ADMIN_IDS:
+    if not is_group_admin(sender_id):
         send_system_message(f"> @{sender_name}: {original_text}\nError: Only admins can use this command")
         return False
-    if not ACCESS_TOKEN or not GROUP_ID:
+    if not ACCESS_TOKEN or not current_group().group_id:
         send_system_message(f"> @{sender_name}: {original_text}\nError: Missing ACCESS_TOKEN or GROUP_ID")
         return False
     success = call_ban_service(target_user_id, target_username, "Admin ban command")
@@ -936,26 +2875,417 @@ def ban_user_command(target_user_id: str, target_username: str, sender_name: str
     return success
 
 def record_strike(target_user_id: str, target_nickname: str, admin_name: str, admin_id: str, original_text: str) -> None:
-    if str(admin_id) not in ADMIN_IDS:
+    if not is_group_admin(admin_id):
         send_system_message(f"> @{admin_name}: {original_text}\nError: Only admins can issue 'strike' commands.")
         return
     user_id = str(target_user_id)
-    if user_id not in user_strikes:
-        user_strikes[user_id] = 0
-    user_strikes[user_id] += 1
-    save_json(strikes_file, user_strikes)
-    count = user_strikes[user_id]
+    count = user_strikes.incr(user_id)
     logger.info(f"Recorded strike for {target_nickname} ({user_id}) — total strikes: {count}")
     send_system_message(f"> @{admin_name}: {original_text}\nStrike recorded for {target_nickname} ({user_id}). Total strikes: {count}")
 
 def get_strikes_report(target_user_id: str, target_nickname: str, requester_name: str, requester_id: str, original_text: str) -> None:
-    if str(requester_id) not in ADMIN_IDS:
+    if not is_group_admin(requester_id):
         send_system_message(f"> @{requester_name}: {original_text}\nError: Only admins can use '!strikes' command.")
         return
     user_id = str(target_user_id)
     count = int(user_strikes.get(user_id, 0))
     send_system_message(f"> @{requester_name}: {original_text}\n{target_nickname} ({user_id}) has {count} strike(s).")
 
+# -----------------------
+# Membership Jobs
+# -----------------------
+# Re-adding a member is asynchronous on GroupMe's side: members/add hands back
+# a results_id that has to be polled. Each unban is a row in membership_jobs
+# that one poller thread advances a step at a time (add -> poll -> verify,
+# then once more with a plainer nickname), backing off exponentially between
+# polls. Nothing sleeps in a webhook or dispatcher thread, and jobs left
+# pending by a restart are picked up again at import.
+MEMBERSHIP_POLL_BASE = 1.0
+MEMBERSHIP_POLL_CAP = 16.0
+MEMBERSHIP_MAX_POLLS = 7
+MEMBERSHIP_VERIFY_DELAY = 6.0
+MEMBERSHIP_JOB_RETENTION = 86400
+JOB_DONE_STATES = ("done", "failed")
+
+membership_jobs = open_state_map("membership_jobs", membership_jobs_file)
+_job_heap: List[Tuple[float, str]] = []
+_job_lock = Lock()
+_job_wakeup = threading.Event()
+_job_poller_started = False
+
+def start_unban_job(user_id: str, nickname: str, sender: str, full_text: str) -> Dict[str, Any]:
+    safe_name = re.sub(r"[^A-Za-z0-9 _\\-]", "", nickname)[:30] or "User"
+    retry_name = re.sub(r"[^A-Za-z0-9]", "", safe_name)[:20] or "Member"
+    now = time.time()
+    _prune_membership_jobs(now)
+    job = {
+        "id": os.urandom(3).hex(), "kind": "unban", "group_id": current_group().group_id,
+        "user_id": str(user_id), "nickname": nickname,
+        "names": [safe_name, retry_name], "name_idx": 0, "state": "add", "results_id": None,
+        "polls": 0, "status_code": 0, "detail": "", "requested_by": sender, "request_text": full_text,
+        "created_at": now, "updated_at": now, "next_at": now,
+    }
+    membership_jobs[job["id"]] = job
+    _schedule_job(job)
+    return job
+
+def _prune_membership_jobs(now: float) -> None:
+    for job_id, job in list(membership_jobs.items()):
+        if job.get("state") in JOB_DONE_STATES and now - job.get("updated_at", 0) > MEMBERSHIP_JOB_RETENTION:
+            del membership_jobs[job_id]
+
+def _schedule_job(job: Dict[str, Any]) -> None:
+    with _job_lock:
+        heapq.heappush(_job_heap, (job["next_at"], job["id"]))
+    _start_job_poller_once()
+    _job_wakeup.set()
+
+def _job_wait(job: Dict[str, Any], state: str, delay: float) -> None:
+    job["state"] = state
+    job["next_at"] = time.time() + delay
+
+def _job_add(job: Dict[str, Any]) -> None:
+    name = job["names"][job["name_idx"]]
+    try:
+        resp = http_request(
+            "POST",
+            f"{API_URL}/groups/{current_group().group_id}/members/add",
+            headers={"X-Access-Token": ACCESS_TOKEN},
+            json={"members": [{"nickname": name, "user_id": job["user_id"]}]},
+            timeout=12
+        )
+    except Exception as e:
+        logger.error(f"Job {job['id']}: add error: {e}")
+        job["status_code"] = 0
+        return _job_wait(job, "verify", MEMBERSHIP_VERIFY_DELAY)
+    if resp.status_code not in (200, 202):
+        logger.warning(f"Job {job['id']}: add HTTP error {resp.status_code}: {resp.text}")
+        job["status_code"] = resp.status_code
+        return _job_wait(job, "verify", MEMBERSHIP_VERIFY_DELAY)
+    try:
+        results_id = resp.json().get("response", {}).get("results_id")
+    except Exception:
+        results_id = None
+    if not results_id:
+        return _job_wait(job, "verify", 3)
+    job["results_id"] = results_id
+    job["polls"] = 0
+    _job_wait(job, "poll", MEMBERSHIP_POLL_BASE)
+
+def _job_poll(job: Dict[str, Any]) -> None:
+    try:
+        resp = http_request(
+            "GET",
+            f"{API_URL}/groups/{current_group().group_id}/members/results/{job['results_id']}",
+            headers={"X-Access-Token": ACCESS_TOKEN},
+            timeout=8
+        )
+        if resp.status_code == 200:
+            added = resp.json().get("response", {}).get("members", [])
+            if any(str(m.get("user_id")) == job["user_id"] for m in added):
+                return _finish_job(job, True)
+        elif resp.status_code == 404:
+            # Results expired or were never recorded; check the roster instead
+            return _job_wait(job, "verify", MEMBERSHIP_VERIFY_DELAY)
+    except Exception as e:
+        logger.error(f"Job {job['id']}: poll {job['polls'] + 1} error: {e}")
+    job["polls"] += 1
+    if job["polls"] >= MEMBERSHIP_MAX_POLLS:
+        job["status_code"] = 408
+        return _job_wait(job, "verify", MEMBERSHIP_VERIFY_DELAY)
+    _job_wait(job, "poll", min(MEMBERSHIP_POLL_CAP, MEMBERSHIP_POLL_BASE * 2 ** job["polls"]))
+
+def _job_verify(job: Dict[str, Any]) -> None:
+    if is_group_member(job["user_id"], fresh=True):
+        return _finish_job(job, True)
+    if job["name_idx"] + 1 < len(job["names"]):
+        job["name_idx"] += 1
+        logger.warning(f"Job {job['id']}: primary re-add failed; retrying with '{job['names'][job['name_idx']]}'.")
+        return _job_wait(job, "add", 0)
+    _finish_job(job, False)
+
+def _finish_job(job: Dict[str, Any], success: bool) -> None:
+    prefix = f"> @{job['requested_by']}: {job['request_text']}\n"
+    uid = job["user_id"]
+    if success:
+        job["state"] = "done"
+        if job["name_idx"] == 0:
+            job["detail"] = f"{job['nickname']} re-added to the group."
+        else:
+            job["detail"] = f"{job['names'][job['name_idx']]} re-added after retry."
+        banned_users.pop(uid, None)
+        user_swear_counts.pop(uid, None)
+        user_strikes.pop(uid, None)
+        former_members.pop(uid, None)
+        invalidate_roster()
+        send_system_message(prefix + job["detail"])
+        return
+    job["state"] = "failed"
+    share_url = get_group_share_url()
+    job["detail"] = (f"Could not re-add {job['nickname']}. GroupMe sync delay, cooldown, "
+                     f"or API failure (code {job['status_code']}). ")
+    if share_url:
+        job["detail"] += f"Send them: {share_url}"
+    send_system_message(prefix + job["detail"])
+
+JOB_STEPS = {"add": _job_add, "poll": _job_poll, "verify": _job_verify}
+
+def job_group(job: Dict[str, Any]) -> GroupConfig:
+    return GROUPS.get(str(job.get("group_id", DEFAULT_GROUP.group_id)), DEFAULT_GROUP)
+
+def group_jobs() -> List[Dict[str, Any]]:
+    group_id = current_group().group_id
+    return [job for job in membership_jobs.values() if job_group(job).group_id == group_id]
+
+def _run_job_step(job_id: str, scheduled_at: float) -> None:
+    job = membership_jobs.get(job_id)
+    # Superseded heap entries (the job moved on or finished) are skipped
+    if not job or job["state"] in JOB_DONE_STATES or job["next_at"] != scheduled_at:
+        return
+    with use_group(job_group(job)):
+        _advance_job(job_id, job)
+
+def _advance_job(job_id: str, job: Dict[str, Any]) -> None:
+    # Another worker sharing the job table may be on this step already
+    if not shared_state.set(f"job:{job_id}", time.time(), ex=60, nx=True):
+        job["next_at"] = time.time() + MEMBERSHIP_POLL_BASE
+        # Stored before scheduling: the poller matches next_at against the stored job
+        membership_jobs[job_id] = job
+        _schedule_job(job)
+        return
+    try:
+        JOB_STEPS[job["state"]](job)
+    except Exception as e:
+        logger.exception(f"Job {job_id} step '{job['state']}' failed: {e}")
+        _finish_job(job, False)
+    finally:
+        shared_state.delete(f"job:{job_id}")
+    job["updated_at"] = time.time()
+    membership_jobs[job_id] = job
+    if job["state"] not in JOB_DONE_STATES:
+        _schedule_job(job)
+
+def _membership_poller() -> None:
+    while True:
+        _job_wakeup.clear()
+        with _job_lock:
+            due = _job_heap[0] if _job_heap else None
+            if due and due[0] <= time.time():
+                heapq.heappop(_job_heap)
+        if due is None:
+            _job_wakeup.wait()
+        elif due[0] > time.time():
+            _job_wakeup.wait(due[0] - time.time())
+        else:
+            try:
+                _run_job_step(due[1], due[0])
+            except Exception as e:
+                logger.error(f"Membership poller error: {e}")
+
+def _start_job_poller_once() -> None:
+    global _job_poller_started
+    if _job_poller_started:
+        return
+    with _job_lock:
+        if _job_poller_started:
+            return
+        _job_poller_started = True
+    threading.Thread(target=_membership_poller, name="membership-jobs", daemon=True).start()
+
+def resume_membership_jobs() -> int:
+    pending = [job for job in membership_jobs.values() if job.get("state") not in JOB_DONE_STATES]
+    for job in pending:
+        _schedule_job(job)
+    if pending:
+        logger.info(f"Resumed {len(pending)} membership job(s)")
+    return len(pending)
+
+def format_job(job: Dict[str, Any]) -> str:
+    age = int(time.time() - job.get("created_at", time.time()))
+    line = f"`{job['id']}` {job['kind']} {job['nickname']} ({job['user_id']}) – {job['state']}"
+    if job["state"] == "poll":
+        line += f", poll {job['polls'] + 1}/{MEMBERSHIP_MAX_POLLS}"
+    line += f", {age}s ago"
+    if job.get("detail"):
+        line += f"\n  {job['detail']}"
+    return line
+
+resume_membership_jobs()
+
+# -----------------------
+# Bulk Moderation
+# -----------------------
+# Raid cleanup: resolve every target against one roster snapshot, then fan
+# the removals and message deletions out over a bounded pool (no larger than
+# the per-host HTTP pool) and answer with a single summary.
+BULK_MODERATION_WORKERS = int(os.getenv("BULK_MODERATION_WORKERS", str(min(8, HTTP_POOL_SIZE))))
+
+def resolve_bulk_targets(data: Dict, command_text: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """@-mentions, user ids and comma-separated names after the command. Returns (targets, unresolved)."""
+    text = command_text or ""
+    targets: "OrderedDict[str, str]" = OrderedDict()
+    blanked = list(text)
+    for att in data.get("attachments", []):
+        if att.get("type") != "mentions":
+            continue
+        for uid, (start, length) in zip(att.get("user_ids", []), att.get("loci", [])):
+            targets.setdefault(str(uid), text[start:start + length].lstrip('@').strip())
+            blanked[start:start + length] = " " * length
+
+    unresolved = []
+    remainder = "".join(blanked).split(None, 1)
+    names = remainder[1].split(",") if len(remainder) > 1 else []
+    for raw in names:
+        name = raw.strip().lstrip('@').strip()
+        if not name:
+            continue
+        if name.isdigit():
+            member = get_roster_member(name)
+            targets.setdefault(name, (member or {}).get("nickname") or former_members.get(name) or name)
+            continue
+        found = fuzzy_find_member(name)
+        if found:
+            targets.setdefault(found[0], found[1])
+        else:
+            unresolved.append(name)
+    return list(targets.items()), unresolved
+
+def mass_ban(targets: List[Tuple[str, str]], unresolved: List[str], sender: str, reason: str,
+             purge: bool = True) -> Dict[str, Any]:
+    """Remove every target and delete their cached messages; posts one summary."""
+    refresh_roster()
+    result = {"banned": [], "failed": [], "skipped": [], "deleted": 0, "unresolved": list(unresolved)}
+    jobs = []
+    for uid, name in targets:
+        member = rosters.by_user_id.get(uid)
+        if is_group_admin(uid) or member is None:
+            result["skipped"].append(name)
+            continue
+        jobs.append((uid, member.get("nickname") or name, member.get("id")))
+
+    message_ids = recent_message_ids_by(uid for uid, _, _ in jobs) if purge else []
+    started = time.time()
+    if jobs or message_ids:
+        with ThreadPoolExecutor(max_workers=BULK_MODERATION_WORKERS, thread_name_prefix="bulk-mod") as pool:
+            ban, delete = bind_group(call_ban_service), bind_group(delete_message)
+            bans = [(name, pool.submit(ban, uid, name, reason, membership_id, False))
+                    for uid, name, membership_id in jobs]
+            deletes = [pool.submit(delete, msg_id) for msg_id in message_ids]
+            for name, future in bans:
+                result["banned" if future.result() else "failed"].append(name)
+            result["deleted"] = sum(1 for future in deletes if future.result())
+        invalidate_roster()
+
+    elapsed = time.time() - started
+    summary = f"**MASS BAN** by @{sender}: banned {len(result['banned'])}/{len(jobs)} in {elapsed:.1f}s"
+    if purge:
+        summary += f", deleted {result['deleted']}/{len(message_ids)} recent messages"
+    for label, key in (("Failed", "failed"), ("Skipped (admin or not in group)", "skipped"), ("Not found", "unresolved")):
+        if result[key]:
+            summary += f"\n{label}: {', '.join(result[key][:20])}" + (" …" if len(result[key]) > 20 else "")
+    logger.info(f"Mass ban by {sender}: {len(result['banned'])} banned, {len(result['failed'])} failed, "
+                f"{result['deleted']} messages deleted in {elapsed:.1f}s")
+    send_system_message(summary)
+    return result
+
+# -----------------------
+# Profanity Matcher
+# -----------------------
+# Both word lists are compiled into one trie-shaped regex, so a message is
+# scanned once in C instead of once per word. "token" mode matches whole
+# words after stripping punctuation (the moderation rule); "substring" mode
+# matches anywhere (the AI search filter).
+TOKEN_STRIP_CHARS = '.,!?"\'()[]{}'
+PROFANITY_RELOAD_SECONDS = 5
+
+class ProfanityHit(NamedTuple):
+    word: str
+    category: str  # "instant" or "regular"
+    start: int
+    end: int
+
+_profanity_lock = Lock()
+_profanity_categories: Dict[str, str] = {}
+_profanity_token_re: Optional["re.Pattern"] = None
+_profanity_substring_re: Optional["re.Pattern"] = None
+_profanity_file_mtime: Optional[float] = None
+_profanity_checked_at = 0.0
+
+def _trie_regex(words: List[str]) -> str:
+    if not words:
+        return "(?!)"
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def walk(node: Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + walk(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Greedy optional tail: the longest word wins at each position
+        return f"(?:{body})?" if "" in node else body
+
+    return walk(trie)
+
+def compile_profanity_matcher() -> None:
+    """Rebuild the automaton from INSTANT_BAN_WORDS / REGULAR_SWEAR_WORDS."""
+    global _profanity_categories, _profanity_token_re, _profanity_substring_re
+    categories: Dict[str, str] = {}
+    for word in REGULAR_SWEAR_WORDS:
+        categories[word.lower()] = "regular"
+    for word in INSTANT_BAN_WORDS:
+        categories[word.lower()] = "instant"
+    # Whitespace-split tokens can never contain a space, so multi-word
+    # entries only take part in substring matching
+    token_words = [w for w in categories if w and not any(ch.isspace() for ch in w)]
+    strip = "[" + re.escape(TOKEN_STRIP_CHARS) + "]*"
+    token_re = re.compile(rf"(?<!\S){strip}({_trie_regex(token_words)}){strip}(?!\S)")
+    substring_re = re.compile(f"({_trie_regex([w for w in categories if w])})")
+    with _profanity_lock:
+        _profanity_categories = categories
+        _profanity_token_re = token_re
+        _profanity_substring_re = substring_re
+    logger.info(f"Profanity matcher compiled ({len(categories)} words)")
+
+def reload_profanity_lists(force: bool = False) -> bool:
+    """Pick up swear_words.json edits. Returns True if the lists changed."""
+    global _profanity_file_mtime, _profanity_checked_at
+    _profanity_checked_at = time.time()
+    try:
+        mtime = os.path.getmtime(swear_words_file) if os.path.exists(swear_words_file) else None
+    except OSError:
+        mtime = None
+    if not force and mtime == _profanity_file_mtime:
+        return False
+    _profanity_file_mtime = mtime
+    if mtime is not None:
+        data = load_json(swear_words_file)
+        if isinstance(data.get("instant"), list):
+            INSTANT_BAN_WORDS[:] = [str(w).lower() for w in data["instant"]]
+        if isinstance(data.get("regular"), list):
+            REGULAR_SWEAR_WORDS[:] = [str(w).lower() for w in data["regular"]]
+    compile_profanity_matcher()
+    return True
+
+def scan_profanity(text: str, mode: str = "token", first_only: bool = False) -> List[ProfanityHit]:
+    if time.time() - _profanity_checked_at > PROFANITY_RELOAD_SECONDS:
+        reload_profanity_lists()
+    pattern = _profanity_token_re if mode == "token" else _profanity_substring_re
+    categories = _profanity_categories
+    hits = []
+    for match in pattern.finditer((text or "").lower()):
+        word = match.group(1)
+        hits.append(ProfanityHit(word, categories.get(word, "regular"), match.start(1), match.end(1)))
+        if first_only:
+            break
+    return hits
+
+reload_profanity_lists(force=True)
+
 # -----------------------
 # Violation Detection with Deletion
 # -----------------------
@@ -964,106 +3294,223 @@ def check_for_violations(text: str, user_id: str, username: str, message_id: str
     now = time.time()
     deleted = False
 
-    if uid in muted_users and now < muted_users[uid]:
-        minutes_left = int((muted_users[uid] - now) / 60) + 1
+    mute_scheduler.expire_due(now)
+    mute_left = mute_scheduler.remaining(uid, now)
+    if mute_left:
+        minutes_left = int(mute_left / 60) + 1
         _delete_message_by_id(message_id)
         logger.info(f"MUTED MSG DELETED: {username} ({uid}), {minutes_left}m left")
         deleted = True
         return deleted
 
-    expired = [u for u, until in list(muted_users.items()) if now >= until]
-    for u in expired:
-        del muted_users[u]
-    if expired:
-        logger.info(f"Cleaned {len(expired)} expired mutes")
-
-    text_lower = text.lower()
-    text_words = text_lower.split()
-    for word in text_words:
-        clean_word = word.strip('.,!?"\'()[]{}').lower()
-        if clean_word in INSTANT_BAN_WORDS:
-            logger.info(f"INSTANT BAN: '{clean_word}' from {username} (msg {message_id})")
-            _delete_message_by_id(message_id)
-            success = call_ban_service(uid, username, f"Instant ban: {clean_word}")
-            if success:
-                send_system_message(f"{username} has been permanently banned for using prohibited language. (Message deleted)")
-            deleted = True
-            return True
+    # One pass over the message finds both categories; instant bans win
+    hits = scan_profanity(text, mode="token")
+    instant = next((h for h in hits if h.category == "instant"), None)
+    if instant:
+        clean_word = instant.word
+        logger.info(f"INSTANT BAN: '{clean_word}' from {username} (msg {message_id})")
+        _delete_message_by_id(message_id)
+        dispatch(PRIORITY_MODERATION, _ban_and_announce, uid, username, f"Instant ban: {clean_word}",
+                 f"{username} has been permanently banned for using prohibited language. (Message deleted)")
+        deleted = True
+        return True
 
-    for word in text_words:
-        clean_word = word.strip('.,!?"\'()[]{}').lower()
-        if clean_word in REGULAR_SWEAR_WORDS:
-            if uid not in user_swear_counts:
-                user_swear_counts[uid] = 0
-            user_swear_counts[uid] += 1
-            save_json(user_swear_counts_file, user_swear_counts)
-            current_count = user_swear_counts[uid]
-            logger.info(f"{username} swear count: {current_count}/10 (msg {message_id})")
-            _delete_message_by_id(message_id)
-            if current_count >= 10:
-                success = call_ban_service(uid, username, f"10 strikes - swear words")
-                if success:
-                    send_system_message(f"{username} has been banned for repeated inappropriate language (10 strikes). (Message deleted)")
-                    user_swear_counts[uid] = 0
-                    save_json(user_swear_counts_file, user_swear_counts)
-                deleted = True
-                return True
-            else:
-                remaining = 10 - current_count
-                send_system_message(f"{username} ({uid}) - Warning {current_count}/10 for inappropriate language. {remaining} more and you're banned! (Message deleted)")
+    if any(h.category == "regular" for h in hits):
+        current_count = user_swear_counts.incr(uid)
+        logger.info(f"{username} swear count: {current_count}/10 (msg {message_id})")
+        _delete_message_by_id(message_id)
+        if current_count >= 10:
+            # call_ban_service clears the swear count once the ban lands
+            dispatch(PRIORITY_MODERATION, _ban_and_announce, uid, username, f"10 strikes - swear words",
+                     f"{username} has been banned for repeated inappropriate language (10 strikes). (Message deleted)")
             deleted = True
-            break
+            return True
+        else:
+            remaining = 10 - current_count
+            send_system_message(f"{username} ({uid}) - Warning {current_count}/10 for inappropriate language. {remaining} more and you're banned! (Message deleted)")
+        deleted = True
     return deleted
 
 # -----------------------
-# Message Sending
+# Outbound Dispatcher
 # -----------------------
-def send_system_message(text: str) -> bool:
-    global last_system_message_time, system_messages_enabled
-    if not BOT_ID:
-        logger.error("No BOT_ID configured")
-        return False
-    is_strike_or_ban = any(k in text for k in ["Warning", "banned", "Strike", "ban", "deleted"])
-    if not is_strike_or_ban and not system_messages_enabled:
-        return False
-    now = time.time()
-    if not is_strike_or_ban and now - last_system_message_time < cooldown_seconds:
+# Every GroupMe side effect is queued here and run by a small worker pool, so
+# webhook() never waits on the network. Lower number = served first.
+PRIORITY_MODERATION = 0  # deletes, bans, strike/ban notices
+PRIORITY_NORMAL = 1      # command replies, warnings, karma, DMs
+PRIORITY_FUN = 2         # fun replies, !pixel, !google, leaderboards
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "500"))
+DISPATCH_DRAIN_SECONDS = 5
+
+_dispatch_queue: "queue.PriorityQueue" = queue.PriorityQueue(maxsize=DISPATCH_QUEUE_SIZE)
+# asgi.py installs a handler here that sends jobs with an async twin from its
+# event loop. It returns True (queued), False (dropped) or None (not async-capable)
+_async_dispatch = None
+_dispatch_seq = itertools.count()
+_dispatch_lock = Lock()
+_dispatch_started = False
+_dispatch_stats: Dict[str, Any] = {
+    "enqueued": 0, "completed": 0, "failed": 0, "dropped": 0, "inline": 0,
+    "max_depth": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0,
+}
+
+def _run_dispatch_job(func, args, kwargs, on_done) -> None:
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        logger.exception(f"Dispatch job {getattr(func, '__name__', func)} failed: {e}")
+        with _dispatch_lock:
+            _dispatch_stats["failed"] += 1
+        return
+    with _dispatch_lock:
+        _dispatch_stats["completed"] += 1
+    if on_done:
+        try:
+            on_done(result)
+        except Exception as e:
+            logger.exception(f"Dispatch callback failed: {e}")
+
+def _dispatch_worker() -> None:
+    while True:
+        _, _, queued_at, func, args, kwargs, on_done = _dispatch_queue.get()
+        waited = time.time() - queued_at
+        with _dispatch_lock:
+            _dispatch_stats["wait_seconds_total"] += waited
+            _dispatch_stats["wait_seconds_max"] = max(_dispatch_stats["wait_seconds_max"], waited)
+        try:
+            _run_dispatch_job(func, args, kwargs, on_done)
+        finally:
+            _dispatch_queue.task_done()
+
+def start_dispatcher_once() -> None:
+    # Started lazily so gunicorn workers spawn their threads after forking
+    global _dispatch_started
+    if _dispatch_started:
+        return
+    with _dispatch_lock:
+        if _dispatch_started:
+            return
+        for i in range(DISPATCH_WORKERS):
+            threading.Thread(target=_dispatch_worker, name=f"dispatch-{i}", daemon=True).start()
+        _dispatch_started = True
+    logger.info(f"Dispatcher started ({DISPATCH_WORKERS} workers, queue {DISPATCH_QUEUE_SIZE}).")
+
+def dispatch(priority: int, func, *args, on_done=None, **kwargs) -> bool:
+    """
+    Queue func(*args, **kwargs) for a dispatcher worker.
+    When the queue is full, fun jobs are dropped and everything else runs
+    inline so moderation is never lost. Non-moderation jobs also count
+    against the group's outbound budget and are dropped once it is spent.
+    Returns False only when dropped.
+    """
+    if priority > PRIORITY_MODERATION and not take_outbound_budget():
+        inc("outbound_budget_dropped_total", group=current_group().group_id)
+        logger.warning(f"Outbound budget spent for group {current_group().group_id}, dropped {getattr(func, '__name__', func)}")
         return False
-    url = "https://api.groupme.com/v3/bots/post"
-    payload = {"bot_id": BOT_ID, "text": text}
+    if _async_dispatch is not None:
+        taken = _async_dispatch(priority, func, args, kwargs, on_done)
+        if taken is not None:
+            return taken
+    if DISPATCH_WORKERS <= 0:
+        with _dispatch_lock:
+            _dispatch_stats["inline"] += 1
+        _run_dispatch_job(func, args, kwargs, on_done)
+        return True
+    start_dispatcher_once()
+    # Workers are shared by every group; the job carries the group it was queued for
+    item = (priority, next(_dispatch_seq), time.time(), bind_group(func), args, kwargs, on_done)
     try:
-        response = requests.post(url, json=payload, timeout=8)
+        _dispatch_queue.put_nowait(item)
+    except queue.Full:
+        if priority >= PRIORITY_FUN:
+            with _dispatch_lock:
+                _dispatch_stats["dropped"] += 1
+            logger.warning(f"Dispatch queue full, dropped {getattr(func, '__name__', func)}")
+            return False
+        with _dispatch_lock:
+            _dispatch_stats["inline"] += 1
+        logger.warning(f"Dispatch queue full, running {getattr(func, '__name__', func)} inline")
+        _run_dispatch_job(func, args, kwargs, on_done)
+        return True
+    with _dispatch_lock:
+        _dispatch_stats["enqueued"] += 1
+        _dispatch_stats["max_depth"] = max(_dispatch_stats["max_depth"], _dispatch_queue.qsize())
+    return True
+
+def dispatcher_stats() -> Dict[str, Any]:
+    with _dispatch_lock:
+        stats = dict(_dispatch_stats)
+    stats["depth"] = _dispatch_queue.qsize()
+    stats["capacity"] = DISPATCH_QUEUE_SIZE
+    stats["workers"] = DISPATCH_WORKERS
+    stats["utilization"] = stats["depth"] / DISPATCH_QUEUE_SIZE if DISPATCH_QUEUE_SIZE else 0.0
+    finished = stats["completed"] + stats["failed"]
+    stats["wait_seconds_avg"] = stats["wait_seconds_total"] / finished if finished else 0.0
+    return stats
+
+def _drain_dispatcher() -> None:
+    deadline = time.time() + DISPATCH_DRAIN_SECONDS
+    while _dispatch_started and _dispatch_queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+
+atexit.register(_drain_dispatcher)
+
+# -----------------------
+# Message Sending
+# -----------------------
+def _post_bot_message(text: str, kind: str) -> bool:
+    url = f"{GROUPME_API}/bots/post"
+    payload = {"bot_id": current_group().bot_id, "text": text}
+    try:
+        response = http_request("POST", url, json=payload, timeout=8)
         response.raise_for_status()
-        if not is_strike_or_ban:
-            last_system_message_time = now
-        logger.info(f"System message sent: {text[:80]}")
+        logger.info(f"{kind} message sent: {text[:80]}")
         return True
     except Exception as e:
         logger.error(f"GroupMe send error: {e}")
         return False
 
-def send_message(text: str) -> bool:
-    global last_sent_time, system_messages_enabled
-    if not system_messages_enabled:
+# The send helpers queue a job on the dispatcher and return whether it was
+# queued (False: skipped by toggle/cooldown/budget, or dropped), not whether
+# GroupMe accepted it. Pass on_done(success) to learn the delivery outcome.
+def send_system_message(text: str, urgent: bool = False, on_done=None) -> bool:
+    if not current_group().bot_id:
+        logger.error("No BOT_ID configured")
         return False
-    now = time.time()
-    if now - last_sent_time < cooldown_seconds:
+    # urgent: moderation alerts that must not be swallowed by the toggle/cooldown
+    is_strike_or_ban = urgent or any(k in text for k in ["Warning", "banned", "Strike", "ban", "deleted"])
+    if not is_strike_or_ban and not load_system_messages_enabled():
         return False
-    if not BOT_ID:
+    if is_strike_or_ban:
+        return dispatch(PRIORITY_MODERATION, _post_bot_message, text, "System", on_done=on_done)
+    # The cooldown lives in shared state so N workers still post at most once per window
+    finished = claim_cooldown_send("system", cooldown_seconds, on_done)
+    if finished is None:
         return False
-    url = "https://api.groupme.com/v3/bots/post"
-    payload = {"bot_id": BOT_ID, "text": text}
-    try:
-        response = requests.post(url, json=payload, timeout=8)
-        response.raise_for_status()
-        last_sent_time = now
-        logger.info(f"Regular message sent: {text[:80]}")
+    if dispatch(PRIORITY_NORMAL, _post_bot_message, text, "System", on_done=finished):
         return True
-    except Exception as e:
-        logger.error(f"GroupMe send error: {e}")
+    finished(None)
+    return False
+
+def send_message(text: str, on_done=None) -> bool:
+    if not load_system_messages_enabled():
+        return False
+    if not current_group().bot_id:
+        return False
+    finished = claim_cooldown_send("regular", cooldown_seconds, on_done)
+    if finished is None:
         return False
+    if dispatch(PRIORITY_FUN, _post_bot_message, text, "Regular", on_done=finished):
+        return True
+    finished(None)
+    return False
+
+def send_dm(recipient_id: str, text: str, on_done=None) -> bool:
+    return dispatch(PRIORITY_NORMAL, _send_dm_now, recipient_id, text, on_done=on_done)
 
-def send_dm(recipient_id: str, text: str) -> bool:
+def _send_dm_now(recipient_id: str, text: str) -> bool:
     url = f"{GROUPME_API}/direct_messages"
     payload = {
         "direct_message": {
@@ -1073,7 +3520,7 @@ def send_dm(recipient_id: str, text: str) -> bool:
         }
     }
     try:
-        response = requests.post(url, params={"token": ACCESS_TOKEN}, json=payload, timeout=8)
+        response = http_request("POST", url, params={"token": ACCESS_TOKEN}, json=payload, timeout=8)
         if response.status_code == 201:
             logger.info(f"DM sent to {recipient_id}: {text[:30]}")
             return True
@@ -1107,108 +3554,95 @@ def is_real_system_event(text_lower: str) -> bool:
 # -----------------------
 # Daily Leaderboard
 # -----------------------
-def _ensure_today_keys():
-    global daily_message_counts, last_message_by_user, daily_counts_date, last_messages_date
+def _ensure_today_keys() -> "DailyTracker":
+    tracker = daily_tracking.for_group()
     today = datetime.now().strftime("%Y-%m-%d")
-    if daily_counts_date != today:
-        daily_message_counts = {}
-        daily_counts_date = today
-        save_json(daily_counts_file, {"date": today, "counts": daily_message_counts})
-        logger.info("Reset daily_message_counts for new day.")
-    if last_messages_date != today:
-        last_message_by_user = {}
-        last_messages_date = today
-        save_json(last_messages_file, {"date": today, "last": last_message_by_user})
-        logger.info("Reset last_message_by_user for new day.")
+    if tracker.date != today:
+        tracker.reset(today)
+        logger.info("Reset daily_message_counts and last_message_by_user for new day.")
+    return tracker
 
 def increment_user_message_count(user_id: str, username: str, text: str) -> None:
     try:
-        _ensure_today_keys()
+        tracker = _ensure_today_keys()
         uid = str(user_id)
         normalized = (text or "").strip()
 
         with leaderboard_lock:
             # Always count the message — no duplicate suppression
-            daily_message_counts[uid] = daily_message_counts.get(uid, 0) + 1
+            tracker.counts[uid] = tracker.counts.get(uid, 0) + 1
+            tracker.ranking.update(uid, -tracker.counts[uid])
 
             # Update last message
-            last_message_by_user[uid] = normalized
+            tracker.last[uid] = normalized
 
-            # Atomic saves
-            safe_save_json(daily_counts_file, {"date": daily_counts_date, "counts": daily_message_counts})
-            safe_save_json(last_messages_file, {"date": daily_counts_date, "last": last_message_by_user})
+        # Atomic saves, coalesced by the write-behind flusher
+        schedule_save(tracker.counts_file, tracker.counts_snapshot)
+        schedule_save(tracker.last_file, tracker.last_snapshot)
 
     except Exception as e:
         logger.error(f"Error incrementing count: {e}")
 
+def apply_karma_vote(data: Dict[str, Any], sender_uid: str, change: int) -> None:
+    # Get the ID directly from the source message, not the nickname search
+    resolved = _get_user_id_from_reply(data)
+    if not resolved:
+        return
+    target_uid, target_nick = resolved
+    if target_uid == sender_uid or target_uid == "None":
+        logger.info("Karma ignored: Self-vote or invalid.")
+        return
+    score = record_karma_vote(target_uid, target_nick, change)
+    logger.info(f"Karma Success: {target_nick} is now {score}")
+
+def _display_name(uid: str, saved_name: Optional[str] = None) -> str:
+    # Priority: Group Nickname > JSONBin Saved Name > Former Member > Fallback ID
+    member = rosters.by_user_id.get(uid)
+    return (member or {}).get("nickname") or saved_name or former_members.get(uid) or f"User {uid}"
+
 def _build_leaderboard_message(top_n: int = 3) -> str:
     try:
-        _ensure_today_keys()
+        tracker = _ensure_today_keys()
         
         # --- THE SYNC STEP ---
-        # Pull the latest truth from JSONBin before displaying
-        global karma_history
-        refreshed_data = load_karma_from_bin()
-        if refreshed_data:
-            karma_history = refreshed_data
+        # Pull the latest truth from JSONBin if our copy is too old to display
+        refresh_karma_if_stale()
 
-        with leaderboard_lock:
-            members = get_group_members()
-            id_to_nick = {str(m.get("user_id")): m.get("nickname") for m in members if m.get("user_id")}
-            fallback = {str(k): v for k, v in former_members.items()}
+        with karma_lock:
+            board = _karma_board()
+            top_positive = board.positive.top(5)
+            top_negative = board.negative.top(5)
+        refresh_roster()
 
+        def saved_name(uid: str) -> Optional[str]:
+            entry = karma_history.get(uid)
+            return entry.get("name") if isinstance(entry, dict) else None
+
+        with leaderboard_lock:
             # --- SECTION A: DAILY MESSAGES ---
-            sorted_msgs = sorted(daily_message_counts.items(), key=lambda kv: (-int(kv[1]), kv[0]))
             lines = ["**Daily Unemployed Leaders:**"]
-            for rank, (uid, cnt) in enumerate(sorted_msgs[:top_n], 1):
-                name = id_to_nick.get(uid) or fallback.get(uid) or f"User {uid}"
-                lines.append(f"{rank}. {name} ({cnt})")
-
-            # --- PRE-PROCESS KARMA DATA ---
-            total_karma_scores = {}
-            for uid, val in karma_history.items():
-                if uid == "None" or not uid:
-                    continue
-                
-                # Handle nested dict {"score": X, "name": Y} vs flat integer
-                if isinstance(val, dict):
-                    total_karma_scores[uid] = val.get("score", 0)
-                else:
-                    try:
-                        total_karma_scores[uid] = int(val)
-                    except (ValueError, TypeError):
-                        total_karma_scores[uid] = 0
+            for rank, (uid, neg_count) in enumerate(tracker.ranking.top(top_n), 1):
+                lines.append(f"{rank}. {_display_name(uid)} ({-neg_count})")
 
             # --- SECTION B: TOP REP (Positive) ---
             lines.append("\n**Top Rep (Total Karma):**")
-            positive_karma = {k: v for k, v in total_karma_scores.items() if v > 0}
-            sorted_positive = sorted(positive_karma.items(), key=lambda kv: (-kv[1], kv[0]))
-            
-            if not sorted_positive:
+            if not top_positive:
                 lines.append("No one has positive street cred yet.")
             else:
-                for rank, (uid, score) in enumerate(sorted_positive[:5], 1):
-                    # Priority: Group Nickname > JSONBin Saved Name > Fallback ID
-                    saved_name = karma_history.get(uid, {}).get("name") if isinstance(karma_history.get(uid), dict) else None
-                    name = id_to_nick.get(uid) or saved_name or fallback.get(uid) or f"User {uid}"
-                    
+                for rank, (uid, neg_score) in enumerate(top_positive, 1):
+                    score = -neg_score
                     if score >= 30: emoji = "👑" 
                     elif score >= 15: emoji = "💎"
                     else: emoji = "🔥"
-                    lines.append(f"{rank}. {name}: {score} {emoji}")
+                    lines.append(f"{rank}. {_display_name(uid, saved_name(uid))}: {score} {emoji}")
 
             # --- SECTION C: HALL OF SHAME (Negative) ---
             lines.append("\n**Hall of Shame (Negative Karma):**")
-            negative_karma = {k: v for k, v in total_karma_scores.items() if v < 0}
-            sorted_negative = sorted(negative_karma.items(), key=lambda kv: (kv[1], kv[0]))
-
-            if not sorted_negative:
+            if not top_negative:
                 lines.append("No one is in the red... yet.")
             else:
-                for rank, (uid, score) in enumerate(sorted_negative[:5], 1):
-                    saved_name = karma_history.get(uid, {}).get("name") if isinstance(karma_history.get(uid), dict) else None
-                    name = id_to_nick.get(uid) or saved_name or fallback.get(uid) or f"User {uid}"
-                    lines.append(f"{rank}. {name}: {score} 🤡")
+                for rank, (uid, score) in enumerate(top_negative, 1):
+                    lines.append(f"{rank}. {_display_name(uid, saved_name(uid))}: {score} 🤡")
 
             return "\n".join(lines)
     except Exception as e:
@@ -1216,15 +3650,38 @@ def _build_leaderboard_message(top_n: int = 3) -> str:
         return "⚠️ Error generating leaderboard."
 
 
+def message_count(uid: str, days: Optional[int]) -> int:
+    """uid's messages over the last `days` days including today; None for all time."""
+    tracker = _ensure_today_keys()
+    with leaderboard_lock:
+        live = tracker.counts.get(uid, 0)
+    return daily_history.for_group().user_total(uid, days, tracker.date) + live
+
+def top_message_counts(days: Optional[int], top_n: int) -> List[Tuple[str, int]]:
+    """The top_n (uid, count) over the last `days` days including today; None for all time."""
+    tracker = _ensure_today_keys()
+    with leaderboard_lock:
+        live = dict(tracker.counts)
+    return daily_history.for_group().top(days, tracker.date, top_n, live)
+
+RANGE_TITLES = {"week": "Weekly", "month": "Monthly", "all": "All-Time"}
+
+def _build_range_leaderboard_message(span: str, top_n: int = 5) -> str:
+    try:
+        leaders = top_message_counts(HISTORY_RANGES.get(span), top_n)
+        refresh_roster()
+        lines = [f"**{RANGE_TITLES[span]} Unemployed Leaders:**"]
+        for rank, (uid, cnt) in enumerate(leaders, 1):
+            lines.append(f"{rank}. {_display_name(uid)} ({cnt:,})")
+        if not leaders:
+            lines.append("Nobody has said anything yet.")
+        return "\n".join(lines)
+    except Exception as e:
+        logger.error(f"Error building {span} leaderboard: {e}")
+        return "⚠️ Error generating leaderboard."
+
 def _reset_daily_counts():
-    global daily_message_counts, last_message_by_user, daily_counts_date, last_messages_date
-    today = datetime.now().strftime("%Y-%m-%d")
-    daily_message_counts = {}
-    last_message_by_user = {}
-    daily_counts_date = today
-    last_messages_date = today
-    save_json(daily_counts_file, {"date": today, "counts": daily_message_counts})
-    save_json(last_messages_file, {"date": today, "last": last_message_by_user})
+    daily_tracking.for_group().reset(datetime.now().strftime("%Y-%m-%d"))
 
 def _seconds_until_next_8pm():
     now = datetime.now()
@@ -1233,6 +3690,23 @@ def _seconds_until_next_8pm():
         target += timedelta(days=1)
     return max(0, (target - now).total_seconds())
 
+def _post_daily_leaderboard() -> None:
+    # Every worker runs this thread; only the first one to claim today posts
+    posted_key = group_scoped(f"leaderboard:posted:{datetime.now().strftime('%Y-%m-%d')}")
+    if shared_state.set(posted_key, 1, ex=6 * 3600, nx=True):
+        msg = _build_leaderboard_message()
+        group_id = current_group().group_id
+
+        def report(delivered: bool) -> None:
+            if delivered:
+                logger.info(f"Posted daily leaderboard for group {group_id}.")
+            else:
+                logger.warning(f"Failed to post leaderboard for group {group_id}.")
+
+        if not send_message(msg, on_done=report):
+            logger.warning(f"Daily leaderboard for group {group_id} was not queued (messages disabled, cooldown or budget).")
+    _reset_daily_counts()
+
 def daily_leaderboard_worker():
     logger.info("Leaderboard thread started.")
     while True:
@@ -1242,12 +3716,12 @@ def daily_leaderboard_worker():
                 sleep_chunk = min(secs, 300)
                 time.sleep(sleep_chunk)
                 secs -= sleep_chunk
-            msg = _build_leaderboard_message()
-            if send_message(msg):
-                logger.info("Posted daily leaderboard.")
-            else:
-                logger.warning("Failed to post leaderboard.")
-            _reset_daily_counts()
+            for group in GROUPS.values():
+                try:
+                    with use_group(group):
+                        _post_daily_leaderboard()
+                except Exception as e:
+                    logger.error(f"Leaderboard error for group {group.group_id}: {e}")
             time.sleep(5)
         except Exception as e:
             logger.error(f"Leaderboard worker error: {e}")
@@ -1260,410 +3734,820 @@ def start_leaderboard_thread_once():
         start_leaderboard_thread_once._started = True
         logger.info("Leaderboard thread initialized.")
 
+# -----------------------
+# Message Search
+# -----------------------
+# Every message that survives moderation is added to a per-group SQLite
+# FTS5 index. FTS5 tokenizes the text and keeps delta-encoded posting
+# lists in segment b-trees on disk, so a query touches only the postings
+# for its terms and memory use does not grow with history. The webhook only
+# queues the message. An indexer thread writes each group's queue every
+# SEARCH_FLUSH_SECONDS in one transaction, which adds one small segment,
+# and spends idle ticks on incremental 'merge' work that folds small
+# segments into larger ones. Row ids follow arrival order, so results come
+# back newest first, and date filters become row-id ranges on the index.
+SEARCH_ENABLED = os.getenv("SEARCH_ENABLED", "1") != "0"
+SEARCH_FLUSH_SECONDS = float(os.getenv("SEARCH_FLUSH_SECONDS", "2"))
+SEARCH_MERGE_PAGES = int(os.getenv("SEARCH_MERGE_PAGES", "200"))
+SEARCH_MAX_PENDING = int(os.getenv("SEARCH_MAX_PENDING", "50000"))
+SEARCH_RESULTS = 5
+_search_lock = Lock()
+_search_indexer_started = False
+
+class MessageSearch:
+    """Full-text index of one group's messages."""
+    def __init__(self, group: GroupConfig):
+        self.db_path = group_file(search_db_file, group)
+        # Writer queue: ("add", message_id, user_id, name, created_at, text) / ("forget", message_id)
+        self.pending: "deque[Tuple]" = deque(maxlen=SEARCH_MAX_PENDING)
+        self.merged = True
+        self._flush_lock = Lock()
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                message_id TEXT NOT NULL UNIQUE,
+                user_id TEXT NOT NULL,
+                name TEXT,
+                created_at REAL NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id);
+            CREATE INDEX IF NOT EXISTS messages_created ON messages (created_at);
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+        """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def flush(self) -> int:
+        """Write queued adds and forgets in one transaction; returns how many were written."""
+        with self._flush_lock:
+            batch = []
+            while self.pending:
+                batch.append(self.pending.popleft())
+            if not batch:
+                return 0
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for op in batch:
+                    if op[0] == "add":
+                        cur = conn.execute("INSERT OR IGNORE INTO messages (message_id, user_id, name, created_at, text) "
+                                           "VALUES (?, ?, ?, ?, ?)", op[1:])
+                        if cur.rowcount:
+                            conn.execute("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)", (cur.lastrowid, op[5]))
+                    else:
+                        row = conn.execute("DELETE FROM messages WHERE message_id = ? RETURNING id, text", (op[1],)).fetchone()
+                        if row:
+                            conn.execute("INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', ?, ?)", row)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.merged = False
+            return len(batch)
+
+    def merge(self) -> bool:
+        """One bounded step of segment merging; True once there is nothing left to merge."""
+        with self._flush_lock:
+            conn = self._conn()
+            before = conn.total_changes
+            conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', ?)", (SEARCH_MERGE_PAGES,))
+            # A merge that wrote nothing means the segments are already merged
+            self.merged = conn.total_changes - before <= 1
+            return self.merged
+
+    def search(self, query: str, user_id: Optional[str] = None, since: Optional[float] = None,
+               until: Optional[float] = None, limit: int = SEARCH_RESULTS) -> List[Dict[str, Any]]:
+        """Newest messages matching every term in `query` (a trailing * matches a prefix)."""
+        terms = re.findall(r"\w+\*?", query.lower())
+        if not terms:
+            return []
+        match = " ".join(f'"{t.rstrip("*")}"' + ("*" if t.endswith("*") else "") for t in terms)
+        conn = self._conn()
+        sql = ["SELECT m.message_id, m.user_id, m.name, m.created_at, m.text FROM messages_fts f "
+               "JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?"]
+        params: List[Any] = [match]
+        if user_id:
+            sql.append("AND m.user_id = ?")
+            params.append(str(user_id))
+        # Dates become rowid bounds (one index seek each) that FTS5 can skip to
+        if since is not None:
+            row = conn.execute("SELECT id FROM messages WHERE created_at >= ? ORDER BY created_at LIMIT 1", (since,)).fetchone()
+            sql.append("AND f.rowid >= ?")
+            params.append(row[0] if row else 1 << 62)
+        if until is not None:
+            row = conn.execute("SELECT id FROM messages WHERE created_at < ? ORDER BY created_at DESC LIMIT 1", (until,)).fetchone()
+            sql.append("AND f.rowid <= ?")
+            params.append(row[0] if row else 0)
+        sql.append("ORDER BY f.rowid DESC LIMIT ?")
+        params.append(limit)
+        rows = conn.execute(" ".join(sql), params).fetchall()
+        return [dict(zip(("message_id", "user_id", "name", "created_at", "text"), row)) for row in rows]
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+message_search = GroupLocal(MessageSearch)
+
+def index_message(message_id: str, user_id: str, name: str, created_at: float, text: str) -> None:
+    if not SEARCH_ENABLED or not text:
+        return
+    message_search.pending.append(("add", str(message_id), str(user_id), name, float(created_at), text))
+    _start_search_indexer_once()
 
+def unindex_message(message_id: str) -> None:
+    """Drop a deleted message from the current group's index."""
+    if SEARCH_ENABLED:
+        message_search.pending.append(("forget", str(message_id)))
+        _start_search_indexer_once()
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    try:
-        global system_messages_enabled, game_data, next_nft_id
-        data = request.get_json()
-        if not data:
-            return '', 200
+def flush_all_search() -> None:
+    for group, index in message_search.instances():
+        try:
+            index.flush()
+        except Exception as e:
+            logger.error(f"Search index flush error for group {group.group_id}: {e}")
 
-        text = data.get('text', '') or ''
-        sender_type = data.get('sender_type')
-        sender = data.get('name', 'Someone')
-        user_id = str(data.get('user_id')) if data.get('user_id') is not None else None
-        message_id = data.get('id')
-        text_lower = text.lower()
-        attachments = data.get("attachments", [])
-        is_dm = 'group_id' not in data or not data['group_id']
+def _search_indexer() -> None:
+    while True:
+        time.sleep(SEARCH_FLUSH_SECONDS)
+        for group, index in message_search.instances():
+            try:
+                if not index.flush() and not index.merged:
+                    index.merge()
+            except Exception as e:
+                logger.error(f"Search indexer error for group {group.group_id}: {e}")
 
-        # SYSTEM MESSAGES
-        if sender_type == "system" or is_system_message(data):
-            if is_real_system_event(text_lower):
-                if 'has left the group' in text_lower or 'was removed from the group' in text_lower:
-                    key = user_id or f"ghost-{sender}"
-                    former_members[str(key)] = sender
-                    save_json(former_members_file, former_members)
-                    if random.randint(1, 10) == 1:
-                        send_system_message("GAY")
-            return '', 200
-        if sender_type not in ['user']:
-            return '', 200
+def _start_search_indexer_once() -> None:
+    global _search_indexer_started
+    if _search_indexer_started:
+        return
+    with _search_lock:
+        if _search_indexer_started:
+            return
+        _search_indexer_started = True
+    threading.Thread(target=_search_indexer, name="search-index", daemon=True).start()
+
+atexit.register(flush_all_search)
+
+def _parse_search(msg: "IncomingMessage") -> Tuple[str, Dict[str, Any], Optional[str]]:
+    """Split `!search` text into (terms, filters, error). Filters: @mention or from:<name>,
+    since:/until:YYYY-MM-DD, or today/week/month."""
+    text = msg.text[len("!search"):]
+    offset = len("!search")
+    filters: Dict[str, Any] = {}
+    for att in msg.attachments:
+        if att.get("type") == "mentions" and att.get("user_ids") and att.get("loci"):
+            filters["user_id"] = str(att["user_ids"][0])
+            start, length = att["loci"][0]
+            text = text[:start - offset] + text[start - offset + length:]
+            break
+    terms = []
+    for word in text.split():
+        key, _, value = word.partition(":")
+        key = key.lower()
+        if key == "from" and value:
+            found = fuzzy_find_member(value.lstrip("@"))
+            if not found:
+                return "", filters, f"Could not find user '{value}'."
+            filters["user_id"] = found[0]
+        elif key in ("since", "until") and value:
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return "", filters, f"Dates look like {key}:2024-05-31"
+            filters[key] = (day + timedelta(days=1 if key == "until" else 0)).timestamp()
+        elif key in HISTORY_RANGES or key == "today":
+            days = HISTORY_RANGES.get(key, 1)
+            filters["since"] = (datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                                - timedelta(days=days - 1)).timestamp()
+        else:
+            terms.append(word)
+    return " ".join(terms), filters, None
 
-        # VIOLATION CHECK
-        if user_id and message_id:
-            if text_lower.startswith('!unmute') and str(user_id) in ADMIN_IDS:
-                pass
-            else:
-                deleted = check_for_violations(text, user_id, sender, str(message_id))
-                if deleted:
-                    return '', 200
+# -----------------------
+# Command Router
+# -----------------------
+# Commands register a prefix once; the webhook walks a character trie over
+# the message and runs the longest registered prefix, so an unknown "!foo"
+# costs a couple of dict lookups instead of a pass over every startswith.
+class IncomingMessage(NamedTuple):
+    data: Dict[str, Any]
+    text: str
+    text_lower: str
+    sender: str
+    user_id: Optional[str]
+    message_id: Optional[str]
+    attachments: List[Dict[str, Any]]
 
-        # DAILY COUNT
-        if user_id and text:
-            increment_user_message_count(user_id, sender, text)
+    @property
+    def is_admin(self) -> bool:
+        return is_group_admin(self.user_id)
 
-# --- KARMA SYSTEM (REPLY-FETCH BASED) ---
-        if text:
-            text_lower = text.lower()
-            if 'upkarma' in text_lower or 'downkarma' in text_lower:
-                # Get the ID directly from the source message, not the nickname search
-                resolved = _get_user_id_from_reply(data)
-                
-                if resolved:
-                    target_uid, target_nick = resolved
-                    sender_uid = str(user_id)
-                    
-                    if target_uid != sender_uid and target_uid != "None":
-                        with leaderboard_lock:
-                            if target_uid not in karma_history:
-                                karma_history[target_uid] = {"score": 0, "name": target_nick}
-                            
-                            change = 1 if 'upkarma' in text_lower else -1
-                            karma_history[target_uid]["score"] += change
-                            
-                            save_karma_to_bin(karma_history)
-                            safe_save_json("karma_history.json", karma_history)
-                            logger.info(f"Karma Success: {target_nick} is now {karma_history[target_uid]['score']}")
-                    else:
-                        logger.info("Karma ignored: Self-vote or invalid.")
-                
-                return '', 200
-        
-        # LINK DELETION
-        if user_id and message_id:
-            if str(user_id) not in ADMIN_IDS:
-                if contains_link_but_no_attachments(text, attachments):
-                    _delete_message_by_id(str(message_id))
-                    send_system_message(f"@{sender}, links in text are not allowed. Your message was deleted. Use image/video upload instead.")
-                    return '', 200
 
-        # === !muteall ===
-        if text_lower.startswith('!muteall'):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can use !muteall")
-                return '', 200
-        
-            minutes = extract_last_number(text, 30)
-            mute_until = time.time() + minutes * 60
-        
-            members = get_group_members()
-            muted_count = 0
-        
-            for member in members:
-                uid = str(member.get("user_id"))
-                if uid in ADMIN_IDS:
-                    continue
-                muted_users[uid] = mute_until
-                muted_count += 1
-        
-            send_system_message(f"**GLOBAL MUTE ENABLED** for {minutes} minutes.\nMuted {muted_count} users.")
-            logger.info(f"!muteall by {sender} ({user_id}): {muted_count} muted, {minutes} min")
-            return '', 200
+_command_trie: Dict[str, Any] = {}
+_exact_commands: Dict[str, Dict[str, Any]] = {}
 
 
-        # SPAM: 5 identical messages in 10 seconds → 2 min mute
-        if user_id and text and message_id:
-            uid = str(user_id)
-            now = time.time()
-            msg = (text or "").strip()
-            
-            # Persistent storage attached to the webhook function itself
-            if not hasattr(webhook, "spam_log"):
-                webhook.spam_log = {}
-            if not hasattr(webhook, "spam_text"):
-                webhook.spam_text = {}
-                
-            # Get/clean the timestamp log for this user (sliding 10-second window)
-            log = webhook.spam_log.get(uid, [])
-            log = [t for t in log if now - t < 10]
-            
-            # How many of the previous messages in the window were identical to this one?
-            prev_same = len(log) if webhook.spam_text.get(uid) == msg else 0
-            
-            # Record this message
-            log.append(now)
-            webhook.spam_log[uid] = log
-            webhook.spam_text[uid] = msg
-            
-            # 5th identical message → mute
-            if prev_same + 1 >= 5:  # change to >= 4 if you prefer triggering on the 4th
-                muted_users[uid] = now + 120
-                _delete_message_by_id(str(message_id))
-                send_system_message(f"{sender} muted for 2 minutes - sent 5 identical messages in 10 seconds")
-                logger.info(f"SPAM MUTE: {sender} ({uid}) - 5x identical")
-                webhook.spam_log[uid] = []  # prevent instant re-trigger on the next one
-                return '', 200
+def command(prefix: str, admin: bool = False, denied: Optional[str] = None, exact: bool = False):
+    """Register a handler for messages starting with `prefix` (or equal to it when `exact`).
 
-        # === !unmuteall ===
-        if text_lower == '!unmuteall':
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can use !unmuteall")
-                return '', 200
-        
-            total = len(muted_users)
-            muted_users.clear()
-        
-            send_system_message(f"**GLOBAL UNMUTE ENABLED** by @{sender}\nUnmuted {total} users.")
-            logger.info(f"!unmuteall by {sender} ({user_id}): {total} unmuted")
-            return '', 200
-          
+    `denied` is sent to non-admins of an admin command ({sender} and {text} are
+    filled in); with no `denied` text the message falls through to fun replies.
+    """
+    def register(func):
+        spec = {"prefix": prefix, "handler": func, "admin": admin, "denied": denied}
+        if exact:
+            _exact_commands[prefix] = spec
+        else:
+            node = _command_trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[""] = spec
+        return func
+    return register
+
+
+def find_command(text_lower: str) -> Optional[Dict[str, Any]]:
+    spec = _exact_commands.get(text_lower.strip())
+    if spec:
+        return spec
+    node = _command_trie
+    found = None
+    for ch in text_lower:
+        node = node.get(ch)
+        if node is None:
+            break
+        found = node.get("", found)
+    return found
 
-        # === !mute ===
-        if text_lower.startswith('!mute'):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: {text}\nOnly admins can use !mute")
-                return '', 200
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user. Reply to their message, @-mention them, or use exact name.")
-                return '', 200
+def run_command(msg: IncomingMessage) -> bool:
+    """Run the matching command handler. Returns True if the message was consumed."""
+    spec = find_command(msg.text_lower)
+    if not spec:
+        return False
+    if spec["admin"] and not msg.is_admin:
+        if spec["denied"] is None:
+            return False
+        send_system_message(spec["denied"].format(sender=msg.sender, text=msg.text))
+        return True
+    spec["handler"](msg)
+    return True
 
-            target_id, target_nick = target
-            minutes = extract_last_number(text, 30)
-            muted_until = time.time() + minutes * 60
-            muted_users[target_id] = muted_until
-            send_system_message(f"{target_nick} (`{target_id}`) has been **muted** for **{minutes}** minute(s).")
-            logger.info(f"Muted {target_nick} ({target_id}) for {minutes}m")
-            return '', 200
 
-        # === !delete ===
-        if text_lower.startswith('!delete'):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: {text}\nOnly admins can use !delete")
-                return '', 200
+# Keyword replies in priority order: the first entry found anywhere in the
+# message wins. All keywords go into one lookahead alternation so a message
+# is scanned once rather than once per keyword.
+FUN_RESPONSES = [
+    ("clean memes", "We're the best!"),
+    ("wsg", "God is good"),
+    ("!kill", "Error: Only God himself can use this command"),
+    ("cooper is my pookie", "me too bro"),
+    ("wrx is tall", "Wrx considers a chihuahua to be a large dog"),
+    ("https:", "Delete this, links are not allowed, admins have been notified"),
+    ("france", "please censor that to fr*nce"),
+    ("french", "please censor that to fr*nch"),
+    ("can i get admin", "No."),
+    ("can i have admin", "No."),
+    ("may i have admin", "No."),
+    ("can i be admin", "No."),
+    ("chill", "TOG is the chillest admin bro"),
+    ("locked in is cute", "I couldn't agree more"),
+    ("sophie", "(Sigh)"),
+    ("anygays", "L-BEATZ WAS GAY"),
+]
+_fun_priority = {keyword: i for i, (keyword, _) in enumerate(FUN_RESPONSES)}
+_fun_pattern = re.compile(
+    "(?=(" + "|".join(re.escape(keyword) for keyword, _ in FUN_RESPONSES) + "))"
+)
 
-            replied = _find_replied_message(data)
-            if replied and replied.get("message_id"):
-                if _delete_message_by_id(replied["message_id"]):
-                    send_system_message(f"Message {replied['message_id']} deleted by @{sender}.")
-                else:
-                    send_system_message(f"Failed to delete message {replied['message_id']}.")
-                return '', 200
 
-            parts = text.split()
-            if len(parts) < 2 or not parts[1].isdigit():
-                send_system_message("> Usage: `!delete` (reply) **or** `!delete <MESSAGE_ID>`")
-                return '', 200
+def _fun_allowed(keyword: str, msg: IncomingMessage) -> bool:
+    if keyword == "https:":
+        # Case-sensitive on purpose, and video posts carry their own link
+        return "https:" in msg.text and not any(att.get("type") == "video" for att in msg.attachments)
+    return True
 
-            if _delete_message_by_id(parts[1]):
-                send_system_message(f"Message {parts[1]} deleted by @{sender}.")
-            else:
-                send_system_message(f"Failed to delete message {parts[1]}.")
-            return '', 200
 
-        # === !unmute ===
-        if text_lower.startswith('!unmute '):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can use !unmute")
-                return '', 200
+def match_fun_response(msg: IncomingMessage) -> Optional[str]:
+    found = {m.group(1) for m in _fun_pattern.finditer(msg.text_lower)}
+    for keyword in sorted(found, key=_fun_priority.__getitem__):
+        if _fun_allowed(keyword, msg):
+            return FUN_RESPONSES[_fun_priority[keyword]][1]
+    return None
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
-                return '', 200
+# -----------------------
+# Command Handlers
+# -----------------------
+@command("!muteall", admin=True, denied="> @{sender}: Only admins can use !muteall")
+def cmd_muteall(msg: IncomingMessage) -> None:
+    minutes = extract_last_number(msg.text, 30)
+    mute_scheduler.mute_all(minutes * 60)
+    # The member count needs a roster fetch, so it is announced off the webhook thread
+    dispatch(PRIORITY_NORMAL, _announce_muteall, minutes, msg.sender, msg.user_id)
+
+def _announce_muteall(minutes: int, sender: str, user_id: str) -> None:
+    muted_count = _non_admin_member_count()
+    send_system_message(f"**GLOBAL MUTE ENABLED** for {minutes} minutes.\nMuted {muted_count} users.")
+    logger.info(f"!muteall by {sender} ({user_id}): {muted_count} muted, {minutes} min")
+
+
+@command("!unmuteall", admin=True, denied="> @{sender}: Only admins can use !unmuteall", exact=True)
+def cmd_unmuteall(msg: IncomingMessage) -> None:
+    total, group_lifted = mute_scheduler.unmute_all()
+    dispatch(PRIORITY_NORMAL, _announce_unmuteall, total, group_lifted, msg.sender, msg.user_id)
+
+def _announce_unmuteall(total: int, group_lifted: bool, sender: str, user_id: str) -> None:
+    if group_lifted:
+        total = max(total, _non_admin_member_count())
+    send_system_message(f"**GLOBAL UNMUTE ENABLED** by @{sender}\nUnmuted {total} users.")
+    logger.info(f"!unmuteall by {sender} ({user_id}): {total} unmuted")
+
+
+@command("!mute", admin=True, denied="> @{sender}: {text}\nOnly admins can use !mute")
+def cmd_mute(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user. Reply to their message, @-mention them, or use exact name.")
+        return
 
-            target_id, target_nick = target
-            if target_id in muted_users:
-                del muted_users[target_id]
-                send_system_message(f"{target_nick} (`{target_id}`) has been unmuted.")
-            else:
-                send_system_message(f"{target_nick} (`{target_id}`) was not muted.")
-            return '', 200
+    target_id, target_nick = target
+    minutes = extract_last_number(msg.text, 30)
+    mute_scheduler.mute(target_id, minutes * 60)
+    send_system_message(f"{target_nick} (`{target_id}`) has been **muted** for **{minutes}** minute(s).")
+    logger.info(f"Muted {target_nick} ({target_id}) for {minutes}m")
 
-        # === !pixel ===
-        if text_lower.startswith('!pixel'):
-            target_msg_id = None
-            replied = _find_replied_message(data)
-            
-            if replied:
-                target_msg_id = replied.get('message_id')
-            elif any(att.get('type') == 'image' for att in data.get('attachments', [])):
-                target_msg_id = message_id
-            else:
-                send_message(f"> @{sender}: Please reply to an image with !pixel.")
-                return '', 200
 
-            # Use the robust function
-            result_msg = get_pixel_count(target_msg_id)
-            
-            if result_msg:
-                send_message(result_msg)
+@command("!delete", admin=True, denied="> @{sender}: {text}\nOnly admins can use !delete")
+def cmd_delete(msg: IncomingMessage) -> None:
+    def report_delete(target_msg_id):
+        def on_done(success):
+            if success:
+                send_system_message(f"Message {target_msg_id} deleted by @{msg.sender}.")
             else:
-                send_message(f"> @{sender}: Error processing image.")
-            
-            return '', 200
+                send_system_message(f"Failed to delete message {target_msg_id}.")
+        return on_done
 
-        # === !ban ===
-        if text_lower.startswith('!ban '):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can use !ban")
-                return '', 200
+    replied = _find_replied_message(msg.data)
+    if replied and replied.get("message_id"):
+        _delete_message_by_id(replied["message_id"], on_done=report_delete(replied["message_id"]))
+        return
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user to ban. Reply, @-mention, or use exact name.")
-                return '', 200
+    parts = msg.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        send_system_message("> Usage: `!delete` (reply) **or** `!delete <MESSAGE_ID>`")
+        return
 
-            target_id, target_nick = target
-            ban_user_command(target_id, target_nick, sender, user_id, text)
-            return '', 200
+    _delete_message_by_id(parts[1], on_done=report_delete(parts[1]))
 
-        # === !unban ===
-        if text_lower.startswith('!unban '):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can use !unban")
-                return '', 200
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user to unban. Use @-mention or exact name.")
-                return '', 200
+@command("!unmute ", admin=True, denied="> @{sender}: Only admins can use !unmute")
+def cmd_unmute(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
+        return
 
-            target_id, _ = target
-            unban_user(target_id, sender, user_id, text)
-            return '', 200
+    target_id, target_nick = target
+    if mute_scheduler.unmute(target_id):
+        send_system_message(f"{target_nick} (`{target_id}`) has been unmuted.")
+    else:
+        send_system_message(f"{target_nick} (`{target_id}`) was not muted.")
 
-        # === !getid ===
-        if text_lower.startswith('!getid '):
-            target_name = text[len('!getid '):].strip().lstrip('@')
-            get_user_id(target_name, sender, user_id, text)
-            return '', 200
 
-        # === !strike ===
-        if text_lower.startswith('!strike '):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can issue strikes")
-                return '', 200
+@command("!pixel")
+def cmd_pixel(msg: IncomingMessage) -> None:
+    replied = _find_replied_message(msg.data)
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
-                return '', 200
+    if replied:
+        target_msg_id = replied.get('message_id')
+    elif any(att.get('type') == 'image' for att in msg.attachments):
+        target_msg_id = msg.message_id
+    else:
+        send_message(f"> @{msg.sender}: Please reply to an image with !pixel.")
+        return
 
-            target_id, target_nick = target
-            record_strike(target_id, target_nick, sender, user_id, text)
-            return '', 200
+    def handle_pixel_task(msg_id, original_sender):
+        result_msg = get_pixel_count(msg_id)
+        if result_msg:
+            send_message(result_msg)
+        else:
+            send_message(f"> @{original_sender}: Error processing image.")
 
-        # === !strikes ===
-        if text_lower.startswith('!strikes '):
-            if str(user_id) not in ADMIN_IDS:
-                send_system_message(f"> @{sender}: Only admins can view strikes")
-                return '', 200
+    dispatch(PRIORITY_FUN, handle_pixel_task, target_msg_id, msg.sender)
 
-            target = resolve_target_user(data, text)
-            if not target:
-                send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
-                return '', 200
 
-            target_id, target_nick = target
-            get_strikes_report(target_id, target_nick, sender, user_id, text)
-            return '', 200
+@command("!ban ", admin=True, denied="> @{sender}: Only admins can use !ban")
+def cmd_ban(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user to ban. Reply, @-mention, or use exact name.")
+        return
 
-        # === !help ===
-        if text_lower.strip() == '!help':
-            is_admin = str(user_id) in ADMIN_IDS
-            msg = get_help_message(is_admin)
+    target_id, target_nick = target
+    dispatch(PRIORITY_MODERATION, ban_user_command, target_id, target_nick, msg.sender, msg.user_id, msg.text)
 
-            if is_admin:
-                send_system_message(msg)
-            else:
-                send_message(msg)
 
-            return '', 200
+@command("!lockdown", admin=True, denied="> @{sender}: Only admins can use !lockdown")
+def cmd_lockdown(msg: IncomingMessage) -> None:
+    status = lockdown_status()
+    if status:
+        minutes_left = int((status["until"] - time.time()) / 60) + 1
+        send_system_message(f"> Lockdown already active ({status['reason']}), {minutes_left} minute(s) left. !unlock to lift.")
+        return
+    minutes = extract_last_number(msg.text, RAID_LOCKDOWN_MINUTES)
+    start_lockdown(f"Manual lockdown by @{msg.sender}", mute_minutes=min(minutes, RAID_MUTE_MINUTES),
+                   lockdown_minutes=minutes, by=msg.sender)
 
-        
-# --- Improved AI Search Command ---
-        if text_lower.startswith('!google '):
-            query = text[8:].strip()
-            if not query:
-                send_message(f"> @{sender}: You gotta give me something to search for!")
+
+@command("!unlock", admin=True, denied="> @{sender}: Only admins can use !unlock", exact=True)
+def cmd_unlock(msg: IncomingMessage) -> None:
+    if end_lockdown():
+        send_system_message(f"Lockdown lifted by @{msg.sender}. Links and messages are allowed again.", urgent=True)
+    else:
+        send_system_message("> No lockdown is active.")
+
+
+@command("!massban", admin=True, denied="> @{sender}: Only admins can use !massban")
+def cmd_massban(msg: IncomingMessage) -> None:
+    targets, unresolved = resolve_bulk_targets(msg.data, msg.text)
+    if not targets:
+        if unresolved:
+            send_system_message(f"> Could not find: {', '.join(unresolved[:20])}")
+        else:
+            send_system_message("> Usage: `!massban @user @user ...` or `!massban name, name, 12345`")
+        return
+    dispatch(PRIORITY_MODERATION, mass_ban, targets, unresolved, msg.sender, f"Mass ban by {msg.sender}")
+
+
+@command("!unban ", admin=True, denied="> @{sender}: Only admins can use !unban")
+def cmd_unban(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user to unban. Use @-mention or exact name.")
+        return
+
+    target_id, _ = target
+    dispatch(PRIORITY_NORMAL, unban_user, target_id, msg.sender, msg.user_id, msg.text)
+
+
+@command("!jobs", admin=True, denied="> @{sender}: Only admins can view jobs", exact=True)
+def cmd_jobs(msg: IncomingMessage) -> None:
+    jobs = sorted(group_jobs(), key=lambda j: j.get("created_at", 0), reverse=True)[:10]
+    if not jobs:
+        send_system_message("> No membership jobs in the last day.")
+        return
+    send_system_message("Membership jobs (newest first):\n" + "\n".join(format_job(j) for j in jobs))
+
+
+@command("!job ", admin=True, denied="> @{sender}: Only admins can view jobs")
+def cmd_job(msg: IncomingMessage) -> None:
+    job_id = msg.text[len("!job "):].strip().strip("`").lower()
+    job = membership_jobs.get(job_id)
+    if not job or job_group(job) != current_group():
+        send_system_message(f"> No job `{job_id}`. Use !jobs to list recent ones.")
+        return
+    send_system_message(format_job(job))
+
+
+@command("!getid ")
+def cmd_getid(msg: IncomingMessage) -> None:
+    # get_user_id does its own admin check and reply
+    target_name = msg.text[len('!getid '):].strip().lstrip('@')
+    get_user_id(target_name, msg.sender, msg.user_id, msg.text)
+
+
+@command("!strike ", admin=True, denied="> @{sender}: Only admins can issue strikes")
+def cmd_strike(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
+        return
+
+    target_id, target_nick = target
+    record_strike(target_id, target_nick, msg.sender, msg.user_id, msg.text)
+
+
+@command("!strikes ", admin=True, denied="> @{sender}: Only admins can view strikes")
+def cmd_strikes(msg: IncomingMessage) -> None:
+    target = resolve_target_user(msg.data, msg.text)
+    if not target:
+        send_system_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
+        return
+
+    target_id, target_nick = target
+    get_strikes_report(target_id, target_nick, msg.sender, msg.user_id, msg.text)
+
+
+@command("!help", exact=True)
+def cmd_help(msg: IncomingMessage) -> None:
+    help_text = get_help_message(msg.is_admin)
+    if msg.is_admin:
+        send_system_message(help_text)
+    else:
+        send_message(help_text)
+
+
+@command("!google ")
+def cmd_google(msg: IncomingMessage) -> None:
+    query = msg.text[8:].strip()
+    if not query:
+        send_message(f"> @{msg.sender}: You gotta give me something to search for!")
+        return
+
+    def handle_search_task(q, original_sender):
+        result = get_ai_search(q)
+        # Credit the user who asked
+        send_message(f"> @{original_sender} searched for: {q}\n\n{result}")
+
+    dispatch(PRIORITY_FUN, handle_search_task, query, msg.sender)
+
+
+@command("!enable", admin=True, exact=True)
+def cmd_enable(msg: IncomingMessage) -> None:
+    save_system_messages_enabled(True)
+    send_system_message("System messages **ENABLED** by admin.")
+
+
+@command("!disable", admin=True, exact=True)
+def cmd_disable(msg: IncomingMessage) -> None:
+    save_system_messages_enabled(False)
+    send_system_message("System messages **DISABLED** by admin.")
+
+
+@command("!leaderboard", exact=True)
+def cmd_leaderboard(msg: IncomingMessage) -> None:
+    dispatch(PRIORITY_FUN, lambda: send_message(_build_leaderboard_message()))
+
+
+@command("!leaderboard ")
+def cmd_leaderboard_range(msg: IncomingMessage) -> None:
+    span = msg.text_lower[len("!leaderboard "):].strip()
+    if span in ("today", "day", ""):
+        cmd_leaderboard(msg)
+        return
+    if span not in RANGE_TITLES:
+        send_message(f"> @{msg.sender}: Try !leaderboard week, month or all")
+        return
+    dispatch(PRIORITY_FUN, lambda: send_message(_build_range_leaderboard_message(span)))
+
+
+@command("!search ")
+def cmd_search(msg: IncomingMessage) -> None:
+    terms, filters, error = _parse_search(msg)
+    if error or not terms:
+        send_message(f"> @{msg.sender}: {error or 'Usage: !search <words> [@user|from:name] [since:YYYY-MM-DD] [until:YYYY-MM-DD] [today|week|month]'}")
+        return
+
+    def run_search():
+        start = time.perf_counter()
+        index = message_search.for_group()
+        index.flush()  # so messages from the last few seconds are found too
+        results = index.search(terms, **filters)
+        observe("search_seconds", time.perf_counter() - start)
+        if not results:
+            send_message(f"> No messages found for \"{terms}\".")
+            return
+        lines = [f"> 🔎 \"{terms}\":"]
+        for hit in results:
+            when = datetime.fromtimestamp(hit["created_at"]).strftime("%b %d")
+            snippet = hit["text"] if len(hit["text"]) <= 120 else hit["text"][:117] + "…"
+            lines.append(f"• {hit['name']} ({when}): {snippet}")
+        send_message("\n".join(lines))
+
+    dispatch(PRIORITY_FUN, run_search)
+
+
+@command("!stats", exact=True)
+@command("!stats ")
+def cmd_stats(msg: IncomingMessage) -> None:
+    words = msg.text.split()
+    span = words.pop().lower() if len(words) > 1 and words[-1].lower() in RANGE_TITLES else None
+    if len(words) > 1 or _find_replied_message(msg.data):
+        target = resolve_target_user(msg.data, " ".join(words))
+        if not target:
+            send_message("> Error: Could not find user. Reply, @-mention, or use exact name.")
+            return
+    else:
+        target = (str(msg.user_id), msg.sender)  # your own stats
+    uid, name = target
+
+    def report():
+        if span:
+            label = {"week": "in the last 7 days", "month": "in the last 30 days", "all": "all time"}[span]
+            send_message(f"> {name}: {message_count(uid, HISTORY_RANGES.get(span)):,} messages {label}")
+            return
+        counts = [message_count(uid, days) for days in (1, 7, 30, None)]
+        send_message(f"> {name}: {counts[0]:,} today · {counts[1]:,} this week · "
+                     f"{counts[2]:,} this month · {counts[3]:,} all time")
+
+    dispatch(PRIORITY_FUN, report)
+
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    return process_webhook(request.get_json(silent=True))
+
+def process_webhook(data: Optional[Dict[str, Any]]) -> Tuple[str, int]:
+    """Handle one callback payload under its group. Shared by the Flask route and asgi.py."""
+    start = time.perf_counter()
+    group = group_for_payload(data)
+    if group is None:
+        inc("webhook_unknown_group_total")
+        return '', 200
+    with use_group(group):
+        body, status = handle_webhook(data)
+    observe("webhook_seconds", time.perf_counter() - start)
+    inc("webhook_requests_total", status=status)
+    return body, status
+
+def handle_webhook(data: Optional[Dict[str, Any]]):
+    message_id = None
+    try:
+        global game_data, next_nft_id
+        with timed("webhook_stage_seconds", stage="parse"):
+            if not data:
                 return '', 200
 
-            def handle_search_task(q, original_sender):
-                # Run search
-                result = get_ai_search(q)
-                # Format response to credit the user
-                final_text = f"> @{original_sender} searched for: {q}\n\n{result}"
-                send_message(final_text)
+            text = data.get('text', '') or ''
+            sender_type = data.get('sender_type')
+            sender = data.get('name', 'Someone')
+            user_id = str(data.get('user_id')) if data.get('user_id') is not None else None
+            message_id = data.get('id')
+            text_lower = text.lower()
+            attachments = data.get("attachments", [])
+            is_dm = 'group_id' not in data or not data['group_id']
 
-            # Pass the sender name to the thread
-            threading.Thread(target=handle_search_task, args=(query, sender)).start()
-            return '', 200
+            # Redelivered callback: already handled (or being handled) once
+            if message_id and not first_delivery(message_id):
+                inc("webhook_duplicates_total")
+                return '', 200
 
-        # === System Toggle ===
-        if text_lower == '!enable' and str(user_id) in ADMIN_IDS:
-            system_messages_enabled = True
-            save_system_messages_enabled(True)
-            send_system_message("System messages **ENABLED** by admin.")
-            return '', 200
+            # Cache author/attachments so replies to this message need no API call
+            if sender_type == "user" and message_id:
+                remember_message(data)
 
-        if text_lower == '!disable' and str(user_id) in ADMIN_IDS:
-            system_messages_enabled = False
-            save_system_messages_enabled(False)
-            send_system_message("System messages **DISABLED** by admin.")
+        # SYSTEM MESSAGES
+        if sender_type == "system" or is_system_message(data):
+            with timed("webhook_stage_seconds", stage="system_event"):
+                if is_real_system_event(text_lower) or 'changed name' in text_lower:
+                    # Joins, leaves, removals, re-adds and renames all change the roster
+                    invalidate_roster()
+                    event = classify_member_event(text_lower)
+                    if event:
+                        handle_member_event(event)
+                    if event == "leave":
+                        key = user_id or f"ghost-{sender}"
+                        former_members[str(key)] = sender
+                        if random.randint(1, 10) == 1:
+                            send_system_message("GAY")
             return '', 200
-
- 
-        
-        # === Fun Responses ===
-        if 'clean memes' in text_lower:
-            send_message("We're the best!")
-        elif 'wsg' in text_lower:
-            send_message("God is good")
-        elif '!kill' in text_lower:
-            send_message("Error: Only God himself can use this command")
-        elif 'cooper is my pookie' in text_lower:
-            send_message("me too bro")
-        elif 'wrx is tall' in text_lower:
-            send_message("Wrx considers a chihuahua to be a large dog")
-        elif 'https:' in text and not any(att.get("type") == "video" for att in attachments):
-            send_message("Delete this, links are not allowed, admins have been notified")
-        elif 'france' in text_lower:
-            send_message("please censor that to fr*nce")
-        elif 'french' in text_lower:
-            send_message("please censor that to fr*nch")
-        elif 'can i get admin' in text_lower:
-            send_message("No.")
-        elif 'can i have admin' in text_lower:
-            send_message("No.")
-        elif 'may i have admin' in text_lower:
-            send_message("No.")
-        elif 'may i have admin' in text_lower:
-            send_message("No.")
-        elif 'can i be admin' in text_lower:
-            send_message("No.")
-        elif 'nene can I get admin' in text_lower:
-            send_message("No.")
-        elif 'chill' in text_lower:
-            send_message("TOG is the chillest admin bro")
-        elif 'locked in is cute' in text_lower:
-            send_message("I couldn't agree more")
-        elif 'sophie' in text_lower:
-            send_message("(Sigh)")
-        elif 'anygays' in text_lower:
-            send_message("L-BEATZ WAS GAY")
-        
-        if text_lower.strip() == '!leaderboard':
-            msg = _build_leaderboard_message()
-            send_message(msg)
+        if sender_type not in ['user']:
             return '', 200
 
-                # === !Factorial Trigger ===
+        # VIOLATION CHECK
+        if user_id and message_id:
+            if text_lower.startswith('!unmute') and is_group_admin(user_id):
+                pass
+            else:
+                with timed("webhook_stage_seconds", stage="violations"):
+                    deleted = check_for_violations(text, user_id, sender, str(message_id))
+                if deleted:
+                    return '', 200
+
+        # DAILY COUNT
+        if user_id and text:
+            with timed("webhook_stage_seconds", stage="daily_count"):
+                increment_user_message_count(user_id, sender, text)
+
+# --- KARMA SYSTEM (REPLY-FETCH BASED) ---
         if text:
-            fact_msg = get_factorial_response(text)
-            if fact_msg:
-                send_message(fact_msg)
+            text_lower = text.lower()
+            if 'upkarma' in text_lower or 'downkarma' in text_lower:
+                with timed("webhook_stage_seconds", stage="karma"):
+                    change = 1 if 'upkarma' in text_lower else -1
+                    dispatch(PRIORITY_NORMAL, apply_karma_vote, data, str(user_id), change)
+                return '', 200
+
+        with timed("webhook_stage_seconds", stage="link_check"):
+            # LOCKDOWN: during a raid lockdown no links at all from non-admins
+            if user_id and message_id and not is_group_admin(user_id) and LOCKDOWN_LINK_RE.search(text):
+                if lockdown_status():
+                    _delete_message_by_id(str(message_id))
+                    return '', 200
+
+            # LINK DELETION
+            if user_id and message_id:
+                if not is_group_admin(user_id):
+                    if contains_link_but_no_attachments(text, attachments):
+                        _delete_message_by_id(str(message_id))
+                        send_system_message(f"@{sender}, links in text are not allowed. Your message was deleted. Use image/video upload instead.")
+                        return '', 200
+
+        # SPAM: identical bursts, message rate and text floods
+        if user_id and text and message_id:
+            with timed("webhook_stage_seconds", stage="spam"):
+                uid = str(user_id)
+                rule = check_spam(uid, text)
+                if rule:
+                    mute_scheduler.mute(uid, rule.mute_minutes * 60)
+                    _delete_message_by_id(str(message_id))
+                    send_system_message(f"{sender} muted for {rule.mute_minutes} minutes - {rule.reason}")
+                    logger.info(f"SPAM MUTE: {sender} ({uid}) - {rule.name}")
+                    return '', 200
+
+        # SEARCH INDEX (commands aren't worth finding later)
+        if user_id and message_id and text and not text.startswith("!"):
+            index_message(message_id, user_id, sender, data.get("created_at") or time.time(), text)
+
+        # COMMANDS
+        with timed("webhook_stage_seconds", stage="commands"):
+            incoming = IncomingMessage(data, text, text_lower, sender, user_id, message_id, attachments)
+            if run_command(incoming):
                 return '', 200
 
+        with timed("webhook_stage_seconds", stage="fun"):
+            # === Fun Responses ===
+            reply = match_fun_response(incoming)
+            if reply:
+                send_message(reply)
+
+            # === !Factorial Trigger ===
+            if text:
+                fact_msg = get_factorial_response(text)
+                if fact_msg:
+                    send_message(fact_msg)
+                    return '', 200
+
         return '', 200
 
     except Exception as e:
         logger.error(f"Webhook error: {e}")
-        return '', 500
+        # The claim stays: a redelivery would repeat whatever already ran
+        return '', 200
+
+def _metrics_denied() -> Optional[Tuple[str, int]]:
+    """The response for a caller without the metrics token, or None if they may proceed."""
+    if not METRICS_TOKEN:
+        # Stacks and queue internals are never served anonymously
+        return 'not found\n', 404
+    supplied = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+        return 'forbidden\n', 403
+    return None
+
+def _metrics_gauges() -> Dict[str, float]:
+    gauges = {}
+    for key, value in dispatcher_stats().items():
+        if isinstance(value, (int, float)):
+            gauges[f"dispatcher_{key}"] = value
+    for key, value in message_cache_stats().items():
+        gauges[f"message_cache_{key}"] = value
+    gauges["groups_configured"] = len(GROUPS)
+    gauges["groups_active"] = len(daily_tracking.instances())
+    gauges["roster_members"] = sum(len(roster.by_user_id) for _, roster in rosters.instances())
+    gauges["mutes_scheduled"] = sum(len(scheduler) for _, scheduler in mute_scheduler.instances())
+    gauges["karma_pending_votes"] = sum(len(state.pending) for _, state in karma_sync.instances())
+    gauges["search_pending"] = sum(len(index.pending) for _, index in message_search.instances())
+    gauges["profiler_running"] = 1 if profiler.running else 0
+    return gauges
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    denied = _metrics_denied()
+    if denied:
+        return denied
+    return render_metrics(_metrics_gauges()), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def metrics_profile():
+    """GET: collapsed stacks so far. POST ?action=start|stop|reset toggles the sampler."""
+    denied = _metrics_denied()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        action = request.args.get("action", "")
+        if action == "start":
+            profiler.start()
+        elif action == "stop":
+            profiler.stop()
+        elif action == "reset":
+            profiler.reset()
+        else:
+            return 'action must be start, stop or reset\n', 400
+        return f'profiler {"running" if profiler.running else "stopped"}\n', 200
+    return profiler.collapsed(), 200, {"Content-Type": "text/plain"}
 
 # -----------------------
 # Flask App Run
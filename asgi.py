@@ -0,0 +1,408 @@
+"""
+ASGI entry point: the same webhook handling as app.py, with the GroupMe
+calls every busy message makes sent from an asyncio event loop instead of
+dispatcher threads.
+
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT    # production (Procfile)
+    python asgi.py [--host 127.0.0.1] [--port 5000]          # same server, local defaults
+
+/webhook runs app.process_webhook() on a small thread pool (a command can
+still need a synchronous roster or message lookup) and answers at once. Bot
+posts, message deletes, DMs, automatic bans and karma votes are handed to
+AsyncOutbound through app.dispatch(), in priority order, and go out through
+one shared httpx.AsyncClient, so hundreds of calls can be in flight without
+a thread each. Admin jobs (!ban, !massban, unban membership jobs), the
+karma JSONBin flush, searches and !pixel are rare and multi-step, and still
+run on app's dispatcher threads. Every other route is served by the Flask
+app, which also still runs under gunicorn (`gunicorn app:app`).
+
+uvicorn owns the HTTP side: request parsing, chunked bodies, keep-alive and
+header limits (--timeout-keep-alive, --limit-concurrency, --h11-max-
+incomplete-event-size). Bodies over ASYNC_MAX_BODY are refused with 413.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+import app
+
+ASYNC_HTTP_POOL_SIZE = int(os.getenv("ASYNC_HTTP_POOL_SIZE", "100"))
+ASYNC_OUTBOUND_CONCURRENCY = int(os.getenv("ASYNC_OUTBOUND_CONCURRENCY", "256"))
+ASYNC_QUEUE_SIZE = int(os.getenv("ASYNC_QUEUE_SIZE", "5000"))
+ASYNC_HANDLER_THREADS = int(os.getenv("ASYNC_HANDLER_THREADS", "8"))
+ASYNC_MAX_BODY = int(os.getenv("ASYNC_MAX_BODY", str(1 << 20)))
+ASYNC_DRAIN_SECONDS = 5
+# Same policy as app's requests session: only calls that are safe to repeat
+# are retried, on these statuses and on transport errors, with backoff.
+# Connection failures (nothing sent yet) are retried for any method by the
+# transport itself.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# httpx logs every request at INFO; app already logs the outcome of each call
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+# -----------------------
+# Async HTTP Client
+# -----------------------
+def make_client(pool_size: int = ASYNC_HTTP_POOL_SIZE) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    transport = httpx.AsyncHTTPTransport(retries=app.HTTP_RETRIES, limits=limits)
+    return httpx.AsyncClient(transport=transport, headers={"User-Agent": "clankerbot-asgi"})
+
+
+async def request(client: httpx.AsyncClient, method: str, url: str, *, params: Optional[Dict[str, Any]] = None,
+                  json: Any = None, timeout: float = 8) -> httpx.Response:
+    """One outbound call with app's retry policy, recorded in app's http metrics."""
+    host = urllib.parse.urlsplit(url).netloc
+    start = time.perf_counter()
+    for attempt in itertools.count():
+        final = method not in IDEMPOTENT_METHODS or attempt >= app.HTTP_RETRIES
+        try:
+            response = await client.request(method, url, params=params, json=json, timeout=timeout)
+        except httpx.TransportError:
+            if final:
+                app._record_http(host, time.perf_counter() - start, True, method, url)
+                raise
+            await asyncio.sleep(app.HTTP_BACKOFF * 2 ** attempt)
+            continue
+        if final or response.status_code not in RETRY_STATUSES:
+            app._record_http(host, time.perf_counter() - start, response.status_code >= 400, method, url)
+            return response
+        retry_after = response.headers.get("retry-after", "")
+        await asyncio.sleep(float(retry_after) if retry_after.isdigit() else app.HTTP_BACKOFF * 2 ** attempt)
+
+
+# -----------------------
+# Async Outbound
+# -----------------------
+# Async twins of app's dispatcher jobs. Same URLs, payloads, success checks
+# and bookkeeping; they run under the group the job was queued for.
+async def post_bot_message(client: httpx.AsyncClient, text: str, kind: str) -> bool:
+    payload = {"bot_id": app.current_group().bot_id, "text": text}
+    try:
+        response = await request(client, "POST", f"{app.GROUPME_API}/bots/post", json=payload, timeout=8)
+        response.raise_for_status()
+        app.logger.info(f"{kind} message sent: {text[:80]}")
+        return True
+    except Exception as e:
+        app.logger.error(f"GroupMe send error: {e!r}")
+        return False
+
+
+async def delete_message(client: httpx.AsyncClient, msg_id: str) -> bool:
+    url = f"{app.GROUPME_API}/conversations/{app.current_group().group_id}/messages/{msg_id}"
+    try:
+        r = await request(client, "DELETE", url, params={"token": app.ACCESS_TOKEN}, timeout=8)
+        if r.status_code == 204:
+            app.logger.info(f"Deleted message {msg_id}")
+            return True
+        app.logger.error(f"Delete failed {msg_id}: {r.status_code} {r.text}")
+        return False
+    except Exception as e:
+        app.logger.error(f"Delete error {msg_id}: {e!r}")
+        return False
+
+
+async def send_dm(client: httpx.AsyncClient, recipient_id: str, text: str) -> bool:
+    payload = {
+        "direct_message": {
+            "recipient_id": recipient_id,
+            "source_guid": str(int(time.time() * 1000)),
+            "text": text
+        }
+    }
+    try:
+        r = await request(client, "POST", f"{app.GROUPME_API}/direct_messages",
+                          params={"token": app.ACCESS_TOKEN}, json=payload, timeout=8)
+        if r.status_code == 201:
+            app.logger.info(f"DM sent to {recipient_id}: {text[:30]}")
+            return True
+        app.logger.error(f"DM failed {r.status_code}: {r.text}")
+        return False
+    except Exception as e:
+        app.logger.error(f"DM error: {e!r}")
+        return False
+
+
+async def ban_and_announce(client: httpx.AsyncClient, user_id: str, username: str, reason: str,
+                           announcement: str) -> bool:
+    try:
+        if app.is_group_admin(user_id):
+            return False
+        # The roster is usually cached; a refresh is a blocking fetch, so it runs off the loop
+        membership_id = await asyncio.to_thread(app.bind_group(app.get_user_membership_id), user_id)
+        if not membership_id:
+            app.logger.warning(f"Cannot ban {username} ({user_id}) — membership id not found")
+            return False
+        url = f"{app.GROUPME_API}/groups/{app.current_group().group_id}/members/{membership_id}/remove"
+        r = await request(client, "POST", url, params={"token": app.ACCESS_TOKEN}, timeout=8)
+        if r.status_code != 200:
+            app.logger.error(f"Ban failed {r.status_code}: {r.text}")
+            return False
+    except Exception as e:
+        app.logger.error(f"Ban error for {username} ({user_id}): {e!r}")
+        return False
+    app.logger.info(f"Successfully banned {username} ({user_id}) - {reason}")
+    app.record_ban(user_id, username)
+    app.send_system_message(announcement)
+    return True
+
+
+async def apply_karma_vote(client: httpx.AsyncClient, data: Dict[str, Any], sender_uid: str, change: int) -> None:
+    target = None
+    for att in data.get("attachments", []):
+        if att.get("type") == "reply" and att.get("base_reply_id"):
+            target = await message_metadata(client, str(att["base_reply_id"]), data.get("group_id"))
+            break
+    if not target:
+        return
+    target_uid, target_nick = str(target.get("user_id")), target.get("name")
+    if target_uid == sender_uid or target_uid == "None":
+        app.logger.info("Karma ignored: Self-vote or invalid.")
+        return
+    score = app.record_karma_vote(target_uid, target_nick, change)
+    app.logger.info(f"Karma Success: {target_nick} is now {score}")
+
+
+async def message_metadata(client: httpx.AsyncClient, message_id: str,
+                           group_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """app.get_message_metadata(), fetching cache misses without a thread."""
+    cached = app._cached_message(message_id)
+    if cached is not None:
+        return cached
+    url = f"{app.GROUPME_API}/groups/{group_id or app.current_group().group_id}/messages/{message_id}"
+    try:
+        r = await request(client, "GET", url, params={"token": app.ACCESS_TOKEN}, timeout=8)
+    except Exception as e:
+        app.logger.error(f"Failed to fetch message {message_id}: {e!r}")
+        return None
+    if r.status_code != 200:
+        app.logger.error(f"Failed to fetch message {message_id}: {r.status_code}")
+        return None
+    msg = r.json().get("response", {}).get("message", {}) or {}
+    msg.setdefault("id", message_id)
+    return app.remember_message(msg)
+
+
+ASYNC_TWINS = {
+    app._post_bot_message: post_bot_message,
+    app._delete_message_now: delete_message,
+    app._send_dm_now: send_dm,
+    app._ban_and_announce: ban_and_announce,
+    app.apply_karma_vote: apply_karma_vote,
+}
+
+
+class AsyncOutbound:
+    """app.dispatch() hook: jobs with an async twin go on a priority queue served by coroutines."""
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient,
+                 concurrency: int = ASYNC_OUTBOUND_CONCURRENCY):
+        self.loop = loop
+        self.client = client
+        self.queue: "asyncio.PriorityQueue" = asyncio.PriorityQueue()
+        self.in_flight = 0
+        self._seq = itertools.count()
+        self._workers = [loop.create_task(self._worker()) for _ in range(concurrency)]
+
+    def submit(self, priority: int, func, args, kwargs, on_done) -> Optional[bool]:
+        twin = ASYNC_TWINS.get(func)
+        if twin is None:
+            return None
+        if self.queue.qsize() >= ASYNC_QUEUE_SIZE and priority >= app.PRIORITY_FUN:
+            app.inc("async_outbound_total", outcome="dropped")
+            return False
+        item = (priority, next(self._seq), time.perf_counter(), app.current_group(), twin, args, kwargs, on_done)
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, queued_at, group, twin, args, kwargs, on_done = await self.queue.get()
+            app.observe("async_outbound_wait_seconds", time.perf_counter() - queued_at)
+            self.in_flight += 1
+            try:
+                with app.use_group(group):
+                    result = await twin(self.client, *args, **kwargs)
+                    app.inc("async_outbound_total", outcome="failed" if result is False else "ok")
+                    if on_done:
+                        on_done(result)
+            except Exception as e:
+                app.logger.exception(f"Async outbound {twin.__name__} failed: {e}")
+                app.inc("async_outbound_total", outcome="error")
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    async def drain(self, timeout: float = ASYNC_DRAIN_SECONDS) -> None:
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            app.logger.warning(f"Async outbound drain timed out with {self.queue.qsize()} job(s) queued")
+        for task in self._workers:
+            task.cancel()
+        await self.client.aclose()
+
+
+_outbound: Optional[AsyncOutbound] = None
+_handler_pool = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_THREADS, thread_name_prefix="asgi-handler")
+
+
+async def startup() -> AsyncOutbound:
+    global _outbound
+    if _outbound is None:
+        _outbound = AsyncOutbound(asyncio.get_running_loop(), make_client())
+        app._async_dispatch = _outbound.submit
+        app.logger.info(f"Async outbound started ({ASYNC_OUTBOUND_CONCURRENCY} slots, "
+                        f"{ASYNC_HTTP_POOL_SIZE} pooled connections).")
+    return _outbound
+
+
+async def shutdown() -> None:
+    global _outbound
+    if _outbound is not None:
+        app._async_dispatch = None
+        outbound, _outbound = _outbound, None
+        await outbound.drain()
+
+
+def start_background_once() -> None:
+    """The leaderboard thread and startup message, as `python app.py` starts them."""
+    if getattr(start_background_once, "_started", False):
+        return
+    start_background_once._started = True
+    app.start_leaderboard_thread_once()
+    threading.Thread(target=app.startup_worker, daemon=True).start()
+
+
+# -----------------------
+# ASGI Application
+# -----------------------
+def _call_flask(scope: Dict[str, Any], body: bytes) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    """Run the Flask app as plain WSGI for one request."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    started: Dict[str, Any] = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = app.app(environ, start_response)
+    try:
+        content = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], content
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    """The request body, or None once it grows past ASYNC_MAX_BODY."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASYNC_MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status: int, headers: List[Tuple[str, str]], content: bytes) -> None:
+    raw = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers if k.lower() != "content-length"]
+    raw.append((b"content-length", str(len(content)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw})
+    await send({"type": "http.response.body", "body": content})
+
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await startup()
+                start_background_once()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    # Servers that skip lifespan events get the outbound loop on first request
+    await startup()
+    body = await _read_body(receive)
+    if body is None:
+        await _respond(send, 413, [], b"")
+        return
+    loop = asyncio.get_running_loop()
+    if scope["path"] == "/webhook" and scope["method"] == "POST":
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        _, status = await loop.run_in_executor(_handler_pool, app.process_webhook, data)
+        await _respond(send, status, [], b"")
+        return
+    status, headers, content = await loop.run_in_executor(_handler_pool, _call_flask, scope, body)
+    await _respond(send, status, headers, content)
+
+
+def main(argv: Optional[list] = None) -> None:
+    import uvicorn
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5000)))
+    args = parser.parse_args(argv)
+    app.logger.info(f"Starting uvicorn on {args.host}:{args.port}")
+    uvicorn.run(application, host=args.host, port=args.port, lifespan="on")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,710 @@
+"""
+Hot-path benchmarks for the bot.
+
+    python bench.py profanity [--messages 2000] [--length 2000]
+    python bench.py workers [--workers 1,2,4] [--messages 2000]
+    python bench.py names [--members 5000] [--lookups 300]
+    python bench.py leaderboard [--users 50000] [--updates 20000]
+    python bench.py history [--days 730] [--users 2000] [--active 300]
+    python bench.py search [--messages 1000000] [--users 500] [--queries 200]
+    python bench.py raid [--payloads events.jsonl] [--save events.jsonl] [--wave 30] [--spacing 0.5]
+    python bench.py load [--messages 500] [--latency 0.02] [--inline] [--json results.json]
+    python bench.py asyncio [--messages 500] [--clients 32] [--latency 0.05]
+
+Runs against app.py in a scratch directory so no state files are touched.
+"""
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import os
+import collections
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+app = None
+
+VOCAB = [
+    "the", "bro", "what", "is", "going", "on", "lmao", "class", "bass", "passing",
+    "shell", "dickens", "assist", "title", "scrap", "grass", "meme", "clean", "ok",
+    "tomorrow", "french", "fries", "pixel", "karma", "!google", "(hello)", "yes!!",
+]
+
+
+def _load_app(**env):
+    """Import app.py from a scratch directory with the given environment."""
+    global app
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    os.environ.setdefault("DISPATCH_WORKERS", "0")
+    os.environ.update({k: str(v) for k, v in env.items()})
+    app = importlib.import_module("app")
+    logging.disable(logging.CRITICAL)
+    return app
+
+
+class _StubResponse:
+    status_code = 200
+    text = "{}"
+    content = b""
+
+    def json(self):
+        return {"response": {"members": [], "message": {}}}
+
+    def raise_for_status(self):
+        pass
+
+
+def _stub_outbound() -> list:
+    """Replace app.http_request with an in-process stub; returns the call log."""
+    calls = []
+
+    def fake(method, url, **kwargs):
+        calls.append((method, url))
+        return _StubResponse()
+
+    app.http_request = fake
+    return calls
+
+
+def _make_messages(count: int, length: int, swear_rate: float) -> list:
+    swears = app.REGULAR_SWEAR_WORDS + app.INSTANT_BAN_WORDS
+    messages = []
+    for _ in range(count):
+        words = []
+        size = 0
+        while size < length:
+            word = random.choice(swears) if random.random() < swear_rate else random.choice(VOCAB)
+            words.append(word)
+            size += len(word) + 1
+        messages.append(" ".join(words))
+    return messages
+
+
+def _legacy_violation_scan(text: str):
+    # The pre-automaton check_for_violations / is_safe logic, kept for comparison
+    words = text.lower().split()
+    for word in words:
+        if word.strip('.,!?"\'()[]{}').lower() in app.INSTANT_BAN_WORDS:
+            return "instant"
+    for word in words:
+        if word.strip('.,!?"\'()[]{}').lower() in app.REGULAR_SWEAR_WORDS:
+            return "regular"
+    return None
+
+
+def _legacy_is_safe(text: str) -> bool:
+    content = text.lower()
+    for word in app.INSTANT_BAN_WORDS + app.REGULAR_SWEAR_WORDS:
+        if word in content:
+            return False
+    return True
+
+
+def _rate(label: str, func, messages: list, unit: str = "msg/s") -> float:
+    start = time.perf_counter()
+    for text in messages:
+        func(text)
+    elapsed = time.perf_counter() - start
+    rate = len(messages) / elapsed if elapsed else float("inf")
+    print(f"  {label:<32} {rate:>12,.0f} {unit}")
+    return rate
+
+
+def bench_profanity(args) -> None:
+    _load_app()
+    _stub_outbound()
+    random.seed(1)
+    for swear_rate in (0.0, 0.002):
+        messages = _make_messages(args.messages, args.length, swear_rate)
+        print(f"profanity: {args.messages} messages x ~{args.length} chars, swear rate {swear_rate}")
+        legacy = _rate("legacy token scan", _legacy_violation_scan, messages)
+        new = _rate("compiled token scan", lambda t: app.scan_profanity(t, mode="token"), messages)
+        print(f"  {'speedup':<32} {new / legacy:>12.1f}x")
+        legacy = _rate("legacy is_safe", _legacy_is_safe, messages)
+        new = _rate("compiled is_safe", app.is_safe, messages)
+        print(f"  {'speedup':<32} {new / legacy:>12.1f}x")
+
+
+def _worker_process(db_path: str, worker_id: int, messages: int, start_at: float, results) -> None:
+    _load_app(STATE_BACKEND="sqlite", SHARED_STATE="sqlite", STATE_DB_PATH=db_path)
+    _stub_outbound()
+    client = app.app.test_client()
+    rng = random.Random(worker_id)
+    payloads = []
+    for i in range(messages):
+        uid = str(1000 + rng.randrange(200))
+        text = rng.choice(["lol", "what is going on", "clean memes", "ok bro", "tomorrow?", "damn"])
+        payloads.append({"text": text, "sender_type": "user", "name": f"user{uid}", "user_id": uid,
+                         "id": f"{worker_id}-{i}", "group_id": "1", "attachments": []})
+    while time.time() < start_at:
+        time.sleep(0.001)
+    begin = time.perf_counter()
+    for payload in payloads:
+        client.post("/webhook", json=payload)
+    results.put((worker_id, time.perf_counter() - begin))
+
+
+def bench_workers(args) -> None:
+    """Aggregate webhook throughput with N processes sharing one SQLite state DB."""
+    counts = [int(n) for n in args.workers.split(",")]
+    cores = os.cpu_count() or 1
+    ctx = multiprocessing.get_context("spawn")
+    print(f"workers: {args.messages} messages per worker, {cores} CPU core(s), shared SQLite state")
+    baseline = None
+    for n in counts:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="bench-db-"), "state.db")
+        results = ctx.Queue()
+        start_at = time.time() + 3.0
+        procs = [ctx.Process(target=_worker_process, args=(db_path, i, args.messages, start_at, results)) for i in range(n)]
+        for p in procs:
+            p.start()
+        elapsed = [results.get()[1] for _ in procs]
+        for p in procs:
+            p.join()
+        rate = n * args.messages / max(elapsed)
+        baseline = baseline or rate / counts[0]
+        ideal = baseline * min(n, cores)
+        print(f"  {n:>2} worker(s) {rate:>10,.0f} msg/s   {rate / ideal:>6.0%} of linear (capped at {cores} core(s))")
+
+
+SYLLABLES = ["ka", "ri", "to", "mo", "lex", "sam", "an", "jo", "dar", "ny", "x", "ee", "zo", "pro", "lil", "big"]
+
+
+def _make_nickname(rng: random.Random) -> str:
+    words = ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(rng.randint(1, 3))]
+    return " ".join(words) + (str(rng.randint(1, 99)) if rng.random() < 0.3 else "")
+
+
+def _typo(rng: random.Random, name: str) -> str:
+    chars = list(name)
+    pos = rng.randrange(len(chars))
+    if rng.random() < 0.5:
+        chars[pos] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    else:
+        del chars[pos]
+    return "".join(chars)
+
+
+def _legacy_fuzzy_find(target: str, members: list, former: dict):
+    # The pre-index fuzzy_find_member, kept for comparison
+    from fuzzywuzzy import fuzz, process
+    for m in members:
+        if (m.get("nickname") or "").lower() == target.lower():
+            return str(m["user_id"]), m["nickname"]
+    nicknames = [m.get("nickname", "") for m in members if m.get("nickname")]
+    nick_lower = [n.lower() for n in nicknames]
+    match = process.extractOne(target, nick_lower, score_cutoff=92, scorer=fuzz.token_sort_ratio)
+    if match:
+        idx = nick_lower.index(match[0])
+        return str(members[idx]["user_id"]), nicknames[idx]
+    for uid, nick in former.items():
+        if nick.lower() == target.lower():
+            return uid, nick
+    return None
+
+
+def bench_names(args) -> None:
+    _load_app()
+    _stub_outbound()
+    rng = random.Random(7)
+    members = [{"user_id": str(10_000 + i), "id": str(i), "nickname": _make_nickname(rng)} for i in range(args.members)]
+    former = {str(90_000 + i): _make_nickname(rng) for i in range(args.members // 5)}
+    app._fetch_group = lambda: {"members": members}
+    app.refresh_roster(force=True)
+    app.former_members.replace_all(former)
+    names = [m["nickname"] for m in members] + list(former.values())
+    queries = []
+    for _ in range(args.lookups):
+        roll = rng.random()
+        name = rng.choice(names)
+        queries.append(name if roll < 0.3 else _typo(rng, name) if roll < 0.8 else _make_nickname(rng))
+
+    print(f"names: {args.members} members + {len(former)} former, {args.lookups} lookups (exact/typo/miss)")
+    start = time.perf_counter()
+    app.get_name_index()
+    print(f"  {'index build':<32} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+    legacy = _rate("legacy extractOne scan", lambda q: _legacy_fuzzy_find(q, members, former), queries, "lookups/s")
+    new = _rate("trigram index", app.fuzzy_find_member, queries, "lookups/s")
+    print(f"  {'speedup':<32} {new / legacy:>12.1f}x")
+
+
+def _legacy_rankings(counts: dict, karma: dict) -> tuple:
+    """The pre-index leaderboard: re-sort counts and re-parse every karma record per call."""
+    top_msgs = sorted(counts.items(), key=lambda kv: (-int(kv[1]), kv[0]))[:3]
+    scores = {}
+    for uid, val in karma.items():
+        if isinstance(val, dict):
+            scores[uid] = val.get("score", 0)
+        else:
+            try:
+                scores[uid] = int(val)
+            except (ValueError, TypeError):
+                scores[uid] = 0
+    positive = sorted(((k, v) for k, v in scores.items() if v > 0), key=lambda kv: (-kv[1], kv[0]))[:5]
+    negative = sorted(((k, v) for k, v in scores.items() if v < 0), key=lambda kv: (kv[1], kv[0]))[:5]
+    return top_msgs, positive, negative
+
+
+def bench_leaderboard(args) -> None:
+    _load_app()
+    _stub_outbound()
+    rng = random.Random(7)
+    uids = [str(10_000 + i) for i in range(args.users)]
+    # Old bins mix bare integers with {"score", "name"} records
+    karma = {uid: rng.randint(-50, 50) if i % 2 else {"score": rng.randint(-50, 50), "name": f"user{uid}"}
+             for i, uid in enumerate(uids)}
+    app.karma_history.replace_all(karma)
+    app.karma_sync.for_group().board = None
+    tracker = app._ensure_today_keys()
+    for uid in uids:
+        tracker.counts[uid] = rng.randint(1, 200)
+    tracker.ranking = app.TopIndex((uid, -n) for uid, n in tracker.counts.items())
+    app._fetch_group = lambda: {"members": []}
+    app.schedule_save = lambda *a, **k: None
+
+    print(f"leaderboard: {args.users} users with counts and karma, {args.updates} updates, "
+          f"{'sortedcontainers' if app.SortedList is not None else 'bisect list'} index")
+    start = time.perf_counter()
+    with app.karma_lock:
+        app._karma_board()
+    print(f"  {'karma normalize + index build':<32} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+    updates = [(rng.choice(uids), rng.choice([-1, 1])) for _ in range(args.updates)]
+    _rate("message count updates", lambda u: app.increment_user_message_count(u[0], "x", "hi"), updates, "updates/s")
+    _rate("karma votes", lambda u: app.record_karma_vote(u[0], "x", u[1]), updates, "votes/s")
+    builds = list(range(50))
+    snapshot = app.karma_history.snapshot()
+    legacy = _rate("legacy sort per leaderboard", lambda _: _legacy_rankings(tracker.counts, snapshot), builds[:10], "boards/s")
+    new = _rate("indexed leaderboard", lambda _: app._build_leaderboard_message(), builds, "boards/s")
+    print(f"  {'speedup':<32} {new / legacy:>12.1f}x")
+
+
+def bench_history(args) -> None:
+    import datetime
+    _load_app()
+    _stub_outbound()
+    rng = random.Random(7)
+    history = app.daily_history.for_group()
+    today = datetime.date.today()
+    days = [(today - datetime.timedelta(days=back)).isoformat() for back in range(args.days, 0, -1)]
+    archived = {}
+    start = time.perf_counter()
+    for date in days:
+        counts = {str(10_000 + rng.randrange(args.users)): rng.randint(1, 80) for _ in range(args.active)}
+        archived[date] = counts
+        history.append(date, counts)
+    elapsed = time.perf_counter() - start
+    with open(history.file_path, "rb") as f:
+        size = len(f.read())
+    print(f"history: {args.days} days archived, {args.active} active of {args.users} users per day")
+    print(f"  {'append (incl. compactions)':<32} {elapsed / len(days) * 1000:>10.2f} ms/day")
+    print(f"  {'archive on disk':<32} {size / 1024:>10.0f} KiB  "
+          f"({len(history.days)} days, {len(history.months)} months, base {'yes' if history.base else 'no'})")
+
+    def legacy_top(window):
+        # What a flat per-day log would need: re-sum every day in range per query
+        cutoff = days[-window] if window else days[0]
+        summed = collections.Counter()
+        for date, counts in archived.items():
+            if date >= cutoff:
+                summed.update(counts)
+        return summed.most_common(5)
+
+    uids = [str(10_000 + rng.randrange(args.users)) for _ in range(200)]
+    for span, window in (("week", 7), ("month", 30), ("all", None)):
+        legacy = _rate(f"scan every day: {span}", lambda _: legacy_top(window), range(5), "boards/s")
+        new = _rate(f"archive top: {span}", lambda _: app.top_message_counts(window, 5), range(200), "boards/s")
+        _rate(f"archive !stats: {span}", lambda uid: app.message_count(uid, window), uids, "users/s")
+        print(f"  {'speedup':<32} {new / legacy:>12.1f}x")
+
+
+def bench_search(args) -> None:
+    import resource
+    _load_app()
+    _stub_outbound()
+    rng = random.Random(7)
+    # Zipf-ish vocabulary: a few words in most messages, a long tail of rare ones
+    vocab = [f"w{i}" for i in range(20_000)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    users = [str(10_000 + i) for i in range(args.users)]
+    index = app.message_search.for_group()
+    start_at = time.time() - 365 * 86400
+    step = 365 * 86400 / args.messages
+    print(f"search: {args.messages:,} messages from {args.users} users over a year, {len(vocab):,}-word vocabulary")
+    start = time.perf_counter()
+    batch = 1000
+    for seq in range(0, args.messages, batch):
+        for i in range(seq, min(seq + batch, args.messages)):
+            words = rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(3, 15))
+            app.index_message(f"m{i}", rng.choice(users), "user", start_at + i * step, " ".join(words))
+        index.flush()
+    elapsed = time.perf_counter() - start
+    print(f"  {'index (batches of 1000)':<32} {args.messages / elapsed:>12,.0f} msg/s")
+    start = time.perf_counter()
+    steps = 0
+    while not index.merge():
+        steps += 1
+    print(f"  {'merge to done':<32} {time.perf_counter() - start:>10.1f} s   ({steps} steps)")
+    size = sum(os.path.getsize(index.db_path + ext) for ext in ("", "-wal") if os.path.exists(index.db_path + ext))
+    print(f"  {'index + text on disk':<32} {size / 2**20:>10.0f} MiB")
+
+    month_ago = time.time() - 30 * 86400
+    cases = [
+        ("common word", lambda: index.search("w0")),
+        ("rare word", lambda: index.search(rng.choice(vocab[5000:]))),
+        ("two words", lambda: index.search(f"w1 {rng.choice(vocab[50:500])}")),
+        ("prefix", lambda: index.search("w12*")),
+        ("common word + user", lambda: index.search("w3", user_id=rng.choice(users))),
+        ("mid word + last month", lambda: index.search(rng.choice(vocab[100:1000]), since=month_ago)),
+    ]
+    print(f"  {'query':<32} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, run in cases:
+        samples = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            run()
+            samples.append(time.perf_counter() - t)
+        print(f"  {label:<32} {_percentile(samples, 0.5) * 1e3:>8.2f} {_percentile(samples, 0.99) * 1e3:>8.2f}")
+    print(f"  {'peak RSS':<32} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:>10.0f} MiB")
+
+
+class _ReplayClock:
+    """Stands in for app's `time` module so recorded timestamps drive every window and TTL."""
+
+    def __init__(self, start: float):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        pass
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def _webhook_payload(seq: int, at: float, text: str, uid: str, name: str, system: bool = False) -> dict:
+    return {"id": f"replay-{seq}", "created_at": at, "text": text, "group_id": "1", "attachments": [],
+            "sender_type": "system" if system else "user", "name": "GroupMe" if system else name,
+            "user_id": "system" if system else uid}
+
+
+def _synthetic_raid(args) -> list:
+    """Quiet chatter with the odd join, then a join wave, as webhook payloads ordered by created_at."""
+    rng = random.Random(11)
+    events, at, seq = [], 1_700_000_000.0, 0
+    wave_at = at + args.minutes * 60
+    while at < wave_at:
+        at += rng.expovariate(2.0)
+        seq += 1
+        if rng.random() < 0.002:
+            events.append(_webhook_payload(seq, at, f"newbie{seq} has joined the group", "", "", system=True))
+        else:
+            uid = str(1000 + rng.randrange(50))
+            events.append(_webhook_payload(seq, at, rng.choice(VOCAB) + " " + rng.choice(VOCAB), uid, f"user{uid}"))
+    for i in range(args.wave):
+        seq += 1
+        join = _webhook_payload(seq, wave_at + i * args.spacing, f"raider{i} has joined the group", "", "", system=True)
+        join["raid"] = True  # ground truth for the report; app.py ignores unknown keys
+        events.append(join)
+        seq += 1
+        events.append(_webhook_payload(seq, wave_at + i * args.spacing + 0.1, "join my server https://spam.example",
+                                       str(9000 + i), f"raider{i}"))
+    return events
+
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))] if ordered else 0.0
+
+
+def bench_raid(args) -> None:
+    """Replay join waves through /webhook on a virtual clock and report detection latency."""
+    if args.payloads:
+        with open(args.payloads, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = _synthetic_raid(args)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(e) + "\n" for e in events)
+    _load_app()
+    calls = _stub_outbound()
+    clock = _ReplayClock(float(events[0].get("created_at") or time.time()))
+    app.time = clock
+    client = app.app.test_client()
+
+    latencies = {"system": [], "user": []}
+    recent_joins = collections.deque()
+    detected = None
+    wave = {"start": None, "joins": 0}
+    begin = time.perf_counter()
+    for event in events:
+        clock.now = max(clock.now, float(event.get("created_at") or clock.now))
+        is_join = event["sender_type"] == "system" and "joined the group" in event["text"]
+        if is_join:
+            if event.get("raid"):
+                wave["start"] = wave["start"] or clock.now
+                wave["joins"] += 1
+            recent_joins.append(clock.now)
+            while recent_joins[0] <= clock.now - app.RAID_WINDOW_SECONDS:
+                recent_joins.popleft()
+        start = time.perf_counter()
+        client.post("/webhook", json=event)
+        latencies["system" if event["sender_type"] == "system" else "user"].append(time.perf_counter() - start)
+        if detected is None and app.lockdown_status():
+            # Joins in the window that tripped the detector, and how long ago the first one was
+            detected = (len(recent_joins), clock.now - recent_joins[0] if recent_joins else 0.0,
+                        wave["joins"], clock.now - wave["start"] if wave["start"] else None)
+    elapsed = time.perf_counter() - begin
+
+    print(f"raid: {len(events)} events replayed in {elapsed:.2f}s ({len(events) / elapsed:,.0f} events/s), "
+          f"join limit {app.RAID_JOIN_LIMIT} per {app.RAID_WINDOW_SECONDS:g}s")
+    for kind, samples in latencies.items():
+        if samples:
+            print(f"  {kind + ' events':<16} p50 {_percentile(samples, 0.5) * 1e3:7.2f} ms   "
+                  f"p99 {_percentile(samples, 0.99) * 1e3:7.2f} ms   n={len(samples)}")
+    if detected:
+        print(f"  lockdown after {detected[0]} joins in the window, {detected[1]:.1f}s (event time) after the first")
+        if detected[3] is not None:
+            print(f"  raid wave: caught on its join #{detected[2]}, {detected[3]:.1f}s after the wave started")
+    else:
+        print("  no lockdown triggered")
+    print(f"  outbound calls: {len(calls)}")
+
+
+def _load_phases(n: int, admin_ids: list) -> dict:
+    """Webhook payloads per message type, all from members of the fake group."""
+    rng = random.Random(5)
+    seq = itertools.count(1)
+    swears = ["damn", "shit", "wtf"]
+
+    def msg(text, uid, **extra):
+        payload = {"id": f"{next(seq):09d}", "text": text, "sender_type": "user", "name": f"member{uid}",
+                   "user_id": uid, "group_id": "1", "attachments": [], "created_at": int(time.time())}
+        payload.update(extra)
+        return payload
+
+    def member():
+        return str(1000 + rng.randrange(200))
+
+    chatter = [msg(" ".join(rng.choice(VOCAB) for _ in range(rng.randint(3, 15))), member()) for _ in range(n)]
+    karma = []
+    for _ in range(n):
+        target = rng.choice(chatter)
+        reply = {"type": "reply", "base_reply_id": target["id"], "reply_id": target["id"], "user_id": target["user_id"]}
+        karma.append(msg(rng.choice(["upkarma", "downkarma", "upkarma lol"]), member(), attachments=[reply]))
+    # Mostly member commands; a few admin ones spread over the admins so the spam rules stay quiet
+    commands = [msg(rng.choice(["!help", "!leaderboard", "!google cats", "!foo", "5!"]), member()) for _ in range(n - n // 10)]
+    commands += [msg(rng.choice(["!strikes member1001", "!help", "!jobs"]), admin_ids[i % len(admin_ids)])
+                 for i in range(n // 10)]
+    rng.shuffle(commands)
+    return {
+        "chatter": chatter,
+        "swear storm": [msg(f"this is {rng.choice(swears)} bro", member()) for _ in range(n)],
+        "karma votes": karma,
+        "commands": commands,
+        "spam flood": [msg("JOIN MY SERVER", str(1000 + (i // 20) % 200)) for i in range(n)],
+    }
+
+
+def bench_load(args) -> None:
+    """Replay message mixes through /webhook against fakeapi.py and report latency and outbound calls."""
+    from fakeapi import fake_api_env, start_fake_api
+    server = start_fake_api(latency=args.latency)
+    server.add_members(200)
+    env = fake_api_env(server)
+    env["DISPATCH_WORKERS"] = "0" if args.inline else os.environ.get("DISPATCH_WORKERS", "4")
+    _load_app(**env)
+    client = app.app.test_client()
+    phases = _load_phases(args.messages, list(app.ADMIN_IDS))
+    for payload in phases["chatter"]:
+        # Fetchable by id, so karma replies that miss the message cache still resolve
+        server.messages[payload["id"]] = payload
+
+    mode = "inline outbound" if args.inline else f"{app.DISPATCH_WORKERS} dispatcher workers"
+    print(f"load: {args.messages} messages per type, fake API latency {args.latency * 1000:.0f} ms, {mode}")
+    print(f"  {'type':<14} {'p50 ms':>8} {'p99 ms':>8} {'msg/s':>9} {'out/msg':>8}  top outbound")
+    results = {}
+    for name, payloads in phases.items():
+        before = dict(server.calls)
+        samples = []
+        begin = time.perf_counter()
+        for payload in payloads:
+            start = time.perf_counter()
+            client.post("/webhook", json=payload)
+            samples.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - begin
+        app._drain_dispatcher()
+        calls = {k: v - before.get(k, 0) for k, v in server.calls.items() if v != before.get(k, 0)}
+        total = sum(calls.values())
+        top = ", ".join(f"{k} x{v}" for k, v in sorted(calls.items(), key=lambda kv: -kv[1])[:2])
+        results[name] = {"p50_ms": _percentile(samples, 0.5) * 1e3, "p99_ms": _percentile(samples, 0.99) * 1e3,
+                         "msg_per_s": len(payloads) / elapsed, "outbound": calls}
+        r = results[name]
+        print(f"  {name:<14} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['msg_per_s']:>9,.0f} "
+              f"{total / len(payloads):>8.2f}  {top}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args) | {"func": None}, "results": results}, f, indent=2)
+    server.shutdown()
+
+
+def _serve_mode(mode: str, env: dict, ports) -> None:
+    """Child process: host app.py over a real socket, Flask/WSGI threads or asgi.py."""
+    _load_app(**env)
+    if mode == "flask":
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", 0, app.app, threaded=True)
+        ports.put(server.server_port)
+        server.serve_forever()
+    else:
+        import socket
+        import uvicorn
+        import asgi
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1024)
+        ports.put(sock.getsockname()[1])
+        # No lifespan: skips the leaderboard thread and startup post; outbound starts on first request
+        config = uvicorn.Config(asgi.application, lifespan="off", log_level="warning", backlog=1024)
+        uvicorn.Server(config).run(sockets=[sock])
+
+
+def _post_concurrently(port: int, payloads: list, clients: int) -> list:
+    """POST every payload to /webhook from `clients` keep-alive connections; returns latencies."""
+    import http.client
+    import threading
+    pending = iter(payloads)
+    lock = threading.Lock()
+    samples = []
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        while True:
+            with lock:
+                payload = next(pending, None)
+            if payload is None:
+                break
+            body = json.dumps(payload)
+            start = time.perf_counter()
+            conn.request("POST", "/webhook", body=body, headers={"Content-Type": "application/json"})
+            conn.getresponse().read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.append(elapsed)
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def bench_asyncio(args) -> None:
+    """Same swear storm against the Flask app (threaded WSGI + dispatcher) and asgi.py, over sockets."""
+    from fakeapi import fake_api_env, start_fake_api
+    server = start_fake_api(latency=args.latency)
+    server.add_members(200)
+    env = fake_api_env(server)
+    env["DISPATCH_WORKERS"] = os.environ.get("DISPATCH_WORKERS", "4")
+    ctx = multiprocessing.get_context("spawn")
+    print(f"asyncio: {args.messages} swear-storm messages from {args.clients} concurrent clients, "
+          f"fake API latency {args.latency * 1000:.0f} ms, {env['DISPATCH_WORKERS']} dispatcher workers")
+    print(f"  {'mode':<22} {'p50 ms':>8} {'p99 ms':>8} {'msg/s':>9} {'outbound':>9} {'all sent s':>11}")
+    for mode, label in (("flask", "flask (wsgi threads)"), ("asgi", "asgi.py (uvicorn)")):
+        ports = ctx.Queue()
+        proc = ctx.Process(target=_serve_mode, args=(mode, env, ports), daemon=True)
+        proc.start()
+        port = ports.get(timeout=60)
+        payloads = _load_phases(args.messages, ["0"])["swear storm"]
+        for payload in payloads:
+            payload["id"] = f"{mode}-{payload['id']}"
+        with server.lock:
+            server.calls.clear()
+        begin = time.time()
+        samples = _post_concurrently(port, payloads, args.clients)
+        elapsed = time.time() - begin
+        # Outbound is done once the fake API has gone quiet
+        while time.time() - max(server.last_call_at, begin) < 1.0:
+            time.sleep(0.1)
+        outbound = sum(v for k, v in server.calls.items() if k.startswith(("POST /groupme/v3/bots", "DELETE ")))
+        print(f"  {label:<22} {_percentile(samples, 0.5) * 1e3:>8.2f} {_percentile(samples, 0.99) * 1e3:>8.2f} "
+              f"{len(samples) / elapsed:>9,.0f} {outbound:>9} {server.last_call_at - begin:>11.2f}")
+        proc.terminate()
+        proc.join()
+    server.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("profanity", help="message throughput of the swear-word matcher")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--length", type=int, default=2000)
+    p.set_defaults(func=bench_profanity)
+
+    p = sub.add_parser("workers", help="webhook throughput across N processes sharing SQLite state")
+    p.add_argument("--workers", default="1,2,4")
+    p.add_argument("--messages", type=int, default=2000)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("names", help="fuzzy member-name lookups against a large roster")
+    p.add_argument("--members", type=int, default=5000)
+    p.add_argument("--lookups", type=int, default=300)
+    p.set_defaults(func=bench_names)
+
+    p = sub.add_parser("leaderboard", help="leaderboard builds and rank updates for a large group")
+    p.add_argument("--users", type=int, default=50_000)
+    p.add_argument("--updates", type=int, default=20_000)
+    p.set_defaults(func=bench_leaderboard)
+
+    p = sub.add_parser("history", help="range leaderboards and per-user stats over a long daily archive")
+    p.add_argument("--days", type=int, default=730)
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--active", type=int, default=300, help="users posting on a given day")
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("search", help="!search query latency over a large message index")
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--queries", type=int, default=200)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("raid", help="replay join waves and measure raid detection latency")
+    p.add_argument("--payloads", help="JSONL of recorded webhook payloads (with created_at) to replay")
+    p.add_argument("--save", help="write the synthetic payload stream to this JSONL file")
+    p.add_argument("--minutes", type=float, default=30, help="quiet chatter before the wave")
+    p.add_argument("--wave", type=int, default=30, help="joins in the wave")
+    p.add_argument("--spacing", type=float, default=0.5, help="seconds between wave joins")
+    p.set_defaults(func=bench_raid)
+
+    p = sub.add_parser("load", help="replay message mixes through /webhook against fakeapi.py")
+    p.add_argument("--messages", type=int, default=500, help="messages per type")
+    p.add_argument("--latency", type=float, default=0.0, help="fake API latency per request (seconds)")
+    p.add_argument("--inline", action="store_true", help="run outbound calls inline (DISPATCH_WORKERS=0)")
+    p.add_argument("--json", help="also write the results to this file")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("asyncio", help="Flask/WSGI vs asgi.py under concurrent webhook load")
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--clients", type=int, default=32, help="concurrent webhook connections")
+    p.add_argument("--latency", type=float, default=0.05, help="fake API latency per request (seconds)")
+    p.set_defaults(func=bench_asyncio)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
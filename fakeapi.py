@@ -0,0 +1,300 @@
+"""
+Local stand-in for the HTTP APIs the bot talks to, for benchmarks and
+manual testing without real credentials.
+
+    python fakeapi.py [--port 8765]
+
+Then point the bot at it with the environment it prints (GROUPME_API,
+JSONBIN_API, TAVILY_API, ...).
+
+Supported endpoints:
+    GroupMe   POST   /groupme/v3/bots/post
+              GET    /groupme/v3/groups/<group>
+              GET    /groupme/v3/groups/<group>/messages/<message>
+              DELETE /groupme/v3/conversations/<group>/messages/<message>
+              POST   /groupme/v3/groups/<group>/members/<membership>/remove
+              POST   /groupme/v3/groups/<group>/members/add
+              GET    /groupme/v3/groups/<group>/members/results/<results>
+              POST   /groupme/v3/direct_messages
+    JSONBin   GET    /jsonbin/v3/b/<bin>/latest      (honours X-Bin-Meta: false)
+              PUT    /jsonbin/v3/b/<bin>
+    Tavily    POST   /tavily/search
+    Files     GET    /files/<name>                   (honours Range unless honor_range is off)
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeApiServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def _reply(self, status: int, payload: Any = None) -> None:
+        body = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method: str) -> None:
+        path = self.path.split("?", 1)[0]
+        self.server.count(method, path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        for route_method, pattern, handler in ROUTES:
+            if route_method != method:
+                continue
+            match = pattern.fullmatch(path)
+            if match:
+                # None: the handler wrote its own response
+                result = handler(self.server, self, *match.groups())
+                if result is not None:
+                    self._reply(*result)
+                return
+        self._reply(404, {"error": f"no fake route for {method} {path}"})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], latency: float = 0.0):
+        super().__init__(address, FakeApiHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bins: Dict[str, Any] = {}
+        self.bin_versions: Dict[str, int] = {}
+        self.calls: Dict[str, int] = {}
+        self.last_call_at = 0.0
+        self.members: List[Dict[str, Any]] = []
+        self.messages: Dict[str, Dict[str, Any]] = {}
+        self.posts: List[str] = []
+        self.pending_adds: Dict[str, List[Dict[str, Any]]] = {}
+        self.files: Dict[str, Tuple[bytes, str]] = {}
+        self.file_requests: List[Tuple[str, Optional[str]]] = []
+        self.honor_range = True
+
+    def add_members(self, count: int, start_id: int = 1000) -> None:
+        """Seed the fake group with `count` members."""
+        with self.lock:
+            for i in range(count):
+                uid = str(start_id + i)
+                self.members.append({"user_id": uid, "id": f"m{uid}", "nickname": f"member{uid}"})
+
+    def add_file(self, name: str, data: bytes, content_type: str) -> str:
+        """Serve `data` at /files/<name>; returns its URL."""
+        with self.lock:
+            self.files[name] = (data, content_type)
+        return f"{self.base_url}/files/{name}"
+
+    def count(self, method: str, path: str) -> None:
+        # Collapse ids (any segment with a digit, bar the API version) so
+        # counts group by endpoint, not by message
+        key = f"{method} {re.sub(r'/(?!v[0-9]+(?=/|$))[^/]*[0-9][^/]*', '/:id', path)}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.last_call_at = time.time()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def _jsonbin_read(server: FakeApiServer, handler: FakeApiHandler, bin_id: str):
+    with server.lock:
+        record = server.bins.get(bin_id, {})
+        version = server.bin_versions.get(bin_id, 0)
+    if handler.headers.get("X-Bin-Meta", "").lower() == "false":
+        return 200, record
+    return 200, {"record": record, "metadata": {"id": bin_id, "version": version}}
+
+
+def _jsonbin_write(server: FakeApiServer, handler: FakeApiHandler, bin_id: str):
+    record = handler._body()
+    if not isinstance(record, (dict, list)):
+        return 400, {"message": "Bin cannot be blank"}
+    with server.lock:
+        server.bins[bin_id] = record
+        server.bin_versions[bin_id] = server.bin_versions.get(bin_id, 0) + 1
+        version = server.bin_versions[bin_id]
+    return 200, {"record": record, "metadata": {"parentId": bin_id, "version": version}}
+
+
+def _groupme_bot_post(server: FakeApiServer, handler: FakeApiHandler):
+    body = handler._body() or {}
+    with server.lock:
+        server.posts.append(body.get("text", ""))
+    return 202, None
+
+
+def _groupme_group(server: FakeApiServer, handler: FakeApiHandler, group_id: str):
+    with server.lock:
+        members = list(server.members)
+    return 200, {"response": {"id": group_id, "members": members, "share_url": f"{server.base_url}/join/{group_id}"}}
+
+
+def _groupme_message(server: FakeApiServer, handler: FakeApiHandler, group_id: str, message_id: str):
+    with server.lock:
+        message = server.messages.get(message_id)
+    if message is None:
+        return 404, {"meta": {"code": 404, "errors": ["not found"]}}
+    return 200, {"response": {"message": message}}
+
+
+def _groupme_delete(server: FakeApiServer, handler: FakeApiHandler, group_id: str, message_id: str):
+    with server.lock:
+        server.messages.pop(message_id, None)
+    return 204, None
+
+
+def _groupme_remove(server: FakeApiServer, handler: FakeApiHandler, group_id: str, membership_id: str):
+    with server.lock:
+        before = len(server.members)
+        server.members = [m for m in server.members if m.get("id") != membership_id]
+        removed = len(server.members) != before
+    return (200, {"response": None}) if removed else (404, {"meta": {"code": 404, "errors": ["not found"]}})
+
+
+def _groupme_add(server: FakeApiServer, handler: FakeApiHandler, group_id: str):
+    added = [{"user_id": str(m.get("user_id")), "id": f"m{m.get('user_id')}", "nickname": m.get("nickname")}
+             for m in (handler._body() or {}).get("members", [])]
+    with server.lock:
+        results_id = f"{len(server.pending_adds) + 1:08x}"
+        server.pending_adds[results_id] = added
+        server.members.extend(added)
+    return 202, {"response": {"results_id": results_id}}
+
+
+def _groupme_add_results(server: FakeApiServer, handler: FakeApiHandler, group_id: str, results_id: str):
+    with server.lock:
+        added = server.pending_adds.get(results_id)
+    if added is None:
+        return 404, {"meta": {"code": 404, "errors": ["not found"]}}
+    return 200, {"response": {"members": added}}
+
+
+def _groupme_dm(server: FakeApiServer, handler: FakeApiHandler):
+    return 201, {"response": {"direct_message": handler._body()}}
+
+
+def _file(server: FakeApiServer, handler: FakeApiHandler, name: str):
+    range_header = handler.headers.get("Range")
+    with server.lock:
+        item = server.files.get(name)
+        server.file_requests.append((name, range_header))
+    if item is None:
+        return 404, {"error": f"no file {name}"}
+    data, content_type = item
+    status, body, headers = 200, data, {}
+    match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header or "")
+    if match and server.honor_range:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), len(data) - 1) if match.group(2) else len(data) - 1
+        if start >= len(data):
+            status, body, headers = 416, b"", {"Content-Range": f"bytes */{len(data)}"}
+        else:
+            status, body = 206, data[start:end + 1]
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Content-Length", str(len(body)))
+    for key, value in headers.items():
+        handler.send_header(key, value)
+    handler.end_headers()
+    try:
+        handler.wfile.write(body)
+    except ConnectionError:
+        pass  # the client read what it needed and hung up
+    return None
+
+
+def _tavily_search(server: FakeApiServer, handler: FakeApiHandler):
+    query = (handler._body() or {}).get("query", "")
+    return 200, {"query": query, "answer": f"Here is a clean summary about {query}.", "results": []}
+
+
+ROUTES = [
+    ("POST", re.compile(r"/groupme/v3/bots/post"), _groupme_bot_post),
+    ("GET", re.compile(r"/groupme/v3/groups/([^/]+)"), _groupme_group),
+    ("GET", re.compile(r"/groupme/v3/groups/([^/]+)/messages/([^/]+)"), _groupme_message),
+    ("DELETE", re.compile(r"/groupme/v3/conversations/([^/]+)/messages/([^/]+)"), _groupme_delete),
+    ("POST", re.compile(r"/groupme/v3/groups/([^/]+)/members/([^/]+)/remove"), _groupme_remove),
+    ("POST", re.compile(r"/groupme/v3/groups/([^/]+)/members/add"), _groupme_add),
+    ("GET", re.compile(r"/groupme/v3/groups/([^/]+)/members/results/([^/]+)"), _groupme_add_results),
+    ("POST", re.compile(r"/groupme/v3/direct_messages"), _groupme_dm),
+    ("GET", re.compile(r"/jsonbin/v3/b/([^/]+)/latest"), _jsonbin_read),
+    ("PUT", re.compile(r"/jsonbin/v3/b/([^/]+)"), _jsonbin_write),
+    ("POST", re.compile(r"/tavily/search"), _tavily_search),
+    ("GET", re.compile(r"/files/([^/]+)"), _file),
+]
+
+
+def start_fake_api(port: int = 0, latency: float = 0.0, host: str = "127.0.0.1") -> FakeApiServer:
+    """Start the stand-in on a background thread and return the server."""
+    server = FakeApiServer((host, port), latency=latency)
+    threading.Thread(target=server.serve_forever, name="fakeapi", daemon=True).start()
+    return server
+
+
+def fake_api_env(server: FakeApiServer, bin_id: str = "karma", group_id: str = "1") -> Dict[str, str]:
+    """Environment that points app.py at this server."""
+    return {
+        "GROUPME_API": f"{server.base_url}/groupme/v3",
+        "ACCESS_TOKEN": "fake",
+        "GROUP_ID": group_id,
+        "BOT_ID": "fake-bot",
+        "JSONBIN_API": f"{server.base_url}/jsonbin/v3",
+        "JSONBIN_BIN_ID": bin_id,
+        "JSONBIN_MASTER_KEY": "fake",
+        "TAVILY_API": f"{server.base_url}/tavily",
+        "TAVILY_API_KEY": "fake",
+    }
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to sleep per request")
+    parser.add_argument("--members", type=int, default=50, help="members in the fake group")
+    args = parser.parse_args(argv)
+    server = FakeApiServer(("127.0.0.1", args.port), latency=args.latency)
+    server.add_members(args.members)
+    print(f"Fake API listening on {server.base_url}")
+    for key, value in fake_api_env(server).items():
+        print(f"  {key}={value}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Shared fixtures: app.py imported once per session, pointed at a fakeapi.py
+server, with its state files in a scratch directory and the dispatcher
+running jobs inline.
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakeapi import fake_api_env, start_fake_api  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_api():
+    server = start_fake_api()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def app(fake_api, tmp_path_factory):
+    os.chdir(tmp_path_factory.mktemp("state"))
+    os.environ.update(fake_api_env(fake_api))
+    os.environ["DISPATCH_WORKERS"] = "0"
+    import app as module
+    return module
@@ -0,0 +1,112 @@
+"""probe_image_size() against Pillow reading the whole file, served by fakeapi.py."""
+import io
+import itertools
+import random
+
+import pytest
+from PIL import Image
+
+_names = itertools.count()
+
+
+def noise(rng, size, mode="RGB"):
+    image = Image.effect_noise(size, rng.randint(20, 80)).convert(mode)
+    if mode == "RGBA":
+        image.putalpha(Image.linear_gradient("L").resize(size))
+    return image
+
+
+def encode(image, fmt, **params):
+    buf = io.BytesIO()
+    image.save(buf, fmt, **params)
+    return buf.getvalue()
+
+
+def with_jpeg_segments(data, marker, count, size=65000):
+    """`data` with `count` filler segments of `size` bytes inserted right after SOI."""
+    segment = bytes([0xFF, marker]) + (size + 2).to_bytes(2, "big") + b"\0" * size
+    return data[:2] + segment * count + data[2:]
+
+
+def variants(rng):
+    """(label, bytes, content type) for the formats the header parser reads."""
+    for _ in range(3):
+        size = (rng.randint(1, 1200), rng.randint(1, 900))
+        yield "png", encode(noise(rng, size), "PNG"), "image/png"
+        yield "png-rgba", encode(noise(rng, size, "RGBA"), "PNG"), "image/png"
+        yield "gif", encode(noise(rng, size, "L"), "GIF"), "image/gif"
+        yield "jpeg", encode(noise(rng, size), "JPEG", quality=90), "image/jpeg"
+        yield "jpeg-progressive", encode(noise(rng, size), "JPEG", progressive=True), "image/jpeg"
+        # APP15 filler standing in for a large EXIF/XMP block before the SOF marker
+        yield "jpeg-app", with_jpeg_segments(encode(noise(rng, size), "JPEG"), 0xEF, 1), "image/jpeg"
+        yield "webp", encode(noise(rng, size), "WEBP"), "image/webp"
+        yield "webp-lossless", encode(noise(rng, size), "WEBP", lossless=True), "image/webp"
+        yield "webp-alpha", encode(noise(rng, size, "RGBA"), "WEBP"), "image/webp"
+
+
+@pytest.fixture
+def serve(app, fake_api):
+    """Serve bytes from fakeapi under a fresh name; returns (url, requests made for it)."""
+    app._image_size_cache.clear()
+    fake_api.honor_range = True
+
+    def add(data, content_type):
+        name = f"img{next(_names)}"
+        url = fake_api.add_file(name, data, content_type)
+        return url, lambda: [r for n, r in fake_api.file_requests if n == name]
+
+    yield add
+    fake_api.honor_range = True
+
+
+@pytest.mark.parametrize("honor_range", [True, False])
+def test_header_probe_matches_pillow(app, fake_api, serve, honor_range):
+    fake_api.honor_range = honor_range
+    for label, data, content_type in variants(random.Random(16)):
+        url, requests = serve(data, content_type)
+        with Image.open(io.BytesIO(data)) as image:
+            expected = image.size
+        assert app.probe_image_size(url) == expected, label
+        # One ranged request; the rest of the file is never fetched
+        assert requests() == [f"bytes=0-{app.IMAGE_PROBE_BYTES - 1}"], label
+
+
+def test_size_is_cached_per_url(app, serve):
+    url, requests = serve(encode(noise(random.Random(1), (40, 30)), "PNG"), "image/png")
+    assert app.probe_image_size(url) == (40, 30)
+    assert app.probe_image_size(url) == (40, 30)
+    assert len(requests()) == 1
+
+
+@pytest.mark.parametrize("honor_range", [True, False])
+def test_pillow_fallback_continues_from_the_probed_bytes(app, fake_api, serve, honor_range):
+    fake_api.honor_range = honor_range
+    rng = random.Random(61)
+    # Formats parse_image_size() can't read: Pillow sizes them from the head alone
+    for fmt, content_type in (("BMP", "image/bmp"), ("TIFF", "image/tiff")):
+        data = encode(noise(rng, (700, 500)), fmt)
+        assert len(data) > app.IMAGE_PROBE_BYTES
+        url, requests = serve(data, content_type)
+        assert app.probe_image_size(url) == (700, 500), fmt
+        assert len(requests()) == 1, fmt
+
+    # A JPEG whose SOF sits past the probe window: the header walk gives up,
+    # and Pillow picks up where the probe stopped instead of refetching
+    data = with_jpeg_segments(encode(noise(rng, (321, 123)), "JPEG"), 0xFE, 3)
+    url, requests = serve(data, "image/jpeg")
+    assert app.probe_image_size(url) == (321, 123)
+    assert requests() == [f"bytes=0-{app.IMAGE_PROBE_BYTES - 1}", f"bytes={app.IMAGE_PROBE_BYTES}-"]
+
+
+def test_short_file_needs_no_second_request(app, monkeypatch, serve):
+    # The whole file fits in the probe window, so Pillow gets it all up front
+    monkeypatch.setattr(app, "parse_image_size", lambda head: None)
+    url, requests = serve(encode(noise(random.Random(2), (9, 7)), "PNG"), "image/png")
+    assert app.probe_image_size(url) == (9, 7)
+    assert len(requests()) == 1
+
+
+def test_non_images_fail_fast(app, serve):
+    url, requests = serve(b"\0\0\0\x18ftypmp42" + b"\0" * 300_000, "video/mp4")
+    assert app.probe_image_size(url) is None
+    assert len(requests()) == 1
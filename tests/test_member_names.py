@@ -0,0 +1,116 @@
+"""fuzzy_find_member() through the trigram index against a scan of every name."""
+import random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+FIRST = ["alex", "sam", "jordan", "taylor", "chris", "pat", "jamie", "morgan", "casey", "riley", "drew", "kim"]
+LAST = ["smith", "jones", "lee", "brown", "garcia", "miller", "davis", "wilson", "moore", "clark"]
+
+
+def random_nickname(rng):
+    first, last = rng.choice(FIRST), rng.choice(LAST)
+    return rng.choice([
+        f"{first} {last}",
+        f"{first.capitalize()} {last.capitalize()}",
+        f"{first}_{last}{rng.randint(1, 99)}",
+        f"{first}.{last}",
+        f"xX_{first}_Xx",
+        f"{first} {last} jr",
+        first.upper(),
+        f"{last}, {first}",
+        f"ñandú {first}",
+        f"🔥{first}🔥",
+        f"{first}{last}",
+    ])
+
+
+def mutate(rng, name):
+    """A query derived from `name`: a typo or two, other case or token order."""
+    chars = list(name)
+    for _ in range(rng.randint(0, 2)):
+        i = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.3 and len(chars) > 2:
+            del chars[i]
+        elif op < 0.6:
+            chars.insert(i, rng.choice("aeiourst "))
+        elif i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    query = "".join(chars)
+    if rng.random() < 0.3:
+        query = " ".join(reversed(query.split()))
+    if rng.random() < 0.3:
+        query = query.swapcase()
+    return query
+
+
+def reference_find(members, former, query, cutoff):
+    """An exact (case-insensitive) name, else the best token_sort_ratio over every name; earlier names win ties."""
+    names = [(str(m["user_id"]), m["nickname"]) for m in members if m.get("nickname")]
+    current = {uid for uid, _ in names}
+    names += [(str(uid), nick) for uid, nick in former.items() if nick and str(uid) not in current]
+    for uid, nick in names:
+        if nick.lower() == query.lower():
+            return uid, nick
+    best, best_score = None, cutoff - 1
+    for uid, nick in names:
+        score = fuzz.token_sort_ratio(query, nick)
+        if score > best_score:
+            best, best_score = (uid, nick), score
+    return best
+
+
+@pytest.fixture
+def roster(app, fake_api):
+    """Replace the fake group's members and former_members; restored afterwards."""
+    with fake_api.lock:
+        saved_members = fake_api.members
+    saved_former = dict(app.former_members.items())
+
+    def use(members, former):
+        with fake_api.lock:
+            fake_api.members = members
+        app.former_members.clear()
+        app.former_members.update(former)
+        app.invalidate_roster()
+
+    yield use
+    use(saved_members, saved_former)
+
+
+def test_index_matches_full_scan(app, roster):
+    rng = random.Random(13)
+    members = [{"user_id": str(1000 + i), "id": f"m{1000 + i}", "nickname": random_nickname(rng)} for i in range(200)]
+    # Some former members share a name or user id with current ones
+    former = {str(5000 + i): random_nickname(rng) for i in range(60)}
+    former.update({members[i]["user_id"]: "old name" for i in range(5)})
+    roster(members, former)
+    names = [m["nickname"] for m in members] + list(former.values())
+    hits = 0
+    for _ in range(1500):
+        if rng.random() < 0.8:
+            query = mutate(rng, rng.choice(names))
+        else:
+            query = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(rng.randint(2, 14)))
+        query = query.strip()
+        if len(query) < 2 or query.startswith("@"):
+            continue
+        expected = reference_find(members, former, query, app.FUZZY_NAME_CUTOFF)
+        assert app.fuzzy_find_member(query) == expected, query
+        hits += expected is not None
+    # The generator has to exercise the fuzzy path, not just misses
+    assert hits > 300
+
+
+def test_roster_change_reaches_the_index(app, roster):
+    members = [{"user_id": "1", "id": "m1", "nickname": "Alex Smith"}, {"user_id": "2", "id": "m2", "nickname": "Sam Jones"}]
+    roster(members, {"3": "Morgan Lee"})
+    assert app.fuzzy_find_member("@alex smith") == ("1", "Alex Smith")
+    assert app.fuzzy_find_member("Lee Morgan") == ("3", "Morgan Lee")
+
+    # A rename lands through a roster refresh, a departure through former_members
+    roster([{"user_id": "1", "id": "m1", "nickname": "Alexandra Smith"}], {"3": "Morgan Lee", "2": "Sam Jones"})
+    assert app.fuzzy_find_member("Alex Smith") is None
+    assert app.fuzzy_find_member("alexandra smith") == ("1", "Alexandra Smith")
+    assert app.fuzzy_find_member("Sam Jones") == ("2", "Sam Jones")
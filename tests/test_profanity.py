@@ -0,0 +1,96 @@
+"""scan_profanity() against the per-word list checks it replaced, on random messages."""
+import random
+
+import pytest
+
+STRIP = '.,!?"\'()[]{}'
+SEPARATORS = [" ", "  ", "\n", "\t", " \r\n"]
+
+
+def reference_token(app, text):
+    """The old check_for_violations() rule: the first instant token, else any regular token."""
+    tokens = [word.strip(STRIP).lower() for word in text.lower().split()]
+    for token in tokens:
+        if token in app.INSTANT_BAN_WORDS:
+            return "instant", token
+    if any(token in app.REGULAR_SWEAR_WORDS for token in tokens):
+        return "regular", None
+    return None
+
+
+def scanned_token(app, text):
+    hits = app.scan_profanity(text, mode="token")
+    instant = next((h for h in hits if h.category == "instant"), None)
+    if instant:
+        return "instant", instant.word
+    if any(h.category == "regular" for h in hits):
+        return "regular", None
+    return None
+
+
+def reference_is_safe(app, text):
+    """The old is_safe() word check: any listed word anywhere in the message."""
+    content = text.lower()
+    return not any(word in content for word in app.INSTANT_BAN_WORDS + app.REGULAR_SWEAR_WORDS)
+
+
+def random_message(rng, words):
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        roll = rng.random()
+        if roll < 0.3:
+            word = rng.choice(words)
+        elif roll < 0.45:
+            word = rng.choice(words)[:rng.randint(1, 6)]
+        elif roll < 0.6:
+            word = rng.choice(words) + rng.choice(words)
+        else:
+            word = "".join(rng.choice("abcdefghiklmnorstuy1") for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.3:
+            word = word.upper() if rng.random() < 0.5 else word.capitalize()
+        word = "".join(rng.choices(STRIP, k=rng.randint(0, 2))) + word + "".join(rng.choices(STRIP, k=rng.randint(0, 2)))
+        if rng.random() < 0.1:
+            word = rng.choice("#@x-") + word
+        parts.append(word)
+    return "".join(part + rng.choice(SEPARATORS) for part in parts)
+
+
+@pytest.fixture
+def word_lists(app):
+    """Swap in other lists for one test; the originals are restored afterwards."""
+    saved = list(app.INSTANT_BAN_WORDS), list(app.REGULAR_SWEAR_WORDS)
+
+    def use(instant, regular):
+        app.INSTANT_BAN_WORDS[:] = instant
+        app.REGULAR_SWEAR_WORDS[:] = regular
+        app.compile_profanity_matcher()
+
+    yield use
+    use(*saved)
+
+
+def check_equivalence(app, seed, count):
+    rng = random.Random(seed)
+    words = app.INSTANT_BAN_WORDS + app.REGULAR_SWEAR_WORDS
+    for _ in range(count):
+        text = random_message(rng, words)
+        assert scanned_token(app, text) == reference_token(app, text), text
+        assert app.is_safe(text) == reference_is_safe(app, text), text
+
+
+def test_default_lists_match_word_checks(app):
+    check_equivalence(app, seed=4, count=5000)
+
+
+def test_overlapping_prefixes_match_word_checks(app, word_lists):
+    # Words that are prefixes of one another, shared between categories,
+    # and a multi-word entry that only substring matching can see
+    word_lists(["ass", "asshat", "b1tch", "two words"], ["as", "assi", "asshat", "bit", "bitch", "sh1t", "shit"])
+    check_equivalence(app, seed=44, count=5000)
+
+
+def test_hit_positions(app):
+    hits = app.scan_profanity("Well, (FUCK) this", mode="token")
+    assert [(h.word, h.category, h.start, h.end) for h in hits] == [("fuck", "regular", 7, 11)]
+    assert app.scan_profanity("unfuckingbelievable", mode="token") == []
+    assert app.scan_profanity("unfuckingbelievable", mode="substring", first_only=True)[0].word == "fucking"